@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import DDL, event, text
+
+from database import db
+
+from models import *
+
+# Per day club activity counters and trending club rankings.
+# club_activity holds, for every club and day (UTC), the number of joins, favorites and comments made that day
+# that still exist. SQLite triggers update it in the same statement as every insert or delete on club_members,
+# club_favorites and comment, whatever endpoint or script made the change, so rankings over a window of days
+# read at most one row per club and day instead of scanning the membership, favorite and comment tables.
+
+# Tables counted in club_activity and the counter each one updates
+ACTIVITY_SOURCES = (('club_members', 'joins'), ('club_favorites', 'favorites'), ('comment', 'comments'))
+
+# Rankings served by /api/clubs/trending. 'activity' is the sum of the three counters.
+TRENDING_METRICS = ('activity', 'joins', 'favorites', 'comments')
+
+# Longest window of days a ranking can cover
+MAX_TRENDING_DAYS = 90
+
+# Returns the triggers adding and removing a table's rows to and from its club_activity counter
+def activity_triggers(table, column):
+    return (
+        f"CREATE TRIGGER IF NOT EXISTS club_activity_{table}_insert AFTER INSERT ON {table} "
+        f"WHEN NEW.club_id IS NOT NULL AND NEW.created_at IS NOT NULL BEGIN "
+        f"INSERT INTO club_activity (day, club_id, {column}) VALUES (date(NEW.created_at), NEW.club_id, 1) "
+        f"ON CONFLICT (day, club_id) DO UPDATE SET {column} = {column} + 1; END",
+        f"CREATE TRIGGER IF NOT EXISTS club_activity_{table}_delete AFTER DELETE ON {table} "
+        f"WHEN OLD.club_id IS NOT NULL AND OLD.created_at IS NOT NULL BEGIN "
+        f"UPDATE club_activity SET {column} = {column} - 1 "
+        f"WHERE day = date(OLD.created_at) AND club_id = OLD.club_id; END"
+    )
+
+# Triggers keeping club_activity in sync, created by db.create_all() after the tables.
+# A deleted club's rows are removed by the ON DELETE CASCADE of club_activity.club_id.
+CLUB_ACTIVITY_TRIGGERS = tuple(
+    trigger for table, column in ACTIVITY_SOURCES for trigger in activity_triggers(table, column)
+)
+
+for trigger in CLUB_ACTIVITY_TRIGGERS:
+    event.listen(db.metadata, "after_create", DDL(trigger))
+
+# Recomputes every row of club_activity from the club_members, club_favorites and comment tables
+def rebuild_club_activity():
+    db.session.execute(text("DELETE FROM club_activity"))
+    db.session.execute(text(
+        "INSERT INTO club_activity (day, club_id, joins, favorites, comments) "
+        "SELECT day, club_id, sum(joins), sum(favorites), sum(comments) FROM ("
+        "SELECT date(created_at) AS day, club_id, 1 AS joins, 0 AS favorites, 0 AS comments FROM club_members "
+        "UNION ALL SELECT date(created_at), club_id, 0, 1, 0 FROM club_favorites "
+        "UNION ALL SELECT date(created_at), club_id, 0, 0, 1 FROM comment "
+        "WHERE club_id IS NOT NULL AND created_at IS NOT NULL"
+        ") GROUP BY day, club_id"
+    ))
+
+# Returns the top limit clubs by metric over the last days days (today included) as a list of
+# (club id, score) tuples, highest score first. Clubs with no activity in the window are left out.
+# Reads the club_activity rows of the window from its (day, club_id) primary key, so the cost depends on the
+# number of active clubs and days rather than on the number of joins, favorites and comments.
+def trending_club_scores(metric, days, limit, today=None):
+    if today is None:
+        today = datetime.now(timezone.utc).date()
+    if metric == 'activity':
+        column = club_activity.c.joins + club_activity.c.favorites + club_activity.c.comments
+    else:
+        column = club_activity.c[metric]
+    score = db.func.sum(column).label('score')
+    rows = db.session.query(club_activity.c.club_id, score) \
+        .filter(club_activity.c.day >= today - timedelta(days=days - 1)) \
+        .group_by(club_activity.c.club_id) \
+        .having(score > 0) \
+        .order_by(score.desc(), club_activity.c.club_id) \
+        .limit(limit).all()
+    return [tuple(row) for row in rows]
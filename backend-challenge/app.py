@@ -1,42 +1,135 @@
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
+import gc
+import os
 
-DB_FILE = "clubreview.db"
-
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB_FILE}"
-db = SQLAlchemy(app)
+from flask import Blueprint, Flask, request, jsonify
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import configure_mappers
+from sqlalchemy.orm.exc import StaleDataError
 
+from database import *
+from json_provider import *
 from models import *
-
-
-@app.route("/")
+from metrics import *
+from pagination import *
+from streaming import *
+from serializers import *
+from search import *
+from tag_stats import *
+from activity import *
+from recommendations import *
+from threads import *
+from cache import *
+from versioning import *
+from routing import *
+from group_commit import *
+
+# Routes of the API, registered on each app made by create_app
+bp = Blueprint('api', __name__)
+
+# Creates an app. Settings are read from the environment (see database.py and json_provider.py) and then
+# overridden by config, e.g. create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'}) for an isolated in-memory
+# instance. Apps share the models and session events, but each has its own engines, response cache,
+# recommendation index and group commit writer.
+# `flask run` and `python3 app.py` call it, and WSGI servers can too, e.g. `gunicorn "app:create_app()"`.
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = get_database_uri()
+    app.config["DB_PROFILE"] = get_db_profile()
+    app.config["PRELOAD"] = os.environ.get('APP_PRELOAD') == '1'
+    app.config.update(config or {})
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS",
+                          get_engine_options(app.config["SQLALCHEMY_DATABASE_URI"], app.config["DB_PROFILE"]))
+    read_uri = get_read_database_uri(app.config["SQLALCHEMY_DATABASE_URI"])
+    if read_uri is not None:
+        app.config.setdefault("SQLALCHEMY_BINDS", {
+            READ_BIND_KEY: {'url': read_uri, **get_engine_options(read_uri, app.config["DB_PROFILE"])}
+        })
+    app.json = get_json_provider_class()(app)
+    db.init_app(app)
+
+    with app.app_context():
+        apply_sqlite_pragmas(db.engine, app.config["DB_PROFILE"])
+        if READ_BIND_KEY in db.engines:
+            apply_sqlite_pragmas(db.engines[READ_BIND_KEY], app.config["DB_PROFILE"], read_only=True)
+
+    init_metrics(app)
+    init_routing(app)
+    app.register_blueprint(bp)
+    if app.config["PRELOAD"]:
+        preload_app(app)
+    return app
+
+# GET requests sent by preload_app. They run the main read paths once, compiling their statements, and fill the
+# response cache with the reference data (tags, schools and majors).
+PRELOAD_PATHS = ('/api/tags', '/api/schools', '/api/majors', '/api/clubs', '/api/clubs/trending',
+                 '/api/clubs/search/penn')
+
+# Warms an app in the current process so that processes forked from it start ready to serve: with the PRELOAD
+# app config (or APP_PRELOAD=1) and `gunicorn --preload`, gunicorn's parent process runs it once and its workers
+# are forked from it. It configures the mappers, sends PRELOAD_PATHS to fill SQLAlchemy's compiled statement cache
+# and the response cache, and builds the recommendation index. It then closes the pooled connections, which must
+# not be shared with the workers, and freezes the objects created so far so the garbage collector of the workers
+# does not write to them, keeping their memory shared copy-on-write with the parent.
+def preload_app(app):
+    with app.app_context():
+        configure_mappers()
+        client = app.test_client()
+        for path in PRELOAD_PATHS:
+            client.get(path)
+        build_recommendation_index()
+        for engine in db.engines.values():
+            engine.dispose()
+    reset_histograms()
+    gc.collect()
+    gc.freeze()
+
+
+# Invalid limit, cursor or fields query parameters on paginated endpoints
+@bp.app_errorhandler(PaginationError)
+def pagination_error(error):
+    return jsonify({'error': str(error)}), 400
+
+# A comment was modified by another request between being read and written (see versioning.py)
+@bp.app_errorhandler(StaleDataError)
+def stale_data_error(error):
+    db.session.rollback()
+    if request.if_match:
+        return jsonify({'error': 'Precondition Failed: resource was modified'}), 412
+    return jsonify({'error': 'Conflict: resource was modified by another request, please retry'}), 409
+
+
+@bp.route("/")
 def main():
     return "Welcome to Penn Club Review!"
 
 
-@app.route("/api")
+@bp.route("/api")
 def api():
     return jsonify({"message": "Welcome to the Penn Club Review API!."})
 
 
-@app.route("/api/test", methods=["GET"])
+@bp.route("/api/test", methods=["GET"])
 def test():
-    clubs = Club.query.filter(Club.name.contains("p")).all()
-    return jsonify([club.to_json() for club in clubs])
+    club_ids = [row.id for row in Club.query.filter(Club.name.contains("p")).order_by(Club.id).with_entities(Club.id)]
+    return jsonify(serialize_clubs(club_ids))
 
 # GET: returns the club with the given club id
 # POST: modify a club with given parameters given club code
 # DELETE: Delete the specified club from the database given club code
-@app.route("/api/clubs/<int:club_id>", methods=["GET","POST","DELETE"])
+@bp.route("/api/clubs/<int:club_id>", methods=["GET","POST","DELETE"])
+@cached_response
 def clubs(club_id):
     if request.method == "GET":
-        club = Club.query.get(club_id)
-        
-        if club is None:
+        # Answers with 304 from the club's version alone if the client's copy is current
+        etag = club_etag(club_id)
+        if etag is None:
             return jsonify({'error':'Club Not Found'}), 404
+        response = not_modified(etag)
+        if response is not None:
+            return response
 
-        return jsonify(club.to_json())
+        cache_depends_on('club', [club_id])
+        return with_etag(jsonify(serialize_clubs([club_id])[0]), etag)
 
     if request.method == "POST":
         club = Club.query.get(club_id)
@@ -44,6 +137,11 @@ def clubs(club_id):
         # Abort if club does not exist
         if club is None:
             return jsonify({'error':'Club Not Found'}), 404
+
+        # Abort if the client edited an outdated copy of the club
+        lock_if_match(Club, club_id)
+        if not if_match_passes(club_etag(club_id)):
+            return jsonify({'error':'Precondition Failed: club was modified'}), 412
         
         # Get relevant club data from input json
         data = request.get_json()
@@ -66,8 +164,9 @@ def clubs(club_id):
         if not updated:
             return jsonify({'error': 'At least one field to update (name, tags, description) must be non-null.'}), 400
             
+        index_club(club)
         db.session.commit()
-        return jsonify(club.to_json()), 200
+        return with_etag(jsonify(club.to_json()), club_etag(club_id)), 200
     
     if request.method == "DELETE":
         # Aborts if club does not exist
@@ -77,18 +176,94 @@ def clubs(club_id):
             
         # Deletes the specified club
         db.session.delete(club)
+        unindex_club(club_id)
         
         db.session.commit()
         return "", 204
     
-# GET: Returns a list of all clubs with the given string in their name
-@app.route("/api/clubs/search/<club_string>", methods=["GET"])
+# GET: Returns a ranked list of clubs whose name, description or tags match the words in club_string
+@bp.route("/api/clubs/search/<club_string>", methods=["GET"])
 def search_clubs(club_string):
-    clubs = Club.query.filter(Club.name.contains(club_string)).all();
-    return jsonify([club.to_json() for club in clubs]), 200;
+    limit, cursor, fields = get_page_args(CLUB_FIELDS, default_limit=None)
+    stream_format = get_stream_format()
+    if stream_format is not None:
+        batches = iter_search_club_ids(club_string, STREAM_BATCH_SIZE)
+        return stream_response((serialize_clubs(club_ids, fields) for club_ids in batches), stream_format)
+    club_ids, next_cursor = search_club_ids(club_string, limit, cursor)
+    return paginated_response(serialize_clubs(club_ids, fields), next_cursor)
+
+# Maximum number of tags a club listing can be filtered by
+MAX_FILTER_TAGS = 20
+
+# Returns a list of clubs ordered by id.
+# Takes in optional `tags`, a comma separated list of tag ids, and `match`, either `all` (default) to list the
+# clubs having every tag or `any` to list the clubs having at least one of them. Aborts if a tag does not exist.
+@bp.route("/api/clubs", methods=["GET"])
+@cached_response
+def list_clubs():
+    limit, cursor, fields = get_page_args(CLUB_FIELDS)
+    match = request.args.get('match', 'all')
+    if match not in ('all', 'any'):
+        return jsonify({'error':'match must be all or any'}), 400
+
+    requested = request.args.get('tags')
+    if requested is None:
+        cache_depends_on('club')
+        club_ids, next_cursor = paginate_ids(Club.query, (Club.id,), limit, cursor)
+        return paginated_response(serialize_clubs(club_ids, fields), next_cursor)
+
+    try:
+        tag_ids = list(dict.fromkeys(int(tag_id) for tag_id in requested.split(',')))
+    except ValueError:
+        return jsonify({'error':'tags must be a comma separated list of tag ids'}), 400
+    if len(tag_ids) > MAX_FILTER_TAGS:
+        return jsonify({'error':f'At most {MAX_FILTER_TAGS} tags can be filtered by'}), 400
+    found = {row[0] for row in db.session.query(Tag.id).filter(Tag.id.in_(tag_ids))}
+    if len(found) < len(tag_ids):
+        return jsonify({'error':'Tag Not Found'}), 404
+
+    club_ids, next_cursor = tagged_club_ids(tag_ids, match, limit, cursor)
+    cache_depends_on('tag', tag_ids)
+    cache_depends_on('club', club_ids)
+    return paginated_response(serialize_clubs(club_ids, fields), next_cursor)
+
+# Returns the clubs with the most activity over the last `days` days (default 7, at most 90), highest first.
+# `metric` ranks them by `joins`, `favorites`, `comments` or `activity`, the sum of the three (default).
+# Takes in `limit` and `fields` like paginated endpoints. Each club includes its `score` for the window.
+@bp.route("/api/clubs/trending", methods=["GET"])
+@cached_response
+def trending_clubs():
+    limit, _, fields = get_page_args(CLUB_FIELDS)
+    metric = request.args.get('metric', 'activity')
+    if metric not in TRENDING_METRICS:
+        return jsonify({'error':f"metric must be one of {', '.join(TRENDING_METRICS)}"}), 400
+    days = get_int_arg('days', 7)
+    if not 1 <= days <= MAX_TRENDING_DAYS:
+        return jsonify({'error':f'days must be between 1 and {MAX_TRENDING_DAYS}'}), 400
+
+    scores = trending_club_scores(metric, days, limit)
+    cache_depends_on('club')
+    return jsonify(serialize_scored_clubs(scores, fields))
+
+# Response of the recommendation endpoints while the first recommendation index is being built
+def recommendations_unavailable():
+    return jsonify({'error':'Recommendations are being computed, please retry shortly'}), 503, {'Retry-After': '5'}
+
+# Returns the clubs most similar to the club with the given id, most similar first, each with its `similarity`.
+# Takes in `limit` (at most 50) and `fields` like paginated endpoints. Aborts if the club does not exist.
+@bp.route("/api/clubs/<int:club_id>/similar", methods=["GET"])
+def similar_clubs(club_id):
+    limit, _, fields = get_page_args(CLUB_FIELDS)
+    if db.session.query(Club.id).filter(Club.id == club_id).scalar() is None:
+        return jsonify({'error':'Club Not Found'}), 404
+    index = get_recommendation_index()
+    if index is None:
+        return recommendations_unavailable()
+    neighbors = index.similar(club_id, limit)
+    return jsonify(serialize_scored_clubs(neighbors, fields, 'similarity'))
 
 # Creates a club with the given parameters
-@app.route("/api/clubs", methods=["POST"])
+@bp.route("/api/clubs", methods=["POST"])
 def create_club():
     # Get relevant information from input josn
     data = request.get_json()
@@ -115,61 +290,100 @@ def create_club():
         description=club_description, 
         tags=tags_list)
     db.session.add(new_club)
+    db.session.flush()
+    index_club(new_club)
     db.session.commit()
 
     return jsonify(new_club.to_json()), 201
 
 # Helper method to generate a list of database objects when given names and the model type
-# Searches for pre-existing ones when possible, otherwise creates new
+# Uses pre-existing ones when possible, otherwise creates new
 # To be used for many-to-many relationships
+# Resolves all names with one IN lookup, inserts the missing ones in one statement that ignores rows a concurrent
+# request inserted first, and re-selects them, so the number of queries does not depend on the number of names
 def get_model_list(models, model_type):
-    return_list = []
-    if models is not None:
-        for model in models:
-            result = model_type.query.filter(model_type.name == model).first()
-            if result is None:
-                new_model = model_type(name=model)
-                return_list.append(new_model)
-            else:
-                return_list.append(result)
-    return return_list
+    if models is None:
+        return []
+    names = list(dict.fromkeys(models))
+    if not names:
+        return []
+
+    found = {model.name: model for model in model_type.query.filter(model_type.name.in_(names))}
+    missing = [name for name in names if name not in found]
+    if missing:
+        db.session.execute(
+            sqlite_insert(model_type.__table__).on_conflict_do_nothing(index_elements=['name']),
+            [{'name': name} for name in missing]
+        )
+        found.update((model.name, model) for model in model_type.query.filter(model_type.name.in_(missing)))
+    return [found[name] for name in names]
     
 # Returns a list of all tags and the number of clubs associated with them.
-@app.route("/api/tags", methods=["GET"])
+@bp.route("/api/tags", methods=["GET"])
+@cached_response
 def get_tags():
-    tags = Tag.query.all()
-    return jsonify([tag.to_json() for tag in tags])
+    limit, cursor, fields = get_page_args(TAG_FIELDS, default_limit=None)
+    cache_depends_on('tag')
+    tag_ids, next_cursor = paginate_ids(Tag.query, (Tag.id,), limit, cursor)
+    return paginated_response(serialize_tags(tag_ids, fields), next_cursor)
 
 # Returns a list of all clubs with the requested tag. Aborts if tag does not exist.
-@app.route("/api/tags/<int:tag_id>", methods=["GET"])
+@bp.route("/api/tags/<int:tag_id>", methods=["GET"])
+@cached_response
 def get_clubs_by_tag(tag_id):
-    tag = Tag.query.get(tag_id)
-
-    if tag is None:
+    if db.session.query(Tag.id).filter(Tag.id == tag_id).scalar() is None:
         return jsonify({'error':'Tag Not Found'}), 404
 
-    return jsonify([club.to_json() for club in tag.clubs]), 200
+    limit, cursor, fields = get_page_args(CLUB_FIELDS, default_limit=None)
+    tag_clubs = db.session.query(club_tags).filter(club_tags.c.tag_id == tag_id)
+    stream_format = get_stream_format()
+    if stream_format is not None:
+        batches = iter_id_batches(tag_clubs, (club_tags.c.club_id,))
+        return stream_response((serialize_clubs(club_ids, fields) for club_ids in batches), stream_format)
+
+    club_ids, next_cursor = paginate_ids(tag_clubs, (club_tags.c.club_id,), limit, cursor)
+    cache_depends_on('tag', [tag_id])
+    cache_depends_on('club', club_ids)
+    return paginated_response(serialize_clubs(club_ids, fields), next_cursor)
 
 # GET: Returns user data for the user with the requested id
 # DELETE: Deletes the user with the requsted id
 # POST: Modifies the user with the given updated data
-@app.route("/api/users/<int:id>", methods=["GET", "DELETE", "POST"])
+@bp.route("/api/users/<int:id>", methods=["GET", "DELETE", "POST"])
 def user(id):
+    # Reads are answered from column rows without loading the User instance
+    if request.method == "GET":
+        etag = user_etag(id)
+        if etag is None:
+            return jsonify({'error':'User Not Found'}), 404
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        return with_etag(jsonify(serialize_users([id])[0]), etag), 200
+
     user = User.query.get(id)
     
     # Abort if user does not exist
     if user is None:
         return jsonify({'error':'User Not Found'}), 404
     
-    if request.method == "GET":
-        return jsonify(user.to_json()), 200
-    
     if request.method == "DELETE":
+        # The user's memberships, favorites, schools and majors are deleted by the database, and their comments
+        # are kept without an author. The member and favorite counts of their clubs change, so the clubs' versions
+        # are bumped here in one statement.
+        club_ids = db.session.query(club_members.c.club_id).filter(club_members.c.user_id == id).union(
+            db.session.query(club_favorites.c.club_id).filter(club_favorites.c.user_id == id))
+        bump_versions(Club, [row[0] for row in club_ids])
         db.session.delete(user)
         db.session.commit()
         return "", 204
     
     if request.method == "POST":
+        # Abort if the client edited an outdated copy of the user
+        lock_if_match(User, id)
+        if not if_match_passes(user_etag(id)):
+            return jsonify({'error':'Precondition Failed: user was modified'}), 412
+
         # Updates the specified user information if provided
         data = request.get_json()
         name = data.get('name')
@@ -181,18 +395,18 @@ def user(id):
         if user_graduation_year is not None:
             user.graduation_year = user_graduation_year
             
-        # If School data provided, updates current School(s). If not in system and missing Name, abort.
+        # If School data provided, updates current School(s). If not in system and missing Code or Name, abort.
         if user_schools is not None:
             user_schools = get_relation_list(user_schools, School)
             if user_schools is None:
-                return jsonify({'error':'School Name Missing and School does not already exist'}), 422
+                return jsonify({'error':'School Code or Name Missing and School does not already exist'}), 422
             user.schools = user_schools
         
-        # If Major data provided, updates current Major(s). If not in system and missing Name, abort.    
+        # If Major data provided, updates current Major(s). If not in system and missing Code or Name, abort.    
         if user_majors is not None:
             user_majors = get_relation_list(user_majors, Major)
             if user_majors is None:
-                return jsonify({'error':'Major Name Missing and Major does not already exist'}), 422
+                return jsonify({'error':'Major Code or Name Missing and Major does not already exist'}), 422
             user.majors = user_majors
             
         if name is not None:
@@ -202,10 +416,23 @@ def user(id):
             user.email = user_email
             
         db.session.commit()
-        return jsonify(user.to_json()), 200
+        return with_etag(jsonify(user.to_json()), user_etag(id)), 200
+
+# Returns the clubs recommended to the user with the given id, best first, each with its `score`.
+# Takes in `limit` (at most 50) and `fields` like paginated endpoints. Aborts if the user does not exist.
+@bp.route("/api/users/<int:id>/recommendations", methods=["GET"])
+def user_recommendations(id):
+    limit, _, fields = get_page_args(CLUB_FIELDS)
+    if db.session.query(User.id).filter(User.id == id).scalar() is None:
+        return jsonify({'error':'User Not Found'}), 404
+    index = get_recommendation_index()
+    if index is None:
+        return recommendations_unavailable()
+    recommendations = index.recommend(id, limit)
+    return jsonify(serialize_scored_clubs(recommendations, fields))
 
 # Creates a new user with the given data
-@app.route("/api/users", methods=["POST"])
+@bp.route("/api/users", methods=["POST"])
 def create_user():
     # Get parameters from input json
     data = request.get_json()
@@ -224,7 +451,7 @@ def create_user():
         return jsonify({'error':'Bad Request: User with this email already exists'}), 400
 
     # Handles School and Major data to handle None case and using pre-existing vs creating new 
-    # instances of each. Also aborts if Major/School not found and no name provided.
+    # instances of each. Also aborts if Major/School not found and no code or name provided.
     user_majors = get_relation_list(user_major, Major)
     if user_majors is None:
         user_majors = []
@@ -246,113 +473,240 @@ def create_user():
     return jsonify(new_user.to_json()), 201
 
 # Given a type of model and list of model instances (primarily for School and Major Data),
-# returns the existing version if already in the database, otherwise creates a new one with name and id.
-# Returns None if none found and no name was provided.
+# returns the existing version if already in the database, otherwise creates a new one with id, code and name.
+# Returns None if none found and no code or name was provided.
+# Like get_model_list, uses one IN lookup, one insert of the missing rows and one re-select regardless of list size
 def get_relation_list(models, model_type):
-    return_list = []
-    if models is not None:
-        for model in models:
-            if not isinstance(model, dict) or "id" not in model:
-                return None
-            result = model_type.query.filter(model_type.id == model["id"]).first()
-            if result is None:
-                if "name" not in model:
-                    return None
-                new_model = model_type(id=model["id"], name=model["name"])
-                return_list.append(new_model)
-            else:
-                return_list.append(result)
-    return return_list
+    if models is None:
+        return []
+    if not all(isinstance(model, dict) and "id" in model for model in models):
+        return None
+    requested = {model["id"]: model for model in models}
+    if not requested:
+        return []
+
+    found = {model.id: model for model in model_type.query.filter(model_type.id.in_(requested.keys()))}
+    missing = [requested[model_id] for model_id in requested if model_id not in found]
+    if missing:
+        if not all("code" in model and "name" in model for model in missing):
+            return None
+        db.session.execute(
+            sqlite_insert(model_type.__table__).on_conflict_do_nothing(),
+            [{"id": model["id"], "code": model["code"], "name": model["name"]} for model in missing]
+        )
+        found.update((model.id, model) for model in model_type.query.filter(model_type.id.in_([model["id"] for model in missing])))
+        # A new row can still be ignored if its code belongs to a different id
+        if len(found) < len(requested):
+            return None
+    return [found[model_id] for model_id in requested]
     
-# Adds a club to a user's favorites list when passed a username.
-# If club is already favorited, removes it from the list
-@app.route("/api/clubs/<int:club_id>/favorite", methods=["POST"])
-def add_remove_favorite(club_id):
+# Toggles the row linking a club and a user in an association table (club_members or club_favorites).
+# Checks that both exist with primary key lookups and then toggles the row through write_link_toggle.
+# Returns a tuple of (response, status).
+def toggle_link(table, club_id, added, removed):
     data = request.get_json()
     user_id = data.get('user_id')
 
-    if user_id == None:
+    # Abort if no user id provided
+    if user_id is None:
         return jsonify({'error':'Missing Required Data user_id'}), 422
 
-    club = Club.query.get(club_id)
-    user = User.query.get(user_id)
-
-    # Abort if club or user doesn ot exist
-    if club is None:
+    # Abort if Club or User does not exist
+    if db.session.query(Club.id).filter(Club.id == club_id).scalar() is None:
         return jsonify({'error':'Club not found'}), 404
-    if user is None:
+    if db.session.query(User.id).filter(User.id == user_id).scalar() is None:
         return jsonify({'error':'User not found'}), 404
 
-    # Logic for adding/removing club from User's favorites list
-    if club in user.favorites:
-        user.favorites.remove(club)
-        action = "removed"
-    else:
-        user.favorites.append(club)
-        action = "added"
-        
-    db.session.commit()
-    return jsonify({'success': True, 'action': action}), 200
+    linked = run_write(write_link_toggle, table, club_id, user_id)
+    return jsonify({'success': True, 'action': added if linked else removed}), 200
+
+# Deletes the row linking a club and a user, inserting it only if there was none, so the cost does not depend
+# on how many clubs the user is in. The DELETE takes SQLite's write lock before the INSERT, so two concurrent
+# toggles are applied one after the other instead of both seeing the same state.
+# Run through run_write (see group_commit.py). Returns True if the row was inserted.
+def write_link_toggle(table, club_id, user_id):
+    cache_changes = {'cache_changes': [('club', club_id)]}
+    link = (table.c.club_id == club_id) & (table.c.user_id == user_id)
+    linked = not db.session.execute(table.delete().where(link), execution_options=cache_changes).rowcount
+    if linked:
+        db.session.execute(
+            sqlite_insert(table).values(club_id=club_id, user_id=user_id).on_conflict_do_nothing(),
+            execution_options=cache_changes
+        )
+    queue_link_change(table, club_id, user_id, linked)
+
+    bump_versions(Club, [club_id])
+    bump_versions(User, [user_id])
+    return linked
+
+# Adds a club to a user's favorites list when passed a username.
+# If club is already favorited, removes it from the list
+@bp.route("/api/clubs/<int:club_id>/favorite", methods=["POST"])
+def add_remove_favorite(club_id):
+    return toggle_link(club_favorites, club_id, 'added', 'removed')
 
 # Adds a club to a user's member list when passed a username.
 # If user is already a member, removes them from the list
-@app.route("/api/clubs/<int:club_id>/join", methods=["POST"])
+@bp.route("/api/clubs/<int:club_id>/join", methods=["POST"])
 def add_remove_member(club_id):
+    return toggle_link(club_members, club_id, 'joined', 'left')
+
+# Maximum number of ids accepted by the batch membership and favorites endpoints
+MAX_BATCH_SIZE = 1000
+
+# Reads the `add` and `remove` id lists of a batch request.
+# Returns a tuple of (ids to add, ids to remove, error message or None).
+def get_batch_ids(data):
+    add_ids = data.get('add') or []
+    remove_ids = data.get('remove') or []
+    if not isinstance(add_ids, list) or not isinstance(remove_ids, list):
+        return None, None, 'add and remove must be lists of ids'
+    # bool is a subclass of int, but true and false are not ids
+    if not all(isinstance(item, int) and not isinstance(item, bool) for item in add_ids + remove_ids):
+        return None, None, 'add and remove must be lists of ids'
+    if not add_ids and not remove_ids:
+        return None, None, 'At least one id to add or remove is required'
+    if len(add_ids) + len(remove_ids) > MAX_BATCH_SIZE:
+        return None, None, f'At most {MAX_BATCH_SIZE} ids can be changed per request'
+    if set(add_ids) & set(remove_ids):
+        return None, None, 'An id cannot be both added and removed'
+    return list(dict.fromkeys(add_ids)), list(dict.fromkeys(remove_ids)), None
+
+# Applies a batch of additions and removals to one owner's rows of a club/user association table
+# (club_members or club_favorites) using a fixed number of set-based statements.
+# owner_column/owner_id is the side that stays fixed (e.g. club_members.c.club_id and a club id), and
+# item_column/item_model the side whose ids were passed in. added/removed are the words used as each item's action.
+# Returns a tuple of (per item results, ids of the items whose rows changed).
+def apply_link_batch(table, owner_column, owner_id, item_column, item_model, add_ids, remove_ids, added, removed):
+    requested = add_ids + remove_ids
+    found = {row[0] for row in db.session.query(item_model.id).filter(item_model.id.in_(requested))}
+    linked = {row[0] for row in db.session.query(item_column).filter(owner_column == owner_id, item_column.in_(requested))}
+
+    to_add = [item_id for item_id in add_ids if item_id in found and item_id not in linked]
+    to_remove = [item_id for item_id in remove_ids if item_id in linked]
+    # Only the responses of the clubs whose rows change need to be evicted from the response cache
+    club_ids = [owner_id] if owner_column.name == 'club_id' else to_add + to_remove
+    cache_changes = {'cache_changes': [('club', club_id) for club_id in club_ids]}
+    if to_add:
+        db.session.execute(
+            sqlite_insert(table).on_conflict_do_nothing(),
+            [{owner_column.name: owner_id, item_column.name: item_id} for item_id in to_add],
+            execution_options=cache_changes
+        )
+    if to_remove:
+        db.session.execute(
+            table.delete().where(owner_column == owner_id, item_column.in_(to_remove)),
+            execution_options=cache_changes
+        )
+    for item_ids, is_linked in ((to_add, True), (to_remove, False)):
+        for item_id in item_ids:
+            link = {owner_column.name: owner_id, item_column.name: item_id}
+            queue_link_change(table, link['club_id'], link['user_id'], is_linked)
+
+    results = []
+    for item_id in requested:
+        if item_id not in found:
+            action = 'not_found'
+        elif item_id in add_ids:
+            action = added if item_id not in linked else 'unchanged'
+        else:
+            action = removed if item_id in linked else 'unchanged'
+        results.append({'id': item_id, 'action': action})
+    return results, to_add + to_remove
+
+# Shared implementation of the batch endpoints below. Validates the request, applies the batch in one
+# transaction, bumps the versions of the club(s) and user(s) whose data changed and returns the per item results.
+def link_batch_response(table, owner_model, owner_id, added, removed):
+    if db.session.query(owner_model.id).filter(owner_model.id == owner_id).scalar() is None:
+        return jsonify({'error': f'{owner_model.__name__} not found'}), 404
+
     data = request.get_json()
-    user_id = data.get('user_id')
+    if not isinstance(data, dict):
+        return jsonify({'error':'Bad Request: body must be a JSON object'}), 400
+    add_ids, remove_ids, error = get_batch_ids(data)
+    if error is not None:
+        return jsonify({'error': error}), 422
+
+    if owner_model is Club:
+        owner_column, item_column, item_model = table.c.club_id, table.c.user_id, User
+    else:
+        owner_column, item_column, item_model = table.c.user_id, table.c.club_id, Club
+    results, changed_ids = apply_link_batch(
+        table, owner_column, owner_id, item_column, item_model, add_ids, remove_ids, added, removed)
 
-    # Abort if no user id provided
-    if user_id is None:
-        return jsonify({'error':'Missing Required Data user_id'}), 422
+    if changed_ids:
+        bump_versions(owner_model, [owner_id])
+        bump_versions(item_model, changed_ids)
+    db.session.commit()
 
-    club = Club.query.get(club_id)
-    user = User.query.get(user_id)
+    summary = {}
+    for result in results:
+        summary[result['action']] = summary.get(result['action'], 0) + 1
+    return jsonify({'success': True, 'results': results, 'summary': summary}), 200
 
-    # Abort if Club or User does not exist
-    if club is None:
-        return jsonify({'error':'Club not found'}), 404
-    if user is None:
-        return jsonify({'error':'User not found'}), 404
+# Adds and removes many users from a club's members in one request.
+# Takes in `add` and/or `remove`, lists of user ids.
+@bp.route("/api/clubs/<int:club_id>/members/batch", methods=["POST"])
+def batch_club_members(club_id):
+    return link_batch_response(club_members, Club, club_id, 'joined', 'left')
 
-    # Logic for adding/removing club from User's member list
-    if club in user.clubs:
-        user.clubs.remove(club)
-        action = "left"
-    else:
-        user.clubs.append(club)
-        action = "joined"
+# Adds and removes a club from many users' favorites in one request.
+# Takes in `add` and/or `remove`, lists of user ids.
+@bp.route("/api/clubs/<int:club_id>/favorites/batch", methods=["POST"])
+def batch_club_favorites(club_id):
+    return link_batch_response(club_favorites, Club, club_id, 'added', 'removed')
 
-    db.session.commit()
-    return jsonify({'success': True, 'action': action}), 200
+# Joins and leaves many clubs for a user in one request.
+# Takes in `add` and/or `remove`, lists of club ids.
+@bp.route("/api/users/<int:user_id>/clubs/batch", methods=["POST"])
+def batch_user_clubs(user_id):
+    return link_batch_response(club_members, User, user_id, 'joined', 'left')
+
+# Adds and removes many clubs from a user's favorites in one request.
+# Takes in `add` and/or `remove`, lists of club ids.
+@bp.route("/api/users/<int:user_id>/favorites/batch", methods=["POST"])
+def batch_user_favorites(user_id):
+    return link_batch_response(club_favorites, User, user_id, 'added', 'removed')
 
 
 # GET: Returns comment with the given ID
 # POST: Modifies comment with the given ID
 # DELETE: Removes the comment with the given id as well as all replies to that comment
-@app.route("/api/comments/<int:comment_id>", methods=["DELETE", "POST", "GET"])
+@bp.route("/api/comments/<int:comment_id>", methods=["DELETE", "POST", "GET"])
 def comment(comment_id):
-    comment = Comment.query.get(comment_id)
+    # Reads only need the columns of the comment's ETag, so they skip loading the Comment instance
+    if request.method == "GET":
+        comment = db.session.query(Comment.id, Comment.version, Comment.club_id).filter(Comment.id == comment_id).first()
+    else:
+        comment = Comment.query.get(comment_id)
     
     # Aborts if comment with specified code does not exist
     if comment is None:
         return jsonify({'error':'Comment not found'}), 404
 
     if request.method == "GET":
-        return jsonify(comment.to_json()), 200
+        max_depth, replies_limit = get_thread_args()
+        etag = comment_etag(comment)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        return with_etag(jsonify(load_threads([comment_id], max_depth, replies_limit)[0]), etag), 200
 
-    data = request.get_json()
     if request.method == "POST":
+        data = request.get_json()
+        # Abort if the client edited an outdated copy of the comment
+        if not if_match_passes(comment_etag(comment)):
+            return jsonify({'error':'Precondition Failed: comment was modified'}), 412
+
         comment_body = data.get('body')
         
         # Abort if missing user name or comment body
         if comment_body == None:
             return jsonify({'error':'Required data body is missing'}), 422
 
-        comment.body = comment_body
-        comment.updated_at = db.func.now()
-            
-        db.session.commit()
-        return jsonify(comment.to_json()), 200
+        # The version read here is only required to still be current when the client sent If-Match
+        run_write(write_comment_edit, comment_id, comment.version if request.if_match else None, comment_body)
+        return with_etag(jsonify(load_threads([comment_id])[0]), comment_etag(comment)), 200
     
     if request.method == "DELETE":
         # Delete the comment from the database
@@ -360,17 +714,60 @@ def comment(comment_id):
         db.session.commit()
         return "", 204
     
-@app.route("/api/clubs/<int:club_id>/comments", methods=["GET","POST"])
+# Returns a page of the direct replies of a comment, oldest first, each with its own replies loaded through
+# load_threads. Pages with `limit` and `cursor`, or `after` the id of the last reply the client already has.
+@bp.route("/api/comments/<int:comment_id>/replies", methods=["GET"])
+def comment_replies(comment_id):
+    comment = db.session.query(Comment.id, Comment.version, Comment.club_id).filter(Comment.id == comment_id).first()
+    if comment is None:
+        return jsonify({'error':'Comment not found'}), 404
+
+    limit, cursor, fields = get_page_args(COMMENT_FIELDS)
+    max_depth, replies_limit = get_thread_args()
+    cursor = get_replies_cursor(comment_id, cursor)
+    etag = make_etag('replies', comment_etag(comment))
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    replies = Comment.query.filter(Comment.parent_id == comment_id)
+    reply_ids, next_cursor = paginate_ids(replies, (Comment.created_at, Comment.id), limit, cursor)
+    threads = load_threads(reply_ids, max_depth, replies_limit)
+    response = paginated_response([{field: reply[field] for field in fields} for reply in threads], next_cursor)
+    return with_etag(response, etag)
+
+@bp.route("/api/clubs/<int:club_id>/comments", methods=["GET","POST"])
 def comment_club(club_id):
-    club = Club.query.get(club_id)
+    club = db.session.query(Club.id).filter(Club.id == club_id).first()
     
     # Aborts if club with specified code does not exist
     if club is None:
         return jsonify({'error':'Club not found'}), 404
     
-    # Returns a list of all information for all comments obtained through the to_json() function
+    # Returns a page of top level comments sorted by date, with their replies loaded through load_threads
     if request.method == "GET":
-        return jsonify(sorted([comment.to_json() for comment in club.comments if comment.parent_id is None], key=lambda item: item['created_at'])), 200
+        limit, cursor, fields = get_page_args(COMMENT_FIELDS, default_limit=None)
+        max_depth, replies_limit = get_thread_args()
+        etag = club_comments_etag(club_id)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        top_level = Comment.query.filter(Comment.club_id == club_id, Comment.parent_id.is_(None))
+        stream_format = get_stream_format()
+        if stream_format is not None:
+            # Threads can be large, so fewer of them are loaded at a time
+            batches = iter_id_batches(top_level, (Comment.created_at, Comment.id), COMMENT_STREAM_BATCH_SIZE)
+            response = stream_response((
+                [{field: comment[field] for field in fields} for comment in load_threads(comment_ids, max_depth, replies_limit)]
+                for comment_ids in batches
+            ), stream_format)
+            return with_etag(response, etag)
+
+        comment_ids, next_cursor = paginate_ids(top_level, (Comment.created_at, Comment.id), limit, cursor)
+        comments = load_threads(comment_ids, max_depth, replies_limit)
+        response = paginated_response([{field: comment[field] for field in fields} for comment in comments], next_cursor)
+        return with_etag(response, etag)
     
     data = request.get_json()
     if request.method == "POST":
@@ -384,27 +781,66 @@ def comment_club(club_id):
         if User.query.get(user_id) is None:
             return jsonify({'error':'User not found'}), 404
 
-        # Creates the Comment with given data
-        comment = Comment(
-            user_id=user_id, 
-            body=comment_body, 
-            club_id=club_id,
-            parent_id=parent_id
-        )
-            
-        db.session.add(comment)
-        db.session.commit()
-        return jsonify(comment.to_json()), 201
+        # A reply must be to an existing comment of the same club
+        if parent_id is not None:
+            parent_club_id = db.session.query(Comment.club_id).filter(Comment.id == parent_id).first()
+            if parent_club_id is None:
+                return jsonify({'error':'Parent comment not found'}), 404
+            if parent_club_id[0] != club_id:
+                return jsonify({'error':'Parent comment belongs to a different club'}), 422
+
+        comment_id = run_write(write_comment, club_id, user_id, comment_body, parent_id)
+        return jsonify(Comment.query.get(comment_id).to_json()), 201
+
+# Creates a comment. Run through run_write (see group_commit.py). Returns the id of the new comment.
+def write_comment(club_id, user_id, comment_body, parent_id):
+    # Creates the Comment with given data
+    comment = Comment(
+        user_id=user_id, 
+        body=comment_body, 
+        club_id=club_id,
+        parent_id=parent_id
+    )
+
+    db.session.add(comment)
+    db.session.flush()
+    return comment.id
+
+# Edits the body of a comment. Run through run_write (see group_commit.py).
+# Raises StaleDataError if the comment was deleted, or modified since version when a version is given.
+def write_comment_edit(comment_id, version, comment_body):
+    comment = Comment.query.get(comment_id)
+    if comment is None or version is not None and comment.version != version:
+        raise StaleDataError(f"Comment {comment_id} was modified since version {version}")
+
+    comment.body = comment_body
+    comment.updated_at = db.func.now()
     
-@app.route("/api/schools", methods=["GET"])
+@bp.route("/api/schools", methods=["GET"])
+@cached_response
 def get_schools():
-    schools = School.query.all()
-    return jsonify([school.to_json() for school in schools]), 200
+    limit, cursor, fields = get_page_args(SCHOOL_FIELDS, default_limit=None)
+    cache_depends_on('school')
+    school_ids, next_cursor = paginate_ids(School.query, (School.id,), limit, cursor)
+    return paginated_response(serialize_schools(school_ids, fields), next_cursor)
 
-@app.route("/api/majors", methods=["GET"])
+@bp.route("/api/majors", methods=["GET"])
+@cached_response
 def get_majors():
-    majors = Major.query.all()
-    return jsonify([major.to_json() for major in majors]), 200
+    limit, cursor, fields = get_page_args(MAJOR_FIELDS, default_limit=None)
+    cache_depends_on('major')
+    major_ids, next_cursor = paginate_ids(Major.query, (Major.id,), limit, cursor)
+    return paginated_response(serialize_majors(major_ids, fields), next_cursor)
+
+# Returns the hit, miss and eviction counters of the response cache
+@bp.route("/api/_cache", methods=["GET"])
+def cache_stats():
+    return jsonify(get_response_cache().stats()), 200
+
+# Returns the per route latency, SQL and serialization histograms in the Prometheus text format
+@bp.route("/api/_metrics", methods=["GET"])
+def request_metrics():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 if __name__ == "__main__":
-    app.run()
+    create_app().run()
@@ -0,0 +1,158 @@
+import io
+import os
+import sys
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.util import await_only
+
+from app import create_app
+from database import apply_sqlite_pragmas, db, get_engine_options
+
+# Async ASGI entry point, e.g. `uvicorn asgi:application`.
+# Serves the same routes as app.py: every request is dispatched to the Flask app inside
+# AsyncSession.run_sync, with db.session set to the async session's synchronous facade. The views, models,
+# serializers, caching, ETags and versioning are therefore shared with the WSGI app, while every SQL statement
+# goes through SQLAlchemy's async engine (aiosqlite) and awaits the database without blocking a thread.
+# The request body is read on the event loop before the view runs, and a non-streamed request only holds a
+# database connection while its view runs, so slow clients do not tie up threads or connections. Each chunk of the
+# response is sent as soon as the Flask app yields it, so streamed responses (streaming.py) keep their bounded
+# memory use and start before the last row is read; they hold their connection until the last chunk is sent.
+# Requires the asgi dependency group (`poetry install --with asgi`: sqlalchemy[asyncio], aiosqlite and uvicorn).
+# Read routing (READ_DATABASE_URL) is not used in this mode: all statements run on the async engine.
+# Each request is dispatched in its own greenlet, which has its own context variables, so the Flask request and
+# app contexts, and db.session (scoped to the app context), stay separate while requests interleave on the loop.
+
+# Returns the URI of the async engine: ASYNC_DATABASE_URL if set, otherwise the app's SQLite database opened
+# with the aiosqlite driver
+def get_async_database_uri(app, environ=os.environ):
+    if 'ASYNC_DATABASE_URL' in environ:
+        return environ['ASYNC_DATABASE_URL']
+    with app.app_context():
+        url = db.engine.url
+    if url.get_backend_name() != 'sqlite':
+        raise ValueError("Set ASYNC_DATABASE_URL to serve a database other than SQLite in async mode")
+    return url.set(drivername='sqlite+aiosqlite').render_as_string(hide_password=False)
+
+# Synchronous session class used by the async sessions. It subclasses the class of db.session so the session
+# event listeners of cache.py, versioning.py, routing.py and search.py apply, and runs every statement on the
+# async engine it is bound to instead of the Flask-SQLAlchemy engines.
+class AsyncBridgeSession(db.session.session_factory.class_):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        return bind or self.bind
+
+# Returns the WSGI environ of an ASGI http request with the given body
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+# Runs a request through a Flask app with db.session set to session, the same way Flask.wsgi_app does, and sends
+# the response through the ASGI send callable. Runs inside AsyncSession.run_sync, so the response body is read from
+# the app's iterator in the request's greenlet, where streamed responses can still query the database, and every
+# chunk is awaited on the event loop as it is produced. Every chunk but the last is sent with more_body set.
+# The app context's teardown removes db.session, which closes session and gives its connection back to the async
+# engine.
+def dispatch(session, app, environ, send):
+    ctx = app.request_context(environ)
+    error = None
+    try:
+        try:
+            ctx.push()
+            db.session.registry.set(session)
+            response = app.full_dispatch_request()
+        except Exception as e:
+            error = e
+            response = app.handle_exception(e)
+        # Drops the body of HEAD requests and 304 responses like a WSGI server would
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        try:
+            await_only(send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            }))
+            # Holds back one chunk so the last one can be sent without more_body
+            previous = b''
+            for chunk in app_iter:
+                if chunk:
+                    if previous:
+                        await_only(send({'type': 'http.response.body', 'body': previous, 'more_body': True}))
+                    previous = chunk
+            await_only(send({'type': 'http.response.body', 'body': previous}))
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+    finally:
+        ctx.pop(error)
+
+# Reads the whole body of an ASGI http request
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+# Returns an ASGI application serving a Flask app (create_app in app.py) on an async engine opened on
+# async_database_uri, by default the one returned by get_async_database_uri. The engine is disposed on the
+# lifespan shutdown event.
+def create_asgi_app(app, async_database_uri=None):
+    if async_database_uri is None:
+        async_database_uri = get_async_database_uri(app)
+    async_engine = create_async_engine(
+        async_database_uri, **get_engine_options(async_database_uri, app.config["DB_PROFILE"]))
+    apply_sqlite_pragmas(async_engine.sync_engine, app.config["DB_PROFILE"])
+    async_session = async_sessionmaker(async_engine, sync_session_class=AsyncBridgeSession, expire_on_commit=False,
+                                       db=db)
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await async_engine.dispose()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        body = await read_body(receive)
+        if body is None:
+            return
+        async with async_session() as session:
+            await session.run_sync(dispatch, app, build_environ(scope, body), send)
+
+    return application
+
+# ASGI application served by `uvicorn asgi:application`
+application = create_asgi_app(create_app())
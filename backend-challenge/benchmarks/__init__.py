@@ -0,0 +1 @@
+# Benchmark suite for the API. Run with `python -m benchmarks --help` from the backend-challenge folder.
@@ -0,0 +1,98 @@
+import argparse
+import os
+import random
+import sys
+
+# Command line entry point of the benchmark suite: seeds a synthetic database, runs the scenarios and prints,
+# saves or compares the results.
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmark the club review API.")
+    parser.add_argument("--scale", default="small", choices=("small", "medium", "large"),
+                        help="preset size of the synthetic database")
+    for key in ("clubs", "tags", "users", "tags-per-club", "clubs-per-user", "favorites-per-user", "threads",
+                "comment-depth", "comment-fanout"):
+        parser.add_argument(f"--{key}", type=int, help=f"override the number of {key.replace('-', ' ')} of the scale")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random data and requests")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="requests sent at the same time")
+    parser.add_argument("--server", action="store_true",
+                        help="send requests over HTTP to a local WSGI server instead of the Flask test client")
+    parser.add_argument("--scenario", action="append", default=[], help="only run this scenario (repeatable)")
+    parser.add_argument("--cache", action="store_true", help="keep the response cache enabled")
+    parser.add_argument("--group-commit", action="store_true",
+                        help="commit joins, favorites and comment writes in batches (see group_commit.py)")
+    parser.add_argument("--save", metavar="PATH", help="write the results to a JSON baseline file")
+    parser.add_argument("--compare", metavar="PATH", help="compare the results with a JSON baseline file")
+    parser.add_argument("--threshold", type=float, default=20,
+                        help="percent of p50/p95 latency growth reported as a regression")
+    parser.add_argument("--encoding", action="store_true",
+                        help="also report the encode throughput of each JSON provider on large club and comment payloads")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # The benchmark database is separate from the development one unless DATABASE_URL says otherwise
+    os.environ.setdefault("DATABASE_URL", "sqlite:///benchmark.db")
+    from app import create_app
+    from benchmarks.runner import (FlaskClientDriver, WSGIServerDriver, compare_results, load_baseline,
+                                   print_comparison, print_results, run_metadata, run_scenario, save_baseline)
+    from benchmarks.scenarios import select_scenarios
+    from benchmarks.seed import SCALES, seed_database
+
+    scale = dict(SCALES[args.scale])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+    scenarios = select_scenarios(args.scenario)
+    app = create_app()
+    app.config['RESPONSE_CACHE_ENABLED'] = args.cache
+    app.config['GROUP_COMMIT_ENABLED'] = args.group_commit
+
+    with app.app_context():
+        ids = seed_database(scale, args.seed)
+
+    driver = WSGIServerDriver(app) if args.server else FlaskClientDriver(app)
+    rng = random.Random(args.seed)
+    results = {}
+    try:
+        for scenario in scenarios:
+            results[scenario[0]] = run_scenario(
+                driver, scenario, ids, rng, args.requests, args.warmup, args.concurrency)
+            print(f"{scenario[0]}: p50 {results[scenario[0]]['p50_ms']}ms", file=sys.stderr)
+    finally:
+        driver.close()
+
+    print_results(results)
+    if args.group_commit:
+        from group_commit import group_commit_stats
+        with app.app_context():
+            stats = group_commit_stats()
+        if stats is not None:
+            print(f"Group commit: {stats['writes']} writes in {stats['batches']} batches "
+                  f"({stats['writes'] / max(stats['batches'], 1):.1f} writes per commit)")
+    if args.encoding:
+        from benchmarks.encoding import encoding_payloads, print_encoding, run_encoding
+        with app.app_context():
+            payloads = encoding_payloads(ids)
+        print_encoding(run_encoding(app, payloads))
+    metadata = run_metadata(scale, args.seed, driver.name, args.concurrency, args.cache, args.group_commit)
+    if args.save:
+        save_baseline(args.save, metadata, results)
+        print(f"Saved results to {args.save}")
+    if args.compare:
+        baseline = load_baseline(args.compare)
+        for key in ('scale', 'seed', 'driver', 'concurrency', 'response_cache', 'group_commit'):
+            if baseline['metadata'].get(key) != metadata[key]:
+                print(f"Warning: the baseline was run with a different {key}: {baseline['metadata'].get(key)}")
+        rows, regressions = compare_results(baseline, results, args.threshold)
+        print_comparison(rows)
+        if regressions:
+            print(f"Regressed: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+import time
+
+from flask.json.provider import DefaultJSONProvider
+
+from json_provider import OrjsonProvider, orjson
+from serializers import serialize_clubs
+from threads import load_threads
+
+# Encode throughput of the JSON providers.
+# Builds the json data of every seeded club and comment thread once, then times how long each available provider
+# takes to turn it into a response body, the same way jsonify does. Reports the best time of several runs, the
+# throughput in MB/s and the speedup over the standard library provider.
+
+# Returns the payloads to encode, keyed by name. Must be called inside an app context.
+def encoding_payloads(ids):
+    return {
+        'clubs': serialize_clubs(ids['club_ids']),
+        'comments': load_threads(ids['thread_root_ids'])
+    }
+
+# Returns the (name, provider class) pairs of the providers that can run here
+def available_providers():
+    providers = [('stdlib', DefaultJSONProvider)]
+    if orjson is not None:
+        providers.append(('orjson', OrjsonProvider))
+    return providers
+
+# Encodes every payload repeat times with each provider. Returns a dictionary of measures keyed by
+# (payload, provider) name pairs.
+def run_encoding(app, payloads, repeat=20):
+    results = {}
+    for payload_name, payload in payloads.items():
+        baseline = None
+        for provider_name, provider_class in available_providers():
+            provider = provider_class(app)
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                body = provider.response(payload).get_data()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            baseline = baseline or best
+            results[(payload_name, provider_name)] = {
+                'items': len(payload),
+                'bytes': len(body),
+                'best_ms': round(best * 1000, 3),
+                'mb_per_s': round(len(body) / best / 1e6, 1),
+                'speedup': round(baseline / best, 2)
+            }
+    return results
+
+# Prints the results of run_encoding as a table
+def print_encoding(results, out=print):
+    columns = ('items', 'bytes', 'best_ms', 'mb_per_s', 'speedup')
+    out(f"{'payload':<12}{'provider':<10}" + ''.join(f"{column:>12}" for column in columns))
+    for (payload_name, provider_name), result in results.items():
+        out(f"{payload_name:<12}{provider_name:<10}" + ''.join(f"{str(result[column]):>12}" for column in columns))
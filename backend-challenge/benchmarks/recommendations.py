@@ -0,0 +1,81 @@
+import argparse
+import itertools
+import random
+import sys
+import time
+
+from benchmarks.runner import percentile
+
+# Benchmark of the recommendation index (recommendations.py).
+# Builds an index in memory from synthetic links and tags, without a database, then reports its build time and
+# the latency of similar club lookups, user recommendations and incremental join/leave updates.
+# e.g. `python -m benchmarks.recommendations --clubs 10000 --users 100000`
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.recommendations",
+                                     description="Benchmark the recommendation index.")
+    parser.add_argument("--clubs", type=int, default=10000, help="number of clubs")
+    parser.add_argument("--users", type=int, default=100000, help="number of users")
+    parser.add_argument("--tags", type=int, default=200, help="number of tags")
+    parser.add_argument("--tags-per-club", type=int, default=4, help="tags of every club")
+    parser.add_argument("--clubs-per-user", type=int, default=10, help="clubs every user joined")
+    parser.add_argument("--favorites-per-user", type=int, default=5, help="clubs every user favorited")
+    parser.add_argument("--lookups", type=int, default=10000, help="measured lookups of each kind")
+    parser.add_argument("--updates", type=int, default=1000, help="measured join and leave updates")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random data and lookups")
+    return parser.parse_args(argv)
+
+# Returns synthetic (club id, user id, bit) links and (club id, tag id) rows. Users pick clubs with a skew
+# towards popular ones, so some clubs have many more users than others like real data.
+def synthetic_rows(args, rng):
+    from recommendations import FAVORITE, MEMBER
+
+    club_ids = list(range(1, args.clubs + 1))
+    cum_weights = list(itertools.accumulate(1 / club_id ** 0.5 for club_id in club_ids))
+    links = []
+    for user_id in range(1, args.users + 1):
+        for bit, count in ((MEMBER, args.clubs_per_user), (FAVORITE, args.favorites_per_user)):
+            for club_id in set(rng.choices(club_ids, cum_weights=cum_weights, k=count)):
+                links.append((club_id, user_id, bit))
+    tag_ids = list(range(1, args.tags + 1))
+    tags = [(club_id, tag_id) for club_id in club_ids
+            for tag_id in rng.sample(tag_ids, min(args.tags_per_club, len(tag_ids)))]
+    return club_ids, links, tags
+
+# Calls function on each argument and returns the sorted latencies in microseconds
+def time_calls(function, arguments):
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(*argument)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    return sorted(latencies)
+
+def main(argv=None):
+    args = parse_args(argv)
+    from recommendations import MEMBER, RecommendationIndex
+
+    rng = random.Random(args.seed)
+    club_ids, links, tags = synthetic_rows(args, rng)
+    start = time.perf_counter()
+    index = RecommendationIndex.from_rows(club_ids, links, tags)
+    print(f"Built the index of {args.clubs} clubs, {args.users} users and {len(links)} links "
+          f"in {time.perf_counter() - start:.1f}s")
+
+    user_ids = range(1, args.users + 1)
+    results = {
+        'similar': time_calls(index.similar, [(rng.choice(club_ids), 10) for _ in range(args.lookups)]),
+        'recommend': time_calls(index.recommend, [(rng.choice(user_ids), 10) for _ in range(args.lookups)])
+    }
+    updates = [(rng.choice(club_ids), rng.choice(user_ids)) for _ in range(args.updates)]
+    results['join'] = time_calls(index.apply, [(('link', club_id, user_id, MEMBER, True),) for club_id, user_id in updates])
+    results['leave'] = time_calls(index.apply, [(('link', club_id, user_id, MEMBER, False),) for club_id, user_id in updates])
+
+    print(f"{'operation':<12}" + ''.join(f"{column:>12}" for column in ('calls', 'p50_us', 'p95_us', 'p99_us', 'max_us')))
+    for name, latencies in results.items():
+        values = [percentile(latencies, p) for p in (50, 95, 99)] + [latencies[-1]]
+        print(f"{name:<12}{len(latencies):>12}" + ''.join(f"{value:>12.1f}" for value in values))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
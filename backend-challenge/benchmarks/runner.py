@@ -0,0 +1,180 @@
+import http.client
+import json
+import math
+import platform
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+# Runs benchmark scenarios against the app and reports latency percentiles, throughput and query counts.
+# Requests are sent either through the Flask test client, which measures the app without any network, or over
+# HTTP to a local threaded WSGI server. The number of SQL statements of each request is read from the
+# Server-Timing header added by metrics.py, so it is available in both modes.
+
+SERVER_TIMING_QUERIES = re.compile(r'desc="(\d+) queries"')
+
+# Sends requests through a Flask test client per thread
+class FlaskClientDriver:
+    name = 'test-client'
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, url, body):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        response = self.local.client.open(url, method=method, json=body)
+        response.get_data()
+        return response.status_code, response.headers.get('Server-Timing', '')
+
+    def close(self):
+        pass
+
+# Request handler that does not log every request
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+# Serves the app from a local threaded WSGI server and sends requests over one keep-alive connection per thread
+class WSGIServerDriver:
+    name = 'wsgi-server'
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.local = threading.local()
+
+    def request(self, method, url, body):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port)
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        self.local.connection.request(method, url, body=data, headers=headers)
+        response = self.local.connection.getresponse()
+        response.read()
+        return response.status, response.getheader('Server-Timing', '')
+
+    def close(self):
+        self.server.shutdown()
+
+# Returns the pth percentile of a sorted list of values using the nearest rank method
+def percentile(values, p):
+    if not values:
+        return None
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+# Sends warmup + requests requests of a scenario, concurrency at a time, and returns its measures
+def run_scenario(driver, scenario, ids, rng, requests, warmup=0, concurrency=1):
+    name, method, build = scenario
+    for _ in range(warmup):
+        driver.request(method, *build(rng, ids))
+    # Requests are built up front so the random choices do not depend on thread scheduling
+    planned = [build(rng, ids) for _ in range(requests)]
+
+    def send(request):
+        start = time.perf_counter()
+        status, server_timing = driver.request(method, *request)
+        latency = time.perf_counter() - start
+        match = SERVER_TIMING_QUERIES.search(server_timing)
+        return latency, status, int(match.group(1)) if match else None
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as executor:
+            measures = list(executor.map(send, planned))
+    else:
+        measures = [send(request) for request in planned]
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency * 1000 for latency, _, _ in measures)
+    queries = [count for _, _, count in measures if count is not None]
+    return {
+        'method': method,
+        'requests': len(measures),
+        'errors': sum(1 for _, status, _ in measures if status >= 400),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'max_ms': round(latencies[-1], 3),
+        'throughput_rps': round(len(measures) / elapsed, 1),
+        'queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+        'queries_max': max(queries) if queries else None
+    }
+
+# Returns the short hash of the current git commit, or None outside of a git checkout
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Returns the metadata stored with benchmark results
+def run_metadata(scale, seed, driver, concurrency, cache, group_commit=False):
+    return {
+        'commit': git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'scale': scale,
+        'seed': seed,
+        'driver': driver,
+        'concurrency': concurrency,
+        'response_cache': cache,
+        'group_commit': group_commit
+    }
+
+# Writes results and their metadata to a JSON baseline file
+def save_baseline(path, metadata, results):
+    with open(path, 'w') as baseline_file:
+        json.dump({'metadata': metadata, 'results': results}, baseline_file, indent=2, sort_keys=True)
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+# Compares results with a baseline. A value regressed if the p50 or p95 latency grew by more than threshold
+# percent, or if the scenario runs more queries on average. Returns a list of
+# (scenario, field, before, after, change in percent, regressed) tuples and the names of the regressed scenarios.
+def compare_results(baseline, results, threshold):
+    rows = []
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        for field in ('p50_ms', 'p95_ms', 'queries_mean'):
+            if before.get(field) is None or result.get(field) is None:
+                continue
+            change = (result[field] - before[field]) / before[field] * 100 if before[field] else 0
+            if field == 'queries_mean':
+                regressed = result[field] > before[field]
+            else:
+                regressed = change > threshold
+            rows.append((name, field, before[field], result[field], change, regressed))
+    regressions = list(dict.fromkeys(row[0] for row in rows if row[5]))
+    return rows, regressions
+
+# Prints the results as a table
+def print_results(results, out=print):
+    columns = ('requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'queries_mean', 'queries_max')
+    out(f"{'scenario':<22}" + ''.join(f"{column:>15}" for column in columns))
+    for name, result in results.items():
+        out(f"{name:<22}" + ''.join(f"{str(result[column]):>15}" for column in columns))
+
+# Prints a comparison made by compare_results
+def print_comparison(rows, out=print):
+    out(f"{'scenario':<22}{'field':>15}{'baseline':>15}{'current':>15}{'change':>10}")
+    for name, field, before, after, change, regressed in rows:
+        flag = '  REGRESSION' if regressed else ''
+        out(f"{name:<22}{field:>15}{before:>15}{after:>15}{change:>+9.1f}%{flag}")
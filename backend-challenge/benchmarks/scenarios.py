@@ -0,0 +1,111 @@
+import itertools
+
+# Benchmark scenarios.
+# Each scenario is a (name, method, build) tuple, where build(rng, ids) returns the url and json body of the next
+# request, picking its club, tag, user and comment ids from the ids returned by seed_database.
+
+# Unique suffixes for the clubs and users created by the write scenarios
+created = itertools.count(1)
+
+def search_clubs(rng, ids):
+    return f"/api/clubs/search/{rng.choice(ids['words'])}", None
+
+def search_clubs_prefix(rng, ids):
+    return f"/api/clubs/search/{rng.choice(ids['words'])[:3]}", None
+
+def get_club(rng, ids):
+    return f"/api/clubs/{rng.choice(ids['club_ids'])}", None
+
+def update_club(rng, ids):
+    return f"/api/clubs/{rng.choice(ids['club_ids'])}", {'description': f"Updated {next(created)}"}
+
+def create_club(rng, ids):
+    number = next(created)
+    return "/api/clubs", {'code': f"bench-{number}", 'name': f"Benchmark Club {number}", 'tags': ['Tag 1', 'Tag 2']}
+
+def get_tags(rng, ids):
+    return "/api/tags", None
+
+def get_clubs_by_tag(rng, ids):
+    return f"/api/tags/{rng.choice(ids['tag_ids'])}", None
+
+def clubs_with_all_tags(rng, ids):
+    tags = rng.sample(ids['tag_ids'], min(2, len(ids['tag_ids'])))
+    return f"/api/clubs?tags={','.join(map(str, tags))}&match=all", None
+
+def clubs_with_any_tag(rng, ids):
+    tags = rng.sample(ids['tag_ids'], min(3, len(ids['tag_ids'])))
+    return f"/api/clubs?tags={','.join(map(str, tags))}&match=any", None
+
+def trending_clubs(rng, ids):
+    return f"/api/clubs/trending?metric={rng.choice(('activity', 'joins', 'favorites'))}&days={rng.choice((1, 7, 30))}", None
+
+def get_user(rng, ids):
+    return f"/api/users/{rng.choice(ids['user_ids'])}", None
+
+def create_user(rng, ids):
+    number = next(created)
+    return "/api/users", {'name': f"Benchmark {number}", 'email': f"bench{number}@upenn.edu",
+                          'school': [{'id': 1}], 'major': [{'id': 1}]}
+
+def get_schools(rng, ids):
+    return "/api/schools", None
+
+def get_majors(rng, ids):
+    return "/api/majors", None
+
+def toggle_join(rng, ids):
+    return f"/api/clubs/{rng.choice(ids['club_ids'])}/join", {'user_id': rng.choice(ids['user_ids'])}
+
+def toggle_favorite(rng, ids):
+    return f"/api/clubs/{rng.choice(ids['club_ids'])}/favorite", {'user_id': rng.choice(ids['user_ids'])}
+
+def batch_members(rng, ids):
+    return f"/api/clubs/{rng.choice(ids['club_ids'])}/members/batch", {
+        'add': rng.sample(ids['user_ids'], min(50, len(ids['user_ids'])))}
+
+def comment_club(rng, ids):
+    return f"/api/clubs/{rng.choice(ids['thread_club_ids'])}/comments", None
+
+def get_comment_thread(rng, ids):
+    return f"/api/comments/{rng.choice(ids['thread_root_ids'])}", None
+
+def post_comment(rng, ids):
+    return f"/api/clubs/{rng.choice(ids['thread_club_ids'])}/comments", {
+        'user_id': rng.choice(ids['user_ids']), 'body': 'Benchmark comment'}
+
+def edit_comment(rng, ids):
+    return f"/api/comments/{rng.choice(ids['thread_root_ids'])}", {'body': f"Edited comment {rng.random()}"}
+
+SCENARIOS = (
+    ('search_clubs', 'GET', search_clubs),
+    ('search_clubs_prefix', 'GET', search_clubs_prefix),
+    ('get_club', 'GET', get_club),
+    ('update_club', 'POST', update_club),
+    ('create_club', 'POST', create_club),
+    ('get_tags', 'GET', get_tags),
+    ('get_clubs_by_tag', 'GET', get_clubs_by_tag),
+    ('clubs_with_all_tags', 'GET', clubs_with_all_tags),
+    ('clubs_with_any_tag', 'GET', clubs_with_any_tag),
+    ('trending_clubs', 'GET', trending_clubs),
+    ('get_user', 'GET', get_user),
+    ('create_user', 'POST', create_user),
+    ('get_schools', 'GET', get_schools),
+    ('get_majors', 'GET', get_majors),
+    ('toggle_join', 'POST', toggle_join),
+    ('toggle_favorite', 'POST', toggle_favorite),
+    ('batch_members', 'POST', batch_members),
+    ('comment_club', 'GET', comment_club),
+    ('get_comment_thread', 'GET', get_comment_thread),
+    ('post_comment', 'POST', post_comment),
+    ('edit_comment', 'POST', edit_comment)
+)
+
+# Returns the scenarios whose names are listed, or every scenario if names is empty
+def select_scenarios(names):
+    if not names:
+        return SCENARIOS
+    unknown = set(names) - {name for name, _, _ in SCENARIOS}
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return tuple(scenario for scenario in SCENARIOS if scenario[0] in names)
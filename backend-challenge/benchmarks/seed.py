@@ -0,0 +1,146 @@
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import insert
+
+from database import db
+from database import remove_sqlite_files
+
+from models import *
+from search import rebuild_search_index
+
+# Synthetic data for benchmarks.
+# Creates a fresh database with a configurable number of clubs, tags, users, memberships, favorites and comment
+# threads. Every choice comes from a random.Random seeded with a fixed value, so the same scale and seed always
+# produce the same database and benchmark results can be compared across commits.
+
+# Preset scales, which can be overridden one value at a time from the command line
+SCALES = {
+    'small': {
+        'clubs': 500, 'tags': 50, 'users': 500, 'tags_per_club': 3, 'clubs_per_user': 10,
+        'favorites_per_user': 5, 'threads': 5, 'comment_depth': 10, 'comment_fanout': 5
+    },
+    'medium': {
+        'clubs': 5000, 'tags': 200, 'users': 5000, 'tags_per_club': 4, 'clubs_per_user': 20,
+        'favorites_per_user': 10, 'threads': 20, 'comment_depth': 30, 'comment_fanout': 10
+    },
+    'large': {
+        'clubs': 50000, 'tags': 1000, 'users': 50000, 'tags_per_club': 5, 'clubs_per_user': 50,
+        'favorites_per_user': 20, 'threads': 50, 'comment_depth': 100, 'comment_fanout': 20
+    }
+}
+
+# Words club names and descriptions are built from
+WORDS = (
+    'penn', 'quaker', 'juggling', 'robotics', 'chess', 'debate', 'film', 'dance', 'jazz', 'coding', 'finance',
+    'consulting', 'theatre', 'poetry', 'cycling', 'rowing', 'climbing', 'cooking', 'gaming', 'astronomy',
+    'biology', 'chemistry', 'physics', 'history', 'philosophy', 'music', 'choir', 'photography', 'design',
+    'startup', 'volunteer', 'outdoors', 'language', 'culture', 'policy', 'health', 'medicine', 'law', 'art'
+)
+
+# Number of past days the joins and favorites are spread over
+ACTIVITY_DAYS = 30
+
+# Rows inserted per executemany statement
+INSERT_CHUNK_SIZE = 5000
+
+# Inserts rows into a table in chunks of INSERT_CHUNK_SIZE
+def insert_rows(table, rows):
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        db.session.execute(insert(table), rows[start:start + INSERT_CHUNK_SIZE])
+
+# Returns a unique club name for the club with index i
+def club_name(rng, i):
+    return f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()} Club {i}"
+
+# Returns the comment rows of one thread under a club: a chain of depth comments, each with fanout replies,
+# one of which continues the chain. Comment ids are assigned here so replies can point to their parents.
+def thread_rows(rng, club_id, user_ids, depth, fanout, next_id):
+    rows = []
+    parent_id = None
+    for _ in range(depth):
+        chain_id = None
+        for _ in range(fanout if parent_id is not None else 1):
+            rows.append({
+                'id': next_id,
+                'body': ' '.join(rng.choices(WORDS, k=8)),
+                'user_id': rng.choice(user_ids),
+                'club_id': club_id,
+                'parent_id': parent_id
+            })
+            chain_id = chain_id or next_id
+            next_id += 1
+        parent_id = chain_id
+    return rows
+
+# Deletes the current database and fills a new one with synthetic data of the given scale.
+# Returns a dictionary of the ids benchmark scenarios pick their requests from.
+def seed_database(scale, seed=0, report=print):
+    start = time.perf_counter()
+    rng = random.Random(seed)
+
+    url = db.engine.url
+    if url.get_backend_name() == 'sqlite' and url.database:
+        db.engine.dispose()
+        remove_sqlite_files(url.database)
+    db.create_all()
+
+    insert_rows(School.__table__, [{'id': 1, 'code': 'SEAS', 'name': 'School of Engineering and Applied Sciences'},
+                                   {'id': 2, 'code': 'COL', 'name': 'College of Arts and Sciences'}])
+    insert_rows(Major.__table__, [{'id': 1, 'code': 'CSCI', 'name': 'Computer and Information Sciences'},
+                                  {'id': 2, 'code': 'ECON', 'name': 'Economics'}])
+
+    tag_ids = list(range(1, scale['tags'] + 1))
+    insert_rows(Tag.__table__, [{'id': tag_id, 'name': f"Tag {tag_id}"} for tag_id in tag_ids])
+
+    club_ids = list(range(1, scale['clubs'] + 1))
+    insert_rows(Club.__table__, [{
+        'id': club_id,
+        'code': f"club-{club_id}",
+        'name': club_name(rng, club_id),
+        'description': ' '.join(rng.choices(WORDS, k=20))
+    } for club_id in club_ids])
+    tags_per_club = min(scale['tags_per_club'], len(tag_ids))
+    insert_rows(club_tags, [{'club_id': club_id, 'tag_id': tag_id}
+                            for club_id in club_ids for tag_id in rng.sample(tag_ids, tags_per_club)])
+
+    user_ids = list(range(1, scale['users'] + 1))
+    insert_rows(User.__table__, [{
+        'id': user_id,
+        'name': f"User {user_id}",
+        'email': f"user{user_id}@upenn.edu",
+        'graduation_year': rng.randint(2025, 2029)
+    } for user_id in user_ids])
+    insert_rows(users_schools, [{'user_id': user_id, 'school_id': rng.randint(1, 2)} for user_id in user_ids])
+    insert_rows(users_majors, [{'user_id': user_id, 'major_id': rng.randint(1, 2)} for user_id in user_ids])
+    # Joins and favorites are spread over the last ACTIVITY_DAYS days so trending rankings have history to read
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    for table, per_user in ((club_members, 'clubs_per_user'), (club_favorites, 'favorites_per_user')):
+        count = min(scale[per_user], len(club_ids))
+        insert_rows(table, [{
+            'user_id': user_id,
+            'club_id': club_id,
+            'created_at': now - timedelta(seconds=rng.randrange(ACTIVITY_DAYS * 86400))
+        } for user_id in user_ids for club_id in rng.sample(club_ids, count)])
+
+    thread_club_ids = club_ids[:scale['threads']]
+    comments = []
+    for club_id in thread_club_ids:
+        comments.extend(thread_rows(
+            rng, club_id, user_ids, scale['comment_depth'], scale['comment_fanout'], len(comments) + 1))
+    insert_rows(Comment.__table__, comments)
+
+    rebuild_search_index()
+    db.session.commit()
+    report(f"Seeded {len(club_ids)} clubs, {len(user_ids)} users and {len(comments)} comments "
+           f"in {time.perf_counter() - start:.1f}s")
+
+    return {
+        'club_ids': club_ids,
+        'tag_ids': tag_ids,
+        'user_ids': user_ids,
+        'thread_club_ids': thread_club_ids,
+        'thread_root_ids': [row['id'] for row in comments if row['parent_id'] is None],
+        'words': WORDS
+    }
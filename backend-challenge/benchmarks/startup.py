@@ -0,0 +1,140 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Benchmark of the app's startup (create_app and preload_app in app.py).
+# Reports the time a fresh interpreter takes to import the app, create it and serve its first request, the cost
+# of each further create_app call in the same process, and how long a process forked from a running app (as
+# gunicorn forks its workers) takes to serve its first requests, with and without preload. Forked processes also
+# report how much of their memory is still shared with the parent, where Linux exposes it.
+# Runs against the database set by DATABASE_URL (see database.py), which should hold data, e.g. from bootstrap.py.
+# e.g. `python -m benchmarks.startup --runs 10`
+
+# Requests served by each forked process. Club 1 exists in both the bootstrapped and the benchmark databases.
+FIRST_PATHS = ('/api/clubs', '/api/tags', '/api/clubs/trending', '/api/clubs/1', '/api/clubs/1/similar')
+
+# Run by a fresh interpreter: prints the import, create_app and first request times as JSON
+COLD_START = """
+import json, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+app.test_client().get('/api/clubs')
+served = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported, 'first_request': served - created}))
+"""
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.startup", description="Benchmark the app's startup.")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts and forked processes measured")
+    parser.add_argument("--apps", type=int, default=20, help="in-memory apps created by create_app")
+    return parser.parse_args(argv)
+
+# Returns the median of each measure of a list of dictionaries of seconds, in milliseconds
+def medians(runs):
+    return {key: statistics.median(run[key] for run in runs) * 1000 for key in runs[0]}
+
+# Starts runs fresh interpreters and returns the medians of their startup times
+def measure_cold_start(runs):
+    results = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", COLD_START], check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        result['process'] = time.perf_counter() - start
+        results.append(result)
+    return medians(results)
+
+# Returns the median time of a create_app call for an isolated in-memory app, after a first one
+def measure_create_app(apps):
+    from app import create_app
+
+    create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'PRELOAD': False})
+    timings = []
+    for _ in range(apps):
+        start = time.perf_counter()
+        create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'PRELOAD': False})
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+# Returns the shared and private memory of the current process in MB, or None where /proc/self/smaps_rollup is
+# not available
+def memory_usage():
+    try:
+        with open('/proc/self/smaps_rollup') as file:
+            kilobytes = {line.split()[0]: int(line.split()[1]) for line in file if line.split()[0].endswith(':')}
+    except OSError:
+        return None
+    return {
+        'shared_mb': (kilobytes.get('Shared_Clean:', 0) + kilobytes.get('Shared_Dirty:', 0)) / 1024,
+        'private_mb': (kilobytes.get('Private_Clean:', 0) + kilobytes.get('Private_Dirty:', 0)) / 1024
+    }
+
+# Forks a process from app, which serves FIRST_PATHS and reports how long it took, and returns its measures
+def measure_fork(app):
+    read_end, write_end = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        result = {}
+        try:
+            client = app.test_client()
+            client.get(FIRST_PATHS[0])
+            result['first_request'] = time.perf_counter() - start
+            for path in FIRST_PATHS[1:]:
+                client.get(path)
+            result['all_requests'] = time.perf_counter() - start
+            result['memory'] = memory_usage()
+        finally:
+            os.write(write_end, json.dumps(result).encode())
+            os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as pipe:
+        output = pipe.read()
+    os.waitpid(pid, 0)
+    return json.loads(output)
+
+# Creates an app with or without preload and returns the time preload took and the medians of runs forks of it
+def measure_forks(preload, runs):
+    from app import create_app
+
+    start = time.perf_counter()
+    app = create_app({'PRELOAD': preload})
+    created = time.perf_counter() - start
+    results = [measure_fork(app) for _ in range(runs)]
+    timings = medians([{key: result[key] for key in ('first_request', 'all_requests')} for result in results])
+    timings['create_app'] = created * 1000
+    return timings, results[-1]['memory']
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    cold = measure_cold_start(args.runs)
+    print(f"Cold start (median of {args.runs}): import {cold['import']:.0f}ms, create_app {cold['create_app']:.0f}ms, "
+          f"first request {cold['first_request']:.0f}ms, whole process {cold['process']:.0f}ms")
+    print(f"create_app of an in-memory app (median of {args.apps}): {measure_create_app(args.apps):.2f}ms")
+
+    if not hasattr(os, 'fork'):
+        print("Forked workers are not measured, as os.fork is not available")
+        return 0
+    # Without preload first, since preload freezes the garbage collector of this process
+    print(f"{'workers':<12}" + ''.join(f"{column:>16}" for column in
+                                       ('create_app_ms', 'first_req_ms', 'all_reqs_ms', 'shared_mb', 'private_mb')))
+    for name, preload in (('plain', False), ('preload', True)):
+        timings, memory = measure_forks(preload, args.runs)
+        values = [timings['create_app'], timings['first_request'], timings['all_requests']]
+        columns = ''.join(f"{value:>16.1f}" for value in values)
+        if memory is not None:
+            columns += f"{memory['shared_mb']:>16.1f}{memory['private_mb']:>16.1f}"
+        print(f"{name:<12}{columns}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,19 @@
+import argparse
 import json
-import os
+import sys
+import time
 
-from app import app, db, DB_FILE
+from sqlalchemy import inspect
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import create_app
+from database import db
 
 from models import *
+from search import rebuild_search_index
+from tag_stats import rebuild_tag_stats
+from activity import rebuild_club_activity
+from database import remove_sqlite_files
 
 def create_user():
     josh = User(name="Josh", email="josh@upenn.edu", graduation_year="2028",schools=
@@ -13,43 +23,190 @@ def create_user():
     db.session.add(josh)
     db.session.commit()
 
-def load_data():
+# Yields each record of a JSON file containing either one JSON array of records or one record per line (JSON Lines),
+# reading the file read_size characters at a time so large files never have to fit in memory.
+# A record that does not parse is retried with more of the file, reading as much again as the record's buffer
+# holds, so a record spanning many reads is decoded a logarithmic number of times. Raises json.JSONDecodeError at
+# the end of the file, or once the record would be longer than max_record_size characters, so a malformed record
+# is not retried until the whole rest of the file is in memory.
+def iter_json_records(json_file, read_size=1 << 16, max_record_size=1 << 24):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    in_array = None
+    while True:
+        # Skip whitespace between records, and the commas between elements of an array
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position == len(buffer):
+            buffer = json_file.read(read_size)
+            position = 0
+            if not buffer:
+                return
+            continue
+
+        if in_array is None:
+            in_array = buffer[position] == "["
+            if in_array:
+                position += 1
+                continue
+        if in_array and buffer[position] == "]":
+            return
+
+        try:
+            record, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The record may continue past the end of the buffer, so read more and retry
+            buffer = buffer[position:]
+            position = 0
+            if len(buffer) >= max_record_size:
+                raise json.JSONDecodeError(f"Record longer than {max_record_size} characters", buffer, 0)
+            more = json_file.read(min(max(read_size, len(buffer)), max_record_size - len(buffer)))
+            if not more:
+                raise
+            buffer += more
+            continue
+        yield record
+
+# Yields lists of up to size items from an iterable
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Inserts or updates a chunk of clubs and their tags using a fixed number of executemany statements.
+# Clubs are upserted on their unique code and tags on their unique name, so loading the same file twice is safe.
+# A club's tags are replaced by the tags listed for it in the file.
+# Club names are unique too, so records whose name is already used by a club with another code (in the database
+# or earlier in the chunk) are skipped instead of failing the whole load. Returns the list of skipped records.
+def upsert_clubs(clubs):
+    # Later records for the same code win, as they would if the records were loaded one by one
+    clubs = list({club['code']: club for club in clubs}.values())
+
+    name_codes = dict(db.session.query(Club.name, Club.code).filter(Club.name.in_([club['name'] for club in clubs])))
+    kept, skipped = [], []
+    for club in clubs:
+        if name_codes.setdefault(club['name'], club['code']) == club['code']:
+            kept.append(club)
+        else:
+            skipped.append(club)
+    clubs = kept
+    if not clubs:
+        return skipped
+
+    club_insert = sqlite_insert(Club.__table__)
+    db.session.execute(
+        club_insert.on_conflict_do_update(
+            index_elements=[Club.code],
+            set_={
+                'name': club_insert.excluded.name,
+                'description': club_insert.excluded.description,
+                'version': Club.version + 1
+            }
+        ),
+        [{'code': club['code'], 'name': club['name'], 'description': club.get('description') or ""} for club in clubs]
+    )
+    club_ids = dict(db.session.query(Club.code, Club.id).filter(Club.code.in_([club['code'] for club in clubs])))
+
+    # Tags are created in the order they first appear in the file
+    tag_names = list(dict.fromkeys(tag for club in clubs for tag in club.get('tags', [])))
+    tag_ids = {}
+    if tag_names:
+        db.session.execute(
+            sqlite_insert(Tag.__table__).on_conflict_do_nothing(index_elements=[Tag.name]),
+            [{'name': name} for name in tag_names]
+        )
+        tag_ids = dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(tag_names)))
+
+    db.session.execute(club_tags.delete().where(club_tags.c.club_id.in_(club_ids.values())))
+    links = dict.fromkeys((club_ids[club['code']], tag_ids[tag]) for club in clubs for tag in club.get('tags', []))
+    if links:
+        db.session.execute(club_tags.insert(), [{'club_id': club_id, 'tag_id': tag_id} for club_id, tag_id in links])
+    return skipped
+
+# Loads clubs from a JSON array or JSON Lines file into the database in chunks of chunk_size clubs,
+# committing after every chunk and reporting progress, and the records skipped because of a name conflict, through
+# the report function.
+# Returns the number of club records read.
+def bulk_load_clubs(path, chunk_size=1000, report=print):
+    start = time.perf_counter()
+    loaded = 0
+    with open(path, 'r') as club_file:
+        for chunk in chunked(iter_json_records(club_file), chunk_size):
+            for club in upsert_clubs(chunk):
+                report(f"Skipped club {club['code']}: another club is already named {club['name']!r}")
+            db.session.commit()
+            loaded += len(chunk)
+            elapsed = time.perf_counter() - start
+            report(f"Loaded {loaded} clubs ({loaded / elapsed:.0f} clubs/s)")
+
+    rebuild_search_index()
+    db.session.commit()
+    return loaded
+
+# Returns the differences between the existing tables of the database and the models, as a list of messages.
+# db.create_all() only creates missing tables, and SQLite cannot add foreign key actions to an existing table, so
+# a database with an older schema (e.g. without the version columns, the created_at columns of club_members and
+# club_favorites, or the ON DELETE actions) has to be recreated rather than appended to.
+def schema_differences():
+    inspector = inspect(db.engine)
+    existing = set(inspector.get_table_names())
+    differences = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        differences.extend(f"{table.name}.{column.name} is missing" for column in table.columns
+                           if column.name not in columns)
+        actions = {(tuple(fk['constrained_columns']), fk['options'].get('ondelete'))
+                   for fk in inspector.get_foreign_keys(table.name)}
+        for column in table.columns:
+            for fk in column.foreign_keys:
+                if fk.ondelete is not None and ((column.name,), fk.ondelete) not in actions:
+                    differences.append(f"{table.name}.{column.name} has no ON DELETE {fk.ondelete}")
+    return differences
+
+def load_data(path='clubs.json', chunk_size=1000):
     try:
-        with open('clubs.json', 'r') as club_file:
-            club_data = json.load(club_file)
+        bulk_load_clubs(path, chunk_size)
     except FileNotFoundError:
-        print("clubs.json not found.");
-        return;
+        print(f"{path} not found.")
     except json.JSONDecodeError:
-        print("Invalid JSON format in clubs.json.");
-        return;
-    # Creates new clubs with the given parameters read from clubs.json.
-    # For tags, checks if tag already exists in database otherwise creates a new one
-    tags_list = {} 
-    for club in club_data:
-        new_club = Club(
-            code=club['code'], 
-            name=club['name'], 
-            description=club['description'], 
-            tags=[])
-        for tag in club['tags']:
-            if tag in tags_list:
-                new_club.tags.append(tags_list[tag])
-            else:
-                new_tag = Tag(name=tag)
-                tags_list[tag] = new_tag
-                new_club.tags.append(new_tag)
-        db.session.add(new_club)
-    db.session.commit()
+        print(f"Invalid JSON format in {path}.")
 
 # No need to modify the below code.
 if __name__ == "__main__":
-    # Delete any existing database before bootstrapping a new one.
-    LOCAL_DB_FILE = "instance/" + DB_FILE
-    if os.path.exists(LOCAL_DB_FILE):
-        os.remove(LOCAL_DB_FILE)
+    parser = argparse.ArgumentParser(description="Create and populate the club review database.")
+    parser.add_argument("--file", default="clubs.json", help="JSON array or JSON Lines file of clubs to load")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="number of clubs inserted per batch")
+    parser.add_argument("--append", action="store_true",
+                        help="load into the existing database instead of recreating it")
+    args = parser.parse_args()
 
+    app = create_app()
     with app.app_context():
+        # Delete any existing database before bootstrapping a new one.
+        if not args.append and db.engine.url.get_backend_name() == 'sqlite' and db.engine.url.database:
+            db.engine.dispose()
+            remove_sqlite_files(db.engine.url.database)
+        if args.append:
+            differences = schema_differences()
+            if differences:
+                print("The database was created with an older schema and has to be recreated with "
+                      "`python3 bootstrap.py` (without --append):\n  " + "\n  ".join(differences))
+                sys.exit(1)
         db.create_all()
-        create_user()
-        load_data()
+        if not args.append:
+            create_user()
+        else:
+            # Fills in tag_stats and club_activity for databases created before they existed, since the triggers
+            # only apply changes
+            rebuild_tag_stats()
+            rebuild_club_activity()
+            db.session.commit()
+        load_data(args.file, args.chunk_size)
@@ -0,0 +1,291 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, request, make_response, current_app
+from sqlalchemy import event, inspect
+
+from database import db
+
+from models import *
+from streaming import get_stream_format
+
+# Read-through cache of serialized GET responses.
+# Views wrapped with @cached_response store their response bytes under the request's path and query string,
+# along with the rows they were built from, declared through cache_depends_on(table, id). A dependency with
+# id None stands for the whole table, such as a listing of every tag.
+# Writes are tracked on the database session and the dependent responses are evicted once the write commits:
+#   - ORM changes evict the responses depending on the changed rows (and on their whole table).
+#   - Core INSERT/UPDATE/DELETE statements run through the session, whose rows are unknown, evict every
+#     response depending on the affected tables, unless the statement names the rows it changes with the
+#     cache_changes execution option, a list of (table, id) pairs.
+# The storage is pluggable: any CacheBackend can be set as RESPONSE_CACHE_BACKEND in the app config.
+# Evictions only happen in the process that committed the write. With the default in-process LRUCache, other
+# worker processes (e.g. gunicorn workers, see preload_app in app.py) keep serving their cached bodies and ETags,
+# and answering If-None-Match with 304s from them, until RESPONSE_CACHE_TTL expires. Deployments with several
+# workers should disable the cache or plug in a backend shared by the workers.
+
+# Tables whose cached responses are affected by a Core statement on a given table
+TABLE_DEPENDENCIES = {
+    'club': ('club', 'tag'),
+    'tag': ('tag',),
+    'club_tags': ('club', 'tag'),
+    'club_members': ('club',),
+    'club_favorites': ('club',),
+    'comment': ('club',),
+    'school': ('school',),
+    'major': ('major',)
+}
+
+# Response headers that are stored with the cached body
+CACHED_HEADERS = ('Content-Type', 'X-Next-Cursor', 'ETag')
+
+# Interface for response cache storage. Values are opaque to the backend.
+# dependencies is a set of (table, id) pairs, where an id of None stands for the whole table.
+# A backend missing one of these methods raises a TypeError when it is created.
+class CacheBackend(ABC):
+    # Returns the value stored under key, or None if missing or expired
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    # Stores value under key along with the (table, id) pairs it was built from
+    @abstractmethod
+    def set(self, key, value, dependencies):
+        pass
+
+    # Evicts every entry depending on one of the given (table, id) pairs, or on the whole table of one of them
+    @abstractmethod
+    def invalidate(self, dependencies):
+        pass
+
+    # Evicts every entry depending on any row of the given tables
+    @abstractmethod
+    def invalidate_tables(self, tables):
+        pass
+
+    # Evicts every entry
+    @abstractmethod
+    def clear(self):
+        pass
+
+    # Returns a dictionary of counters such as hits, misses and evictions
+    @abstractmethod
+    def stats(self):
+        pass
+
+# In-process cache keeping at most max_entries entries, each for at most ttl seconds,
+# evicting the least recently used entry when full
+class LRUCache(CacheBackend):
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # table -> id -> keys of the entries depending on that row (or on the whole table for id None)
+        self.dependents = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                self._remove(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, dependencies):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, time.monotonic() + self.ttl, frozenset(dependencies))
+            for table, row_id in dependencies:
+                self.dependents.setdefault(table, {}).setdefault(row_id, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, dependencies):
+        with self.lock:
+            keys = set()
+            for table, row_id in dependencies:
+                rows = self.dependents.get(table, {})
+                keys.update(rows.get(row_id, ()))
+                keys.update(rows.get(None, ()))
+            self._invalidate_keys(keys)
+
+    def invalidate_tables(self, tables):
+        with self.lock:
+            keys = set()
+            for table in tables:
+                for row_keys in self.dependents.get(table, {}).values():
+                    keys.update(row_keys)
+            self._invalidate_keys(keys)
+
+    def clear(self):
+        with self.lock:
+            self._invalidate_keys(list(self.entries))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+    # Removes the given keys because the data they were built from changed. Must hold the lock.
+    def _invalidate_keys(self, keys):
+        for key in keys:
+            if key in self.entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    # Removes an entry and its dependency index entries. Must hold the lock.
+    def _remove(self, key):
+        _, _, dependencies = self.entries.pop(key)
+        for table, row_id in dependencies:
+            rows = self.dependents[table]
+            rows[row_id].discard(key)
+            if not rows[row_id]:
+                del rows[row_id]
+
+# Number of commits that invalidated cached responses. A response built while this changed is not cached,
+# since it may have read data from before the commit.
+invalidation_generation = 0
+
+# Returns the cache backend of the current app, creating the default in-process LRU cache on first use
+def get_response_cache():
+    backend = current_app.config.get('RESPONSE_CACHE_BACKEND')
+    if backend is None:
+        backend = LRUCache(
+            current_app.config.get('RESPONSE_CACHE_MAX_ENTRIES', 1024),
+            current_app.config.get('RESPONSE_CACHE_TTL', 60)
+        )
+        current_app.config['RESPONSE_CACHE_BACKEND'] = backend
+    return backend
+
+# Declares that the response of the current request was built from the given rows of table,
+# or from the whole table if row_ids is None
+def cache_depends_on(table, row_ids=None):
+    dependencies = g.setdefault('cache_dependencies', set())
+    if row_ids is None:
+        dependencies.add((table, None))
+    else:
+        dependencies.update((table, row_id) for row_id in row_ids)
+
+# Decorator for views whose GET responses are cached. Other methods are passed through.
+# Only successful responses that declared their dependencies through cache_depends_on are stored.
+def cached_response(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # Streamed responses are never cached, and have the same path and query string as paginated ones
+        if (request.method != 'GET' or not current_app.config.get('RESPONSE_CACHE_ENABLED', True)
+                or get_stream_format() is not None):
+            return view(*args, **kwargs)
+
+        cache = get_response_cache()
+        key = request.full_path
+        cached = cache.get(key)
+        if cached is not None:
+            body, status, headers = cached
+            response = current_app.response_class(body, status=status, headers=headers)
+            # Answers If-None-Match with a 304 when the cached response has a matching ETag
+            return response.make_conditional(request)
+
+        generation = invalidation_generation
+        g.cache_dependencies = set()
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200 and g.cache_dependencies and generation == invalidation_generation:
+            headers = [(name, response.headers[name]) for name in CACHED_HEADERS if name in response.headers]
+            cache.set(key, (response.get_data(), response.status_code, headers), g.cache_dependencies)
+        return response
+    return wrapper
+
+# Returns the ids of the clubs added to or removed from a relationship collection in the pending flush.
+# Deleted instances report the whole collection as removed.
+def changed_ids(state, attribute):
+    history = state.attrs[attribute].history
+    return {model.id for model in list(history.added or ()) + list(history.deleted or ()) if model.id is not None}
+
+# Collects the rows changed by an ORM flush, to be evicted from the cache once the transaction commits
+@event.listens_for(db.session, 'after_flush')
+def collect_flushed_changes(session, flush_context):
+    changes = session.info.setdefault('cache_changes', set())
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        state = inspect(instance)
+        if isinstance(instance, Club):
+            changes.add(('club', instance.id))
+            tags = changed_ids(state, 'tags')
+            if instance in session.new:
+                tags.update(tag.id for tag in instance.tags)
+            changes.update(('tag', tag_id) for tag_id in tags)
+            # A deleted club's tags are removed by the database without being loaded, so every tag is evicted
+            if instance in session.deleted:
+                session.info.setdefault('cache_tables', set()).add('tag')
+        elif isinstance(instance, Tag):
+            changes.add(('tag', instance.id))
+        elif isinstance(instance, User):
+            # A deleted user's clubs are evicted through the bump_versions call of the user DELETE handler
+            for attribute in ('clubs', 'favorites'):
+                changes.update(('club', club_id) for club_id in changed_ids(state, attribute))
+        elif isinstance(instance, Comment):
+            changes.add(('club', instance.club_id))
+        elif isinstance(instance, School):
+            changes.add(('school', instance.id))
+        elif isinstance(instance, Major):
+            changes.add(('major', instance.id))
+
+# Collects the rows or tables written to by Core statements run through the session
+@event.listens_for(db.session, 'do_orm_execute')
+def collect_statement_changes(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    changes = orm_execute_state.execution_options.get('cache_changes')
+    if changes is not None:
+        orm_execute_state.session.info.setdefault('cache_changes', set()).update(changes)
+        return
+    table = getattr(orm_execute_state.statement, 'table', None)
+    tables = TABLE_DEPENDENCIES.get(getattr(table, 'name', None), ())
+    orm_execute_state.session.info.setdefault('cache_tables', set()).update(tables)
+
+# Evicts the responses depending on the committed changes
+# SQLAlchemy also dispatches after_commit when a savepoint is released (e.g. by group_commit.py), which is ignored
+# until the outermost transaction commits.
+@event.listens_for(db.session, 'after_commit')
+def invalidate_committed_changes(session):
+    global invalidation_generation
+    if session.in_nested_transaction():
+        return
+    changes = session.info.pop('cache_changes', set())
+    tables = session.info.pop('cache_tables', set())
+    if not (changes or tables):
+        return
+
+    invalidation_generation += 1
+    cache = get_response_cache()
+    if changes:
+        cache.invalidate(changes)
+    if tables:
+        cache.invalidate_tables(tables)
+
+# Discards the changes of a rolled back transaction
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_rolled_back_changes(session, previous_transaction):
+    session.info.pop('cache_changes', None)
+    session.info.pop('cache_tables', None)
@@ -0,0 +1,127 @@
+import os
+
+from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# Database connection settings.
+# The database URI and tuning profile are read from the environment so the same code can run against a plain
+# development database or a tuned production one:
+#   - DATABASE_URL: SQLAlchemy database URI (defaults to the SQLite file clubreview.db in the instance folder).
+#   - DB_PROFILE: name of one of the SQLITE_PROFILES below (defaults to 'dev').
+#   - DB_POOL_SIZE / DB_MAX_OVERFLOW: connection pool sizing for file or server databases.
+#   - READ_DATABASE_URL: optional URI of a read-only database or replica that read requests are routed to
+#     (see routing.py). The value 'readonly' opens the primary SQLite file a second time in read-only mode.
+# The pragmas of the profile are run on every new SQLite connection through the engine's connect event.
+# db is created here without an app, and bound to each app made by create_app (app.py) with db.init_app, so
+# models and the other modules import it from this module rather than from app.py.
+
+DEFAULT_DB_FILE = "clubreview.db"
+
+# Bind key of the read-only engine
+READ_BIND_KEY = 'read'
+
+# Pragmas run on every new SQLite connection for each profile
+SQLITE_PROFILES = {
+    # Default SQLite settings, only waiting on locks instead of failing right away. Foreign keys are enforced in
+    # every profile, since deletes rely on their ON DELETE actions (see models.py).
+    'dev': {
+        'foreign_keys': 'ON',
+        'busy_timeout': 5000
+    },
+    # WAL lets readers run alongside a writer, and synchronous=NORMAL only syncs on checkpoints, which is safe
+    # in WAL mode. Reads are served from a memory map and a 64MB page cache, and temporary tables stay in memory.
+    'prod': {
+        'foreign_keys': 'ON',
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY'
+    }
+}
+
+# Connection pool sizing for each profile
+POOL_SIZES = {
+    'dev': {'pool_size': 5, 'max_overflow': 10},
+    'prod': {'pool_size': 10, 'max_overflow': 20}
+}
+
+# Returns the database URI from the environment
+def get_database_uri(environ=os.environ):
+    return environ.get('DATABASE_URL', f"sqlite:///{DEFAULT_DB_FILE}")
+
+# Returns the name of the tuning profile from the environment. Aborts if the profile does not exist.
+def get_db_profile(environ=os.environ):
+    profile = environ.get('DB_PROFILE', 'dev')
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE {profile!r}, expected one of {', '.join(SQLITE_PROFILES)}")
+    return profile
+
+# Returns the URI of the read-only database from the environment, or None if reads are not routed
+def get_read_database_uri(uri, environ=os.environ):
+    read_uri = environ.get('READ_DATABASE_URL')
+    if read_uri == 'readonly':
+        return read_only_uri(uri)
+    return read_uri
+
+# Returns a URI opening the same SQLite database file as uri in read-only mode
+def read_only_uri(uri):
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite' or is_memory_database(uri):
+        raise ValueError("Only SQLite database files can be opened read-only")
+    return url.set(database=f"file:{url.database}", query={'mode': 'ro', 'uri': 'true'}).render_as_string()
+
+# Returns True if uri is an in-memory SQLite database, which lives in a single connection and cannot be pooled
+def is_memory_database(uri):
+    url = make_url(uri)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+# Returns the SQLALCHEMY_ENGINE_OPTIONS for a database uri and profile
+def get_engine_options(uri, profile, environ=os.environ):
+    if is_memory_database(uri):
+        return {}
+    sizes = POOL_SIZES[profile]
+    return {
+        'pool_size': int(environ.get('DB_POOL_SIZE', sizes['pool_size'])),
+        'max_overflow': int(environ.get('DB_MAX_OVERFLOW', sizes['max_overflow'])),
+        'pool_pre_ping': profile == 'prod'
+    }
+
+# Runs the pragmas of a profile on every new connection of a SQLite engine.
+# Read-only connections cannot change the journal mode and are set to reject writes.
+def apply_sqlite_pragmas(engine, profile, read_only=False):
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = dict(SQLITE_PROFILES[profile])
+    if read_only:
+        pragmas.pop('journal_mode', None)
+        pragmas['query_only'] = 1
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+# Deletes a SQLite database file along with its WAL and shared memory files
+def remove_sqlite_files(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+# Session that runs its statements on the read-only engine while info['read_only'] is set.
+# Flushes and INSERT/UPDATE/DELETE statements always go to the primary database.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and self.info.get('read_only') and READ_BIND_KEY in self._db.engines
+                and not self._flushing and not getattr(clause, 'is_dml', False)):
+            return self._db.engines[READ_BIND_KEY]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+# Flask-SQLAlchemy extension shared by every app. Its scoped session exists before any app, so the session event
+# listeners of the other modules are registered on import.
+db = SQLAlchemy(session_options={'class_': RoutingSession})
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.util.concurrency import await_only, in_greenlet
+
+from database import db
+
+# Group commit of high-frequency writes.
+# Joining, favoriting and posting or editing comments each used to commit their own transaction. On SQLite every
+# commit takes the database's single write lock and syncs the journal to disk, which caps the number of these
+# requests served per second no matter how many threads serve them.
+# With the GROUP_COMMIT_ENABLED app config (default False), these writes are instead queued to one writer thread
+# per process, which applies them in batches: it waits up to GROUP_COMMIT_INTERVAL seconds (default 0.002) or
+# until GROUP_COMMIT_MAX_BATCH writes (default 100) are queued, runs each write in its own savepoint and commits
+# the batch once. Each request waits for the commit of its batch before responding, so a response is only sent
+# once its write is durable, as before.
+#   - A write that raises only rolls back its own savepoint, and its exception is raised again in the request's
+#     thread, so the request fails the same way it would have on its own (e.g. a StaleDataError is still a 409).
+#     The changes collected by the session events are only applied (cache evictions, recommendation index updates)
+#     once the whole batch commits, not when each savepoint is released.
+#   - If the batch's commit fails, its writes are run again with one commit each, so only the writes that fail on
+#     their own report an error.
+#   - Checks that only read the database run in the request's thread before the write is queued, so the writer
+#     thread only spends its time on writes.
+# Writes are functions taking plain arguments that run on db.session without committing it, and return plain data
+# (such as an id) rather than model instances, since the writer's session is not the request's one.
+# Under the ASGI app (asgi.py) a request waits for its batch on the event loop instead of blocking it, so other
+# requests keep being served meanwhile. The writer thread commits through the app's synchronous engine.
+
+# Guards the creation of the writer thread
+writer_lock = threading.Lock()
+
+# Returns the writer thread of the current app, starting it on first use. A process forked from the one that
+# started it (e.g. a preforked worker, see preload_app in app.py) starts its own, as threads do not survive a fork.
+def get_group_commit_writer():
+    with writer_lock:
+        writer = current_app.config.get('GROUP_COMMIT_WRITER')
+        if writer is None or writer.pid != os.getpid():
+            writer = GroupCommitWriter(
+                current_app._get_current_object(),
+                current_app.config.get('GROUP_COMMIT_INTERVAL', 0.002),
+                current_app.config.get('GROUP_COMMIT_MAX_BATCH', 100)
+            )
+            current_app.config['GROUP_COMMIT_WRITER'] = writer
+        return writer
+
+# Runs operation(*args) and commits it, either right away on the request's session or as part of a group commit.
+# Returns what operation returned, or raises what it raised.
+def run_write(operation, *args):
+    if not current_app.config.get('GROUP_COMMIT_ENABLED', False):
+        result = operation(*args)
+        db.session.commit()
+        return result
+
+    # Ends the request's own transaction first, which gives its connection back to the pool while it waits (the
+    # writer could otherwise be left without one) and expires the instances it loaded, so its next reads see the
+    # batch
+    db.session.commit()
+    future = get_group_commit_writer().submit(operation, args)
+    # The write may still be committed after a timeout, as it cannot be taken back from its batch
+    timeout = current_app.config.get('GROUP_COMMIT_TIMEOUT', 30)
+    if in_greenlet():
+        # Dispatched by asgi.py inside AsyncSession.run_sync: awaits the future on the event loop. It is shielded
+        # so a timeout does not cancel it, which would fail the writer when it resolves it.
+        result, wrote = await_only(asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout))
+    else:
+        result, wrote = future.result(timeout=timeout)
+    if wrote:
+        # Same as a commit on the request's session, so read routing sends the client's next reads to the primary
+        db.session.info['committed_write'] = True
+    return result
+
+# A queued write and the future resolved once its batch commits
+class QueuedWrite:
+    def __init__(self, operation, args):
+        self.operation = operation
+        self.args = args
+        self.future = Future()
+
+# Thread applying queued writes in batched transactions
+class GroupCommitWriter:
+    def __init__(self, app, interval, max_batch):
+        self.app = app
+        self.interval = interval
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.writes = 0
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, name='group-commit-writer', daemon=True)
+        self.thread.start()
+
+    # Queues a write. Returns a future resolved with a (result, wrote) tuple once the write commits, where wrote
+    # is True if the write changed any row.
+    def submit(self, operation, args):
+        write = QueuedWrite(operation, args)
+        self.queue.put(write)
+        return write.future
+
+    def run(self):
+        # The writer has its own app context, and so its own session
+        with self.app.app_context():
+            while True:
+                batch = self.next_batch()
+                try:
+                    self.apply_batch(batch)
+                except Exception as error:
+                    # e.g. the rollback of a failed batch failing, in which case the writes' outcome is unknown
+                    self.app.logger.exception("Group commit failed")
+                    for write in batch:
+                        if not write.future.done():
+                            write.future.set_exception(error)
+
+    # Waits for a write, then collects the writes queued within the interval, up to max_batch of them
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.max_batch:
+            try:
+                timeout = deadline - time.monotonic()
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    # Runs the writes of a batch in one transaction and resolves their futures once it commits. If the commit
+    # fails, each write of the batch is run again in a transaction of its own.
+    def apply_batch(self, batch):
+        try:
+            self.begin()
+            outcomes = [self.apply(write) for write in batch]
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            if len(batch) > 1:
+                for write in batch:
+                    self.apply_batch([write])
+                return
+            outcomes = [error]
+        finally:
+            db.session.remove()
+
+        self.batches += 1
+        self.writes += len(batch)
+        for write, outcome in zip(batch, outcomes):
+            if isinstance(outcome, Exception):
+                write.future.set_exception(outcome)
+            else:
+                write.future.set_result(outcome)
+
+    # Starts the batch's transaction. SQLite takes the write lock now instead of at the first write, and the
+    # explicit BEGIN keeps the driver from committing when the first savepoint is released.
+    def begin(self):
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(text('BEGIN IMMEDIATE'))
+
+    # Runs one write in a savepoint. Returns its (result, wrote) tuple, or the exception it raised.
+    def apply(self, write):
+        # Every write starts from an empty identity map, as it would in a request of its own
+        db.session.expunge_all()
+        # Changes collected by the session events of cache.py, recommendations.py and routing.py. Rolling back a
+        # savepoint discards all of them, so the ones of the earlier writes are put back.
+        info = {key: value.copy() if hasattr(value, 'copy') else value for key, value in db.session.info.items()}
+        db.session.info.pop('pending_write', None)
+        try:
+            with db.session.begin_nested():
+                result = write.operation(*write.args)
+        except Exception as error:
+            db.session.info.clear()
+            db.session.info.update(info)
+            return error
+        return result, db.session.info.get('pending_write', False)
+
+# Returns the number of batches committed and writes applied by the writer, or None if it has not started
+def group_commit_stats():
+    writer = current_app.config.get('GROUP_COMMIT_WRITER')
+    if writer is None:
+        return None
+    return {'batches': writer.batches, 'writes': writer.writes}
@@ -0,0 +1,63 @@
+import os
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Pluggable JSON encoding of responses.
+# Every jsonify call, streamed response and cached response body is encoded by the app's JSON provider, which is
+# picked with the JSON_PROVIDER environment variable:
+#   - `auto` (default): orjson if it is installed (`pip install orjson`), otherwise the standard library.
+#   - `orjson`: orjson, failing at startup if it is not installed.
+#   - `stdlib`: Flask's default provider built on the json module.
+# Both providers sort keys and return the same data. orjson writes non-ASCII characters as UTF-8 instead of
+# \u escapes, and always writes compact JSON unless the response is pretty printed.
+
+JSON_PROVIDERS = ('auto', 'orjson', 'stdlib')
+
+# JSON provider encoding with orjson. Values orjson does not support natively are passed to Flask's default
+# conversions (dates as HTTP dates, decimals, UUIDs, dataclasses and objects with __html__).
+class OrjsonProvider(DefaultJSONProvider):
+    # Returns the orjson options matching the provider's settings
+    def options(self, indent=False):
+        # Dates are passed to Flask's conversion so both providers format them the same way
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    # Returns obj encoded as bytes
+    def dumpb(self, obj, indent=False, newline=False):
+        options = self.options(indent)
+        if newline:
+            options |= orjson.OPT_APPEND_NEWLINE
+        return orjson.dumps(obj, default=self.default, option=options)
+
+    # Encodes obj as a str. Only `indent` is used from kwargs, as orjson output is otherwise always compact.
+    def dumps(self, obj, **kwargs):
+        return self.dumpb(obj, bool(kwargs.get('indent'))).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    # Same as DefaultJSONProvider.response, without decoding the encoded bytes to a str and back
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(self.dumpb(obj, indent, newline=True), mimetype=self.mimetype)
+
+# Returns the JSON provider class named by the JSON_PROVIDER environment variable
+def get_json_provider_class(environ=os.environ):
+    name = environ.get('JSON_PROVIDER', 'auto')
+    if name not in JSON_PROVIDERS:
+        raise ValueError(f"Unknown JSON_PROVIDER {name!r}, expected one of {', '.join(JSON_PROVIDERS)}")
+    if name == 'orjson' and orjson is None:
+        raise ValueError("JSON_PROVIDER=orjson requires the orjson package")
+    if name == 'stdlib' or orjson is None:
+        return DefaultJSONProvider
+    return OrjsonProvider
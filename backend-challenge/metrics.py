@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import current_app, g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Per-request performance instrumentation.
+# Every request records the number of SQL statements it ran, the time spent in them, the time spent serializing
+# models to json (functions wrapped with @timed_serialization, not counting the SQL they run) and its total
+# latency. These are sent back in a Server-Timing header and aggregated into per-route histograms, which are
+# served in the Prometheus text format by /api/_metrics.
+# Requests running more statements than the QUERY_BUDGET app config (default 25) are logged as warnings along with
+# their most repeated statement, which is usually an N+1 query.
+
+# Upper bounds of the histogram buckets for durations in seconds and for statement counts
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250)
+
+# Name, help text and buckets of each histogram kept per route
+HISTOGRAMS = (
+    ('http_request_duration_seconds', 'Total request latency', DURATION_BUCKETS),
+    ('http_request_db_seconds', 'Time spent running SQL statements', DURATION_BUCKETS),
+    ('http_request_serialize_seconds', 'Time spent serializing models to json', DURATION_BUCKETS),
+    ('http_request_queries', 'Number of SQL statements run', QUERY_COUNT_BUCKETS)
+)
+
+# Prometheus style histogram, keeping cumulative counts per bucket upper bound along with the sum and count
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    # Returns (le, cumulative count) pairs, ending with the +Inf bucket
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+# Histograms of every route, keyed by (histogram name, method, route)
+histograms = {}
+histograms_lock = threading.Lock()
+
+# Measures of the current request, or None outside of requests
+def current_metrics():
+    if not has_request_context():
+        return None
+    return g.get('request_metrics')
+
+# Decorator for functions serializing models to json. Their time is added to the request's serialization time,
+# minus the time spent on SQL statements they run. Nested calls are only counted once.
+def timed_serialization(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        metrics = current_metrics()
+        if metrics is None or metrics['serializing']:
+            return function(*args, **kwargs)
+
+        metrics['serializing'] = True
+        start, db_start = time.perf_counter(), metrics['db_time']
+        try:
+            return function(*args, **kwargs)
+        finally:
+            metrics['serializing'] = False
+            metrics['serialize_time'] += time.perf_counter() - start - (metrics['db_time'] - db_start)
+    return wrapper
+
+# Registers the measurement of requests on an app
+def init_metrics(app):
+    app.before_request(start_request_metrics)
+    app.after_request(record_request_metrics)
+
+# Forgets every request recorded so far, e.g. the warmup requests of preload_app (app.py)
+def reset_histograms():
+    with histograms_lock:
+        histograms.clear()
+
+# Starts measuring a request
+def start_request_metrics():
+    g.request_metrics = {
+        'start': time.perf_counter(),
+        'queries': 0,
+        'db_time': 0,
+        'serialize_time': 0,
+        'serializing': False,
+        'statements': Counter()
+    }
+
+# Times SQL statements run by any engine during a request
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    if current_metrics() is not None:
+        conn.info['statement_start'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    metrics = current_metrics()
+    start = conn.info.pop('statement_start', None)
+    if metrics is None or start is None:
+        return
+    metrics['db_time'] += time.perf_counter() - start
+    metrics['queries'] += 1
+    metrics['statements'][statement] += 1
+
+# Adds the Server-Timing header, records the request in its route's histograms and logs requests over budget
+def record_request_metrics(response):
+    metrics = g.pop('request_metrics', None)
+    if metrics is None:
+        return response
+    total = time.perf_counter() - metrics['start']
+
+    response.headers['Server-Timing'] = ', '.join((
+        f'db;dur={metrics["db_time"] * 1000:.2f};desc="{metrics["queries"]} queries"',
+        f'serialize;dur={metrics["serialize_time"] * 1000:.2f}',
+        f'total;dur={total * 1000:.2f}'
+    ))
+
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    values = (total, metrics['db_time'], metrics['serialize_time'], metrics['queries'])
+    with histograms_lock:
+        for (name, _, buckets), value in zip(HISTOGRAMS, values):
+            key = (name, request.method, route)
+            if key not in histograms:
+                histograms[key] = Histogram(buckets)
+            histograms[key].observe(value)
+
+    budget = current_app.config.get('QUERY_BUDGET', 25)
+    if metrics['queries'] > budget:
+        statement, repeats = metrics['statements'].most_common(1)[0]
+        current_app.logger.warning(
+            '%s %s ran %d SQL statements (budget %d). Most repeated (%d times): %s',
+            request.method, request.full_path, metrics['queries'], budget, repeats, ' '.join(statement.split())
+        )
+    return response
+
+# Escapes a Prometheus label value
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Returns every route histogram in the Prometheus text exposition format
+def render_metrics():
+    lines = []
+    with histograms_lock:
+        for name, help_text, _ in HISTOGRAMS:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for (histogram_name, method, route), histogram in sorted(histograms.items()):
+                if histogram_name != name:
+                    continue
+                labels = f'method="{escape_label(method)}",route="{escape_label(route)}"'
+                for bound, count in histogram.cumulative():
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+    return '\n'.join(lines) + '\n'
@@ -1,37 +1,62 @@
-from app import db
+from database import db
+from metrics import timed_serialization
 
 # Your database models should go here.
 # Check out the Flask-SQLAlchemy quickstart for some good docs!
 # https://flask-sqlalchemy.palletsprojects.com/en/2.x/quickstart/
 
+# Rows of the association and statistics tables below are deleted by the database along with the rows they
+# reference (ON DELETE CASCADE, enforced by the foreign_keys pragma in database.py). The relationships using them
+# set passive_deletes, so deleting a club, tag, user, school or major does not load its collections first.
+
 # Table for many-to-many relationships to allow for multiple tags to be associated with multiple clubs and vice versa
 club_tags = db.Table('club_tags',
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
-    db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True)
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id', ondelete='CASCADE'), primary_key=True, index=True)
+)
+
+# Table of precomputed statistics for each tag, kept up to date by triggers on tag and club_tags (see tag_stats.py)
+tag_stats = db.Table('tag_stats',
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('club_count', db.Integer, nullable=False, default=0, server_default='0')
 )
 
 # Table for many-to-many relationships to allow for multiple schools to be associated with multiple users for the cases of dual degrees
 users_schools = db.Table('users_schools',
-    db.Column('school_id', db.Integer, db.ForeignKey('school.id'), primary_key=True),
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    db.Column('school_id', db.Integer, db.ForeignKey('school.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
 )
 
 # Table for many-to-many relationships to allow for multiple users to be associated with multiple majors for the cases of dual majors
 users_majors = db.Table('users_majors',
-    db.Column('major_id', db.Integer, db.ForeignKey('major.id'), primary_key=True),
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    db.Column('major_id', db.Integer, db.ForeignKey('major.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
 )
 
 # Table for many-to-many relationships to allow for multiple users to be associated with multiple clubs and vice versa
+# created_at records when the user joined the club
 club_members = db.Table('club_members',
-    db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('created_at', db.DateTime, nullable=False, server_default=db.func.now())
 )
 
 # Table for many-to-many relationships to allow for multiple users to favorite multiple clubs
+# created_at records when the user favorited the club
 club_favorites = db.Table('club_favorites',
-    db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('created_at', db.DateTime, nullable=False, server_default=db.func.now())
+)
+
+# Table of per club, per day (UTC) counts of the joins, favorites and comments made that day that still exist,
+# kept up to date by triggers on club_members, club_favorites and comment (see activity.py)
+club_activity = db.Table('club_activity',
+    db.Column('day', db.Date, primary_key=True),
+    db.Column('club_id', db.Integer, db.ForeignKey('club.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('joins', db.Integer, nullable=False, default=0, server_default='0'),
+    db.Column('favorites', db.Integer, nullable=False, default=0, server_default='0'),
+    db.Column('comments', db.Integer, nullable=False, default=0, server_default='0')
 )
 
 class Club (db.Model):
@@ -41,20 +66,30 @@ class Club (db.Model):
     code = db.Column(db.String(50), unique=True, nullable=False, index=True)
     name = db.Column(db.String(255), nullable=False, index=True, unique=True)
     description = db.Column(db.Text(500), default="")
-    tags = db.relationship('Tag', backref=db.backref('clubs'), secondary=club_tags)
-    comments = db.relationship('Comment', backref=db.backref('club'), cascade="all, delete-orphan")
+    tags = db.relationship('Tag', backref=db.backref('clubs', passive_deletes=True), secondary=club_tags,
+                           passive_deletes=True)
+    # Comments and their replies are deleted by the database along with the club
+    comments = db.relationship('Comment', backref=db.backref('club'), cascade="all, delete-orphan", passive_deletes=True)
+
+    # Incremented whenever the club's json changes, used for ETags and If-Match checks (see versioning.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     # Returns club data in json format for the API
-    def to_json(self):
+    # Takes in the precomputed member/favorite/comment counts from get_club_counts when serializing
+    # many clubs at once, otherwise counts them in the database instead of loading every related row
+    @timed_serialization
+    def to_json(self, counts=None):
+        if counts is None:
+            counts = get_club_counts([self.id])[self.id]
         return {
             'id': self.id,
             'code': self.code,
             'name': self.name,
             'description': self.description,
             'tags': [tag.name for tag in self.tags],
-            'members': len(self.members),
-            'favorites': len(self.favorites),
-            'comments': len(self.comments)
+            'members': counts['members'],
+            'favorites': counts['favorites'],
+            'comments': counts['comments']
         }
     
 class Tag (db.Model):
@@ -65,11 +100,15 @@ class Tag (db.Model):
     name = db.Column(db.String(50), nullable=False, unique=True, index=True)
     
     # Returns tag data in json format for the API
-    def to_json(self):
+    # Takes in a precomputed club count when serializing many tags at once, otherwise reads it from tag_stats
+    @timed_serialization
+    def to_json(self, number_of_clubs=None):
+        if number_of_clubs is None:
+            number_of_clubs = db.session.query(tag_stats.c.club_count).filter(tag_stats.c.tag_id == self.id).scalar() or 0
         return {
             'id': self.id,
             'name': self.name,
-            'number_of_clubs': len(self.clubs)
+            'number_of_clubs': number_of_clubs
         }
     
 class User (db.Model):
@@ -80,12 +119,20 @@ class User (db.Model):
     email = db.Column(db.String(255), unique=True, nullable=False, index=True)
     graduation_year = db.Column(db.Integer, nullable=True)
     
-    schools = db.relationship('School', secondary=users_schools, backref=db.backref('users'))
-    majors = db.relationship('Major', secondary=users_majors, backref=db.backref('users'))
-    clubs = db.relationship('Club', backref=db.backref("members"), secondary=club_members)
-    favorites = db.relationship('Club', backref=db.backref("favorites"), secondary=club_favorites)
+    schools = db.relationship('School', secondary=users_schools, backref=db.backref('users', passive_deletes=True),
+                              passive_deletes=True)
+    majors = db.relationship('Major', secondary=users_majors, backref=db.backref('users', passive_deletes=True),
+                             passive_deletes=True)
+    clubs = db.relationship('Club', backref=db.backref("members", passive_deletes=True), secondary=club_members,
+                            passive_deletes=True)
+    favorites = db.relationship('Club', backref=db.backref("favorites", passive_deletes=True), secondary=club_favorites,
+                                passive_deletes=True)
+
+    # Incremented whenever the user's own data or club lists change (see versioning.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     # Returns non-private user data in json format for the API
+    @timed_serialization
     def to_json(self):
         return {
             "id" : self.id,
@@ -107,6 +154,7 @@ class School (db.Model):
     name = db.Column(db.String(100), nullable=False, index=True)
 
     # Returns school data in json format for the API
+    @timed_serialization
     def to_json(self):
         return {
             'id' : self.id,
@@ -122,6 +170,7 @@ class Major (db.Model):
     name = db.Column(db.String(100), nullable=False, index=True)
     
     # Returns major data in json format for the API
+    @timed_serialization
     def to_json(self):
         return {
             'id' : self.id,
@@ -134,26 +183,62 @@ class Comment (db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text(511), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # Comments outlive their author so replies from other users stay in the thread: deleting a user sets
+    # user_id to NULL, and the comment is returned with `user` null
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True, index=True)
     created_at = db.Column(db.DateTime, server_default=db.func.now(), index=True)
     updated_at = db.Column(db.DateTime, server_default=None, onupdate=db.func.now())
-    club_id = db.Column(db.Integer, db.ForeignKey('club.id'), index=True)
-    parent_id = db.Column(db.Integer, db.ForeignKey('comment.id'), server_default=None, index=True)
+    club_id = db.Column(db.Integer, db.ForeignKey('club.id', ondelete='CASCADE'), index=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('comment.id', ondelete='CASCADE'), server_default=None)
 
-    user = db.relationship('User', backref=db.backref('comments', lazy=True))
+    # Composite indexes so a club's top level comments and a comment's replies can be read in order of creation
+    __table_args__ = (
+        db.Index('ix_comment_club_thread', 'club_id', 'parent_id', 'created_at', 'id'),
+        db.Index('ix_comment_replies', 'parent_id', 'created_at', 'id'),
+    )
+
+    user = db.relationship('User', backref=db.backref('comments', lazy=True, passive_deletes=True))
 
     # One-to-many relationship between Comments to allow for replies
-    replies = db.relationship('Comment', backref=db.backref('parent', remote_side="Comment.id"), cascade="all, delete-orphan")
+    replies = db.relationship('Comment', backref=db.backref('parent', remote_side="Comment.id"), cascade="all, delete-orphan",
+                              passive_deletes=True)
+
+    # Incremented whenever the comment is edited (see versioning.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version, 'version_id_generator': False}
 
     # Returns Comment data in json format for the API
+    # Walks the replies one comment at a time, so use threads.load_threads when serializing existing threads
+    @timed_serialization
     def to_json(self):
         return {
             'id': self.id,
-            'user': {'id': self.user_id, 'name': self.user.name},
+            'user': {'id': self.user_id, 'name': self.user.name} if self.user is not None else None,
             'club_id': self.club_id,
             'parent_id': self.parent_id,
             'body': self.body,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'reply_count': len(self.replies or []),
             'replies': [reply.to_json() for reply in self.replies or []]
-        }
\ No newline at end of file
+        }
+
+# Given a list of club ids, returns a dictionary mapping each id to its number of members, favorites and comments.
+# Uses one COUNT ... GROUP BY query per relationship so the number of queries does not grow with the number of clubs.
+# Takes in an optional subset of the counts ('members', 'favorites', 'comments') to only run those queries.
+def get_club_counts(club_ids, keys=('members', 'favorites', 'comments')):
+    counts = {club_id: {key: 0 for key in keys} for club_id in club_ids}
+    if not counts:
+        return counts
+
+    count_columns = {
+        'members': club_members.c.club_id,
+        'favorites': club_favorites.c.club_id,
+        'comments': Comment.club_id
+    }
+    for key in keys:
+        column = count_columns[key]
+        rows = db.session.query(column, db.func.count()).filter(column.in_(counts.keys())).group_by(column).all()
+        for club_id, count in rows:
+            counts[club_id][key] = count
+    return counts
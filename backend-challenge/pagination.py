@@ -0,0 +1,103 @@
+import base64
+import binascii
+import json
+
+from flask import request, jsonify
+
+from database import db
+
+# Keyset (cursor) pagination and field projection for collection endpoints.
+# Pages are ordered by a tuple of key columns (e.g. (Comment.created_at, Comment.id)) and the cursor is an
+# opaque token encoding the key of the last row of the previous page, so every page is an index range scan
+# instead of an OFFSET that has to skip over all earlier rows.
+# The token for the next page is returned in the X-Next-Cursor response header, and is absent on the last page.
+# Endpoints that returned complete lists before they were paginated still do when neither `limit` nor `cursor`
+# is given, so existing clients do not lose rows without noticing.
+
+# Default and maximum number of items per page
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# Raised when the limit, cursor or fields query parameters are invalid. Returned to the client as a 400.
+class PaginationError(ValueError):
+    pass
+
+# Encodes a list of key values as a url safe cursor token
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+# Decodes a cursor token into a list of key_count key values
+def decode_cursor(token, key_count):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise PaginationError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != key_count:
+        raise PaginationError("Invalid cursor")
+    if not all(value is None or isinstance(value, (int, float, str)) for value in values):
+        raise PaginationError("Invalid cursor")
+    return values
+
+# Reads an integer query parameter of the current request, or returns default if it is missing.
+# Raises a PaginationError if it is not an integer.
+def get_int_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise PaginationError(f"{name} must be an integer")
+
+# Reads the `limit`, `cursor` and `fields` query parameters of the current request.
+# default_limit is the page size used without a `limit`. With None, every row is returned unless a `cursor` is
+# given, in which case pages have DEFAULT_PAGE_SIZE rows.
+# `fields` is a comma separated list which must be a subset of allowed_fields; if missing, all allowed fields are returned.
+# Returns a tuple of (limit or None for every row, cursor token or None, tuple of fields).
+def get_page_args(allowed_fields, default_limit=DEFAULT_PAGE_SIZE):
+    cursor = request.args.get("cursor") or None
+    limit = get_int_arg("limit")
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE if default_limit is None and cursor is not None else default_limit
+    elif limit < 1:
+        raise PaginationError("limit must be a positive integer")
+    if limit is not None:
+        limit = min(limit, MAX_PAGE_SIZE)
+
+    fields = allowed_fields
+    requested = request.args.get("fields")
+    if requested:
+        fields = tuple(field.strip() for field in requested.split(",") if field.strip())
+        unknown = [field for field in fields if field not in allowed_fields]
+        if unknown or not fields:
+            raise PaginationError(f"Unknown fields: {', '.join(unknown)}. Allowed fields: {', '.join(allowed_fields)}")
+    return limit, cursor, fields
+
+# Returns one page of a model query as (ids, next cursor token or None), or every row after the cursor if limit is None.
+# key_columns must uniquely order the rows and end with the model's id column, e.g. (Comment.created_at, Comment.id).
+def paginate_ids(query, key_columns, limit, cursor=None):
+    # Timestamps are compared as the strings SQLite stores, so cursor values round trip exactly
+    raw_columns = [db.type_coerce(column, db.String) if isinstance(column.type, db.DateTime) else column
+                   for column in key_columns]
+    query = query.with_entities(*raw_columns)
+    if cursor is not None:
+        values = decode_cursor(cursor, len(key_columns))
+        query = query.filter(db.tuple_(*raw_columns) > db.tuple_(*[db.literal(value) for value in values]))
+    query = query.order_by(*key_columns)
+    rows = query.all() if limit is None else query.limit(limit + 1).all()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(list(rows[-1]))
+    return [row[-1] for row in rows], next_cursor
+
+# Returns a json response for one page of results, with the next page's cursor in the X-Next-Cursor header
+def paginated_response(data, next_cursor, status=200):
+    response = jsonify(data)
+    response.status_code = status
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return response
@@ -0,0 +1,312 @@
+import heapq
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from operator import itemgetter
+
+from flask import current_app
+from sqlalchemy import event, text
+
+from database import db
+
+from models import *
+
+# Similar clubs and personalized club recommendations.
+# An in-memory index holds two sparse matrices: club x user (a user is linked to a club they joined or favorited)
+# and club x tag, each stored as dictionaries of the non-zero entries by row and by column. From them it
+# precomputes the NEIGHBOR_COUNT most similar clubs of every club, scoring pairs of clubs by the cosine similarity
+# of their users blended with the Jaccard similarity of their tags. Only pairs sharing a user or a tag are
+# scored, found through the column dictionaries, so building it never compares every club with every other one.
+# /api/clubs/<id>/similar reads a club's precomputed neighbors, and /api/users/<id>/recommendations adds up the
+# neighbors of the clubs a user is linked to, so both are dictionary lookups that do not run SQL.
+# Joins, favorites and their removals are applied to the index once their transaction commits: the changed
+# club's neighbors are recomputed and its similarity to the user's other clubs is updated. Committed changes are
+# queued and applied by a background thread, so neither the request that committed them nor the group commit
+# writer (group_commit.py) pays for recomputing neighbors, and the endpoints may not reflect a link for a few
+# milliseconds after it changed. The index's lock is held while a change is applied and while an endpoint reads
+# it. Anything else, such as tag edits, new clubs and changes made by other processes, is picked up when the index is rebuilt from the
+# database, in a background thread, once it is older than the RECOMMENDATIONS_REFRESH_INTERVAL app config in
+# seconds (default 600). The first index is built in the background too, and the endpoints answer 503 until it
+# is ready. Each app has its own index, which preload_app (app.py) builds before workers are forked.
+
+# Number of neighbors kept for every club, which is also the most clubs an endpoint returns
+NEIGHBOR_COUNT = 50
+
+# Number of each of a user's clubs' nearest neighbors considered for their recommendations
+RECOMMENDATION_NEIGHBORS = 20
+
+# Weights of the user cosine similarity and the tag Jaccard similarity in a pair's score
+USER_WEIGHT = 0.8
+TAG_WEIGHT = 0.2
+
+# Bits recording how a user is linked to a club
+MEMBER = 1
+FAVORITE = 2
+LINK_TABLES = {'club_members': MEMBER, 'club_favorites': FAVORITE}
+
+class RecommendationIndex:
+    def __init__(self):
+        # club id -> {user id: MEMBER and/or FAVORITE bits}, and the transpose
+        self.club_users = {}
+        self.user_clubs = {}
+        # club id -> set of tag ids, and the transpose
+        self.club_tags = {}
+        self.tag_clubs = {}
+        # club id -> list of (club id, similarity) pairs, most similar first
+        self.neighbors = {}
+        # Clubs with the most users, recommended to users who have no clubs yet
+        self.popular = []
+        self.built_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Builds an index from club ids, (club id, user id, MEMBER or FAVORITE) links and (club id, tag id) rows
+    @classmethod
+    def from_rows(cls, club_ids, links, tags):
+        index = cls()
+        for club_id in club_ids:
+            index.club_users[club_id] = {}
+            index.club_tags[club_id] = set()
+        for club_id, user_id, bit in links:
+            index.set_link(club_id, user_id, bit, True)
+        for club_id, tag_id in tags:
+            index.club_tags.setdefault(club_id, set()).add(tag_id)
+            index.tag_clubs.setdefault(tag_id, set()).add(club_id)
+        for club_id in index.club_users:
+            index.neighbors[club_id] = index.compute_neighbors(club_id)
+        index.popular = [club_id for club_id, _ in heapq.nlargest(
+            NEIGHBOR_COUNT, ((club_id, len(users)) for club_id, users in index.club_users.items()), key=itemgetter(1))]
+        return index
+
+    # Sets or clears one bit of the link between a club and a user
+    def set_link(self, club_id, user_id, bit, linked):
+        users = self.club_users.setdefault(club_id, {})
+        bits = users.get(user_id, 0)
+        bits = bits | bit if linked else bits & ~bit
+        if bits:
+            users[user_id] = bits
+            self.user_clubs.setdefault(user_id, {})[club_id] = bits
+        else:
+            users.pop(user_id, None)
+            self.user_clubs.get(user_id, {}).pop(club_id, None)
+
+    # Returns the NEIGHBOR_COUNT clubs most similar to a club as (club id, similarity) pairs
+    def compute_neighbors(self, club_id):
+        # Lookups are bound to locals since the comprehensions below run once per pair of clubs sharing a user
+        club_users, club_tags, sqrt = self.club_users, self.club_tags, math.sqrt
+        users = club_users.get(club_id, {})
+        shared_users = Counter()
+        for user_id in users:
+            shared_users.update(self.user_clubs[user_id].keys())
+        weight = USER_WEIGHT / sqrt(len(users) or 1)
+        scores = {other_id: weight * count / sqrt(len(club_users[other_id]))
+                  for other_id, count in shared_users.items()}
+
+        tags = club_tags.get(club_id, ())
+        shared_tags = Counter()
+        for tag_id in tags:
+            shared_tags.update(self.tag_clubs[tag_id])
+        tag_count = len(tags)
+        for other_id, count in shared_tags.items():
+            scores[other_id] = scores.get(other_id, 0) + \
+                TAG_WEIGHT * count / (tag_count + len(club_tags[other_id]) - count)
+
+        scores.pop(club_id, None)
+        return heapq.nlargest(NEIGHBOR_COUNT, scores.items(), key=itemgetter(1))
+
+    # Returns the similarity of two clubs
+    def similarity(self, club_id, other_id):
+        users, other_users = self.club_users.get(club_id, {}), self.club_users.get(other_id, {})
+        score = 0
+        if users and other_users:
+            if len(users) > len(other_users):
+                users, other_users = other_users, users
+            shared = sum(1 for user_id in users if user_id in other_users)
+            score += USER_WEIGHT * shared / math.sqrt(len(users) * len(other_users))
+        tags, other_tags = self.club_tags.get(club_id, set()), self.club_tags.get(other_id, set())
+        if tags and other_tags:
+            shared = len(tags & other_tags)
+            score += TAG_WEIGHT * shared / (len(tags) + len(other_tags) - shared)
+        return score
+
+    # Updates the similarity of other_id in club_id's neighbors
+    def update_neighbor(self, club_id, other_id):
+        score = self.similarity(club_id, other_id)
+        neighbors = [neighbor for neighbor in self.neighbors.get(club_id, ()) if neighbor[0] != other_id]
+        if score > 0:
+            neighbors.append((other_id, score))
+        neighbors.sort(key=itemgetter(1), reverse=True)
+        self.neighbors[club_id] = neighbors[:NEIGHBOR_COUNT]
+
+    # Applies a change committed to the database: ('link', club id, user id, bit, linked), ('club', club id)
+    # for a deleted club or ('user', user id) for a deleted user. Applying a change twice has no further effect.
+    def apply(self, change):
+        with self.lock:
+            if change[0] == 'club':
+                self.remove_club(change[1])
+            elif change[0] == 'user':
+                for club_id in list(self.user_clubs.pop(change[1], {})):
+                    self.club_users.get(club_id, {}).pop(change[1], None)
+            else:
+                _, club_id, user_id, bit, linked = change
+                was_linked = user_id in self.club_users.get(club_id, {})
+                self.set_link(club_id, user_id, bit, linked)
+                if was_linked == (user_id in self.club_users[club_id]):
+                    return
+                # Clubs sharing other users also see their similarity to club_id change slightly, which is left
+                # to the next rebuild
+                self.neighbors[club_id] = self.compute_neighbors(club_id)
+                for other_id in self.user_clubs.get(user_id, ()):
+                    if other_id != club_id:
+                        self.update_neighbor(other_id, club_id)
+
+    def remove_club(self, club_id):
+        for user_id in self.club_users.pop(club_id, {}):
+            self.user_clubs[user_id].pop(club_id, None)
+        for tag_id in self.club_tags.pop(club_id, ()):
+            self.tag_clubs[tag_id].discard(club_id)
+        self.neighbors.pop(club_id, None)
+
+    # Returns up to limit (club id, similarity) pairs of the clubs most similar to club_id
+    def similar(self, club_id, limit):
+        with self.lock:
+            return [neighbor for neighbor in self.neighbors.get(club_id, ())
+                    if neighbor[0] in self.club_users][:limit]
+
+    # Returns up to limit (club id, score) pairs of clubs recommended to user_id, the clubs most similar to the
+    # ones the user joined or favorited. Users without any clubs get the most popular clubs with a score of 0.
+    def recommend(self, user_id, limit):
+        scores = defaultdict(float)
+        with self.lock:
+            clubs = self.user_clubs.get(user_id)
+            if not clubs:
+                return [(club_id, 0) for club_id in self.popular if club_id in self.club_users][:limit]
+            for club_id in clubs:
+                for other_id, score in self.neighbors.get(club_id, ())[:RECOMMENDATION_NEIGHBORS]:
+                    if other_id not in clubs and other_id in self.club_users:
+                        scores[other_id] += score
+        return heapq.nlargest(limit, scores.items(), key=itemgetter(1))
+
+# Builds an index from the database
+def load_recommendation_index():
+    club_ids = [row[0] for row in db.session.query(Club.id)]
+    links = db.session.execute(text(
+        f"SELECT club_id, user_id, {MEMBER} FROM club_members UNION ALL "
+        f"SELECT club_id, user_id, {FAVORITE} FROM club_favorites"
+    ))
+    tags = db.session.query(club_tags.c.club_id, club_tags.c.tag_id)
+    return RecommendationIndex.from_rows(club_ids, links, tags)
+
+# Index of an app, the committed changes not applied to it yet, the changes committed while a new one is being
+# built, and the lock guarding them
+class RecommendationState:
+    def __init__(self):
+        self.index = None
+        self.pending_changes = []
+        # Whether a thread is applying pending_changes
+        self.applying = False
+        self.rebuild_changes = None
+        self.lock = threading.Lock()
+
+# Returns the recommendation state of the current app, kept in its extensions so every app has its own index
+def get_recommendation_state():
+    state = current_app.extensions.get('recommendations')
+    if state is None:
+        state = current_app.extensions.setdefault('recommendations', RecommendationState())
+    return state
+
+# Returns the index, or None until the first one is built. Building an index reads every link and scores every
+# club (tens of seconds for 100,000 users), so no request waits for it: the first call starts building it in a
+# background thread, and once the index is older than the refresh interval the next call starts a rebuild while
+# the current index is still served.
+def get_recommendation_index():
+    state = get_recommendation_state()
+    with state.lock:
+        if state.rebuild_changes is None and (state.index is None or time.monotonic() - state.index.built_at
+                                              > current_app.config.get('RECOMMENDATIONS_REFRESH_INTERVAL', 600)):
+            state.rebuild_changes = []
+            threading.Thread(target=rebuild_index, args=(current_app._get_current_object(),), daemon=True).start()
+        return state.index
+
+# Builds the index of the current app in the current thread and returns it, e.g. in preload_app (app.py) so
+# forked workers start with it
+def build_recommendation_index():
+    state = get_recommendation_state()
+    with state.lock:
+        state.rebuild_changes = []
+    rebuild_index(current_app._get_current_object())
+    return state.index
+
+# Builds a new index and swaps it in. The changes committed meanwhile are queued again to be applied to it: the
+# changes pending for the old index were committed before it was loaded, so they are already part of it.
+def rebuild_index(app):
+    state = app.extensions['recommendations']
+    index = None
+    try:
+        with app.app_context():
+            index = load_recommendation_index()
+    finally:
+        with state.lock:
+            if index is not None:
+                state.index = index
+                state.pending_changes = state.rebuild_changes
+                start_applying(state)
+            state.rebuild_changes = None
+
+# Starts a thread applying the pending changes unless one is running. Called with state.lock held.
+def start_applying(state):
+    if state.pending_changes and not state.applying:
+        state.applying = True
+        threading.Thread(target=apply_pending_changes, args=(state,), daemon=True).start()
+
+# Applies the pending changes to the index until there are none left. Changes are applied one at a time, each
+# holding the index's lock, so reads are served in between.
+def apply_pending_changes(state):
+    while True:
+        with state.lock:
+            changes, state.pending_changes = state.pending_changes, []
+            index = state.index
+            if not changes or index is None:
+                state.applying = False
+                return
+        for change in changes:
+            index.apply(change)
+
+# Records a change to the links between clubs and users, applied to the index when the transaction commits.
+# table is club_members or club_favorites.
+def queue_link_change(table, club_id, user_id, linked):
+    db.session.info.setdefault('recommendation_changes', []).append(
+        ('link', club_id, user_id, LINK_TABLES[table.name], linked))
+
+# Records deleted clubs and users, whose links are removed from the index when the transaction commits
+@event.listens_for(db.session, 'after_flush')
+def collect_deleted_links(session, flush_context):
+    for instance in session.deleted:
+        if isinstance(instance, Club):
+            session.info.setdefault('recommendation_changes', []).append(('club', instance.id))
+        elif isinstance(instance, User):
+            session.info.setdefault('recommendation_changes', []).append(('user', instance.id))
+
+# Queues the committed changes to be applied to the index in the background, and records them for an index being
+# rebuilt
+# SQLAlchemy also dispatches after_commit when a savepoint is released (e.g. by group_commit.py), which is ignored
+# until the outermost transaction commits.
+@event.listens_for(db.session, 'after_commit')
+def apply_committed_links(session):
+    if session.in_nested_transaction():
+        return
+    changes = session.info.pop('recommendation_changes', None)
+    if not changes:
+        return
+    state = get_recommendation_state()
+    with state.lock:
+        if state.rebuild_changes is not None:
+            state.rebuild_changes.extend(changes)
+        if state.index is not None:
+            state.pending_changes.extend(changes)
+            start_applying(state)
+
+# Discards the changes of a rolled back transaction
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_rolled_back_links(session, previous_transaction):
+    session.info.pop('recommendation_changes', None)
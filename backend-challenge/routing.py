@@ -0,0 +1,76 @@
+import time
+
+from flask import current_app, request
+from sqlalchemy import event
+
+from database import READ_BIND_KEY, db
+
+# Read/write routing.
+# When a read-only engine is configured (READ_DATABASE_URL), GET and HEAD requests run their queries on it and
+# every other request runs on the primary database, so heavy read traffic does not compete with writes.
+# Read-your-writes guard: a replica may lag behind the primary, so
+#   - once a session writes, the rest of its queries go to the primary, and
+#   - a request that commits a write sets a cookie sending the client's reads to the primary for
+#     READ_YOUR_WRITES_WINDOW seconds (default 5).
+
+# Request methods whose queries are routed to the read-only engine
+READ_METHODS = ('GET', 'HEAD')
+
+# Cookie holding the time until which the client's reads go to the primary database
+READ_PRIMARY_COOKIE = 'read_primary_until'
+
+# Returns True if a read-only engine is configured
+def read_routing_enabled():
+    return READ_BIND_KEY in db.engines
+
+# Returns the time until which the current request's client should read from the primary database
+def read_primary_until():
+    try:
+        return float(request.cookies.get(READ_PRIMARY_COOKIE, 0))
+    except ValueError:
+        return 0
+
+# Registers the routing of requests on an app
+def init_routing(app):
+    app.before_request(route_reads)
+    app.after_request(set_read_primary_cookie)
+
+# Routes the queries of read requests to the read-only engine unless the client wrote recently
+def route_reads():
+    if read_routing_enabled() and request.method in READ_METHODS and read_primary_until() <= time.time():
+        db.session.info['read_only'] = True
+
+# Sends the client's next reads to the primary database after a request that committed a write
+def set_read_primary_cookie(response):
+    if read_routing_enabled() and db.session.info.get('committed_write'):
+        window = current_app.config.get('READ_YOUR_WRITES_WINDOW', 5)
+        response.set_cookie(READ_PRIMARY_COOKIE, str(time.time() + window), max_age=window, httponly=True)
+    return response
+
+# Marks the session as having written through an ORM flush
+@event.listens_for(db.session, 'after_flush')
+def mark_flushed_write(session, flush_context):
+    session.info['read_only'] = False
+    session.info['pending_write'] = True
+
+# Marks the session as having written through a Core INSERT/UPDATE/DELETE statement
+@event.listens_for(db.session, 'do_orm_execute')
+def mark_statement_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['read_only'] = False
+        orm_execute_state.session.info['pending_write'] = True
+
+# Records that the session committed a write
+# SQLAlchemy also dispatches after_commit when a savepoint is released (e.g. by group_commit.py), which is ignored
+# until the outermost transaction commits.
+@event.listens_for(db.session, 'after_commit')
+def mark_committed_write(session):
+    if session.in_nested_transaction():
+        return
+    if session.info.pop('pending_write', False):
+        session.info['committed_write'] = True
+
+# Forgets the writes of a rolled back transaction
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_rolled_back_write(session, previous_transaction):
+    session.info.pop('pending_write', None)
@@ -0,0 +1,117 @@
+import re
+
+from sqlalchemy import DDL, event, text
+
+from database import db
+
+from models import *
+from pagination import encode_cursor, decode_cursor
+
+# Full-text search over clubs backed by an SQLite FTS5 virtual table.
+# Each row of club_search holds a club's name, description and tag names, with the club id as its rowid.
+# The table is created alongside the other tables by db.create_all() and has to be kept in sync by
+# calling index_club / unindex_club whenever a club is created, modified or deleted.
+
+# Relative weights used by bm25 when ranking matches in the name, description and tags columns
+SEARCH_WEIGHTS = (10.0, 1.0, 5.0)
+
+event.listen(db.metadata, "after_create", DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS club_search "
+    "USING fts5(name, description, tags, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+))
+event.listen(db.metadata, "before_drop", DDL("DROP TABLE IF EXISTS club_search"))
+
+# Adds or replaces the search entry for a club. The club must have been flushed so it has an id.
+# Runs in the current session transaction, so the entry is committed together with the club.
+def index_club(club):
+    unindex_club(club.id)
+    db.session.execute(
+        text("INSERT INTO club_search (rowid, name, description, tags) VALUES (:id, :name, :description, :tags)"),
+        {
+            "id": club.id,
+            "name": club.name,
+            "description": club.description or "",
+            "tags": " ".join(tag.name for tag in club.tags)
+        }
+    )
+
+# Removes the search entry for the club with the given id
+def unindex_club(club_id):
+    db.session.execute(text("DELETE FROM club_search WHERE rowid = :id"), {"id": club_id})
+
+# Rebuilds the whole search index from the club and tag tables in a single statement
+def rebuild_search_index():
+    db.session.execute(text("DELETE FROM club_search"))
+    db.session.execute(text(
+        "INSERT INTO club_search (rowid, name, description, tags) "
+        "SELECT club.id, club.name, coalesce(club.description, ''), coalesce(club_tag_names.tags, '') "
+        "FROM club LEFT JOIN ("
+        "SELECT club_tags.club_id AS club_id, group_concat(tag.name, ' ') AS tags "
+        "FROM club_tags JOIN tag ON tag.id = club_tags.tag_id GROUP BY club_tags.club_id"
+        ") AS club_tag_names ON club_tag_names.club_id = club.id"
+    ))
+
+# Turns user input into an FTS5 query where every word must match the start of a word in the club.
+# Words are quoted so FTS5 operators in the input are treated as plain text.
+# Returns None if the input has no searchable words.
+def build_match_query(search_string):
+    words = re.findall(r"\w+", search_string)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+# Club ids matching :query along with their bm25 rank, where lower ranks are better matches
+RANKED_MATCHES = (
+    "SELECT bm25(club_search, :name_weight, :description_weight, :tags_weight) AS rank, rowid AS id "
+    "FROM club_search WHERE club_search MATCH :query"
+)
+
+# Returns the parameters of a RANKED_MATCHES query along with any extra parameters
+def search_params(match_query, **params):
+    return {
+        "query": match_query,
+        "name_weight": SEARCH_WEIGHTS[0],
+        "description_weight": SEARCH_WEIGHTS[1],
+        "tags_weight": SEARCH_WEIGHTS[2],
+        **params
+    }
+
+# Returns one page of the ids of clubs matching search_string, best matches first, as (ids, next cursor token or None).
+# A limit of None returns every match after the cursor.
+def search_club_ids(search_string, limit, cursor=None):
+    match_query = build_match_query(search_string)
+    if match_query is None:
+        return [], None
+
+    # Results are paged by their key (bm25 rank, club id)
+    after_rank, after_id = None, None
+    if cursor is not None:
+        after_rank, after_id = decode_cursor(cursor, 2)
+
+    rows = db.session.execute(
+        text(
+            f"SELECT rank, id FROM ({RANKED_MATCHES}) "
+            "WHERE :after_id IS NULL OR (rank, id) > (:after_rank, :after_id) "
+            "ORDER BY rank, id LIMIT :limit"
+        ),
+        search_params(match_query, after_rank=after_rank, after_id=after_id, limit=-1 if limit is None else limit + 1)
+    ).all()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(list(rows[-1]))
+    return [row[1] for row in rows], next_cursor
+
+# Yields the ids of every club matching search_string, best matches first, in lists of at most batch_size ids
+def iter_search_club_ids(search_string, batch_size):
+    match_query = build_match_query(search_string)
+    if match_query is None:
+        return
+    result = db.session.execute(
+        text(f"SELECT id FROM ({RANKED_MATCHES}) ORDER BY rank, id"),
+        search_params(match_query),
+        execution_options={"yield_per": batch_size}
+    )
+    for rows in result.partitions(batch_size):
+        yield [row[0] for row in rows]
@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from database import db
+from metrics import timed_serialization
+
+from models import *
+
+# Batched serializers for list endpoints.
+# Each serializer takes a list of model ids and the fields to return, loads only the requested columns and
+# relationships with IN queries, and returns the json dictionaries in the same order as the given ids.
+# The number of queries each one runs is fixed and does not depend on how many ids are passed in.
+# The dictionaries match the output of the models' to_json functions when all fields are requested.
+
+# Fields each serializer can return. Column fields are read directly from the model's table.
+CLUB_COLUMNS = ('id', 'code', 'name', 'description')
+CLUB_FIELDS = CLUB_COLUMNS + ('tags', 'members', 'favorites', 'comments')
+TAG_COLUMNS = ('id', 'name')
+TAG_FIELDS = TAG_COLUMNS + ('number_of_clubs',)
+USER_COLUMNS = ('id', 'name', 'graduation_year', 'email')
+USER_FIELDS = USER_COLUMNS + ('schools', 'majors', 'clubs', 'favorites')
+SCHOOL_FIELDS = ('id', 'code', 'name')
+MAJOR_FIELDS = ('id', 'code', 'name')
+COMMENT_FIELDS = ('id', 'user', 'club_id', 'parent_id', 'body', 'created_at', 'updated_at', 'reply_count', 'replies')
+
+# Loads the requested column fields for the models with the given ids in one query.
+# Returns a dictionary mapping each id found to a dictionary of its requested column values.
+def load_columns(model, ids, fields, columns):
+    selected = [column for column in columns if column in fields]
+    rows = db.session.query(model.id, *[getattr(model, column) for column in selected]).filter(model.id.in_(ids)).all()
+    return {row[0]: dict(zip(selected, row[1:])) for row in rows}
+
+# Given a dictionary of serialized models, adds a list under key built from (owner id, value) rows
+def attach_lists(serialized, key, rows):
+    for data in serialized.values():
+        data[key] = []
+    for owner_id, value in rows:
+        serialized[owner_id][key].append(value)
+
+# Helper to return the serialized models in the order of the requested ids, skipping ids that were not found
+def order_by_ids(serialized, ids):
+    return [serialized[model_id] for model_id in ids if model_id in serialized]
+
+# Returns json data for the clubs with the given ids in at most 5 queries (columns, tags, and the three grouped counts)
+@timed_serialization
+def serialize_clubs(club_ids, fields=CLUB_FIELDS):
+    if not club_ids:
+        return []
+    clubs = load_columns(Club, club_ids, fields, CLUB_COLUMNS)
+
+    if 'tags' in fields:
+        attach_lists(clubs, 'tags', db.session.query(club_tags.c.club_id, Tag.name)
+            .join(Tag, Tag.id == club_tags.c.tag_id)
+            .filter(club_tags.c.club_id.in_(club_ids))
+            .all())
+
+    count_keys = [key for key in ('members', 'favorites', 'comments') if key in fields]
+    if count_keys:
+        counts = get_club_counts(club_ids, count_keys)
+        for club_id, data in clubs.items():
+            data.update(counts[club_id])
+    return order_by_ids(clubs, club_ids)
+
+# Returns json data for the clubs of a list of (club id, score) pairs in the same order, adding each score
+# under score_key. Clubs that no longer exist are skipped.
+def serialize_scored_clubs(scores, fields=CLUB_FIELDS, score_key='score'):
+    scores = dict(scores)
+    clubs = serialize_clubs(list(scores), fields if 'id' in fields else fields + ('id',))
+    for club in clubs:
+        club_id = club['id'] if 'id' in fields else club.pop('id')
+        club[score_key] = round(scores[club_id], 4)
+    return clubs
+
+# Returns json data for the tags with the given ids in at most 2 queries (columns and precomputed club counts)
+@timed_serialization
+def serialize_tags(tag_ids, fields=TAG_FIELDS):
+    if not tag_ids:
+        return []
+    tags = load_columns(Tag, tag_ids, fields, TAG_COLUMNS)
+
+    if 'number_of_clubs' in fields:
+        counts = dict(
+            db.session.query(tag_stats.c.tag_id, tag_stats.c.club_count)
+            .filter(tag_stats.c.tag_id.in_(tag_ids))
+            .all()
+        )
+        for tag_id, data in tags.items():
+            data['number_of_clubs'] = counts.get(tag_id, 0)
+    return order_by_ids(tags, tag_ids)
+
+# Returns json data for the users with the given ids in at most 5 queries (columns plus one per relationship)
+@timed_serialization
+def serialize_users(user_ids, fields=USER_FIELDS):
+    if not user_ids:
+        return []
+    users = load_columns(User, user_ids, fields, USER_COLUMNS)
+
+    if 'schools' in fields:
+        rows = db.session.query(users_schools.c.user_id, School.id, School.code, School.name) \
+            .join(School, School.id == users_schools.c.school_id) \
+            .filter(users_schools.c.user_id.in_(user_ids)).all()
+        attach_lists(users, 'schools', [(row[0], {'id': row[1], 'code': row[2], 'name': row[3]}) for row in rows])
+    if 'majors' in fields:
+        rows = db.session.query(users_majors.c.user_id, Major.id, Major.code, Major.name) \
+            .join(Major, Major.id == users_majors.c.major_id) \
+            .filter(users_majors.c.user_id.in_(user_ids)).all()
+        attach_lists(users, 'majors', [(row[0], {'id': row[1], 'code': row[2], 'name': row[3]}) for row in rows])
+    if 'clubs' in fields:
+        attach_lists(users, 'clubs', db.session.query(club_members.c.user_id, Club.name)
+            .join(Club, Club.id == club_members.c.club_id)
+            .filter(club_members.c.user_id.in_(user_ids))
+            .all())
+    if 'favorites' in fields:
+        attach_lists(users, 'favorites', db.session.query(club_favorites.c.user_id, Club.name)
+            .join(Club, Club.id == club_favorites.c.club_id)
+            .filter(club_favorites.c.user_id.in_(user_ids))
+            .all())
+    return order_by_ids(users, user_ids)
+
+# Returns json data for the schools with the given ids in 1 query
+@timed_serialization
+def serialize_schools(school_ids, fields=SCHOOL_FIELDS):
+    if not school_ids:
+        return []
+    return order_by_ids(load_columns(School, school_ids, fields, SCHOOL_FIELDS), school_ids)
+
+# Returns json data for the majors with the given ids in 1 query
+@timed_serialization
+def serialize_majors(major_ids, fields=MAJOR_FIELDS):
+    if not major_ids:
+        return []
+    return order_by_ids(load_columns(Major, major_ids, fields, MAJOR_FIELDS), major_ids)
+
+# Context manager that records every SQL statement executed on the app's engines while active, including the
+# read-only engine that read requests are routed to (see routing.py). Must be used inside an app context. Yields
+# the list of statements so callers can inspect it.
+@contextmanager
+def count_queries():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", record)
+
+# Context manager for tests that pins a block of code (such as a test client request) to a statement budget.
+# Raises an AssertionError listing the executed statements if more than max_queries were run.
+@contextmanager
+def assert_max_queries(max_queries):
+    with count_queries() as statements:
+        yield statements
+    if len(statements) > max_queries:
+        raise AssertionError(
+            f"Expected at most {max_queries} queries but {len(statements)} were executed:\n"
+            + "\n".join(statements)
+        )
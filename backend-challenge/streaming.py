@@ -0,0 +1,59 @@
+from flask import current_app, request, stream_with_context
+
+# Streaming responses for large result sets.
+# Collection endpoints normally return one page at a time. A client can instead ask for every result in one
+# response, either as a JSON array (`stream=true`) or as newline delimited JSON (`Accept: application/x-ndjson`).
+# The ids are read from the database with yield_per in batches of STREAM_BATCH_SIZE, and each batch is serialized
+# and sent before the next is read, so memory use is bounded by the batch size rather than the result size and the
+# response starts before the query has returned every row. `limit` and `cursor` do not apply to streamed responses.
+
+# Number of items read, serialized and sent at a time
+STREAM_BATCH_SIZE = 500
+# Number of top level comments whose threads are loaded and sent at a time
+COMMENT_STREAM_BATCH_SIZE = 50
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Returns the streaming format requested by the current request: 'ndjson', 'json', or None for a paginated response
+def get_stream_format():
+    if request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE:
+        return "ndjson"
+    if request.args.get("stream", "").lower() in ("1", "true"):
+        return "json"
+    return None
+
+# Yields the ids of a query in lists of at most batch_size ids, ordered by key_columns,
+# which must end with the id column, e.g. (Comment.created_at, Comment.id)
+def iter_id_batches(query, key_columns, batch_size=STREAM_BATCH_SIZE):
+    batch = []
+    for row in query.with_entities(key_columns[-1]).order_by(*key_columns).yield_per(batch_size):
+        batch.append(row[0])
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Returns a streamed response of the json items in batches, an iterable of lists of json dictionaries.
+# The items are encoded like jsonify does, either as one JSON array or one item per line for 'ndjson'.
+def stream_response(batches, stream_format):
+    def dumps(item):
+        return current_app.json.dumps(item, separators=(",", ":"))
+
+    def generate():
+        if stream_format == "ndjson":
+            for batch in batches:
+                if batch:
+                    yield "".join(dumps(item) + "\n" for item in batch)
+            return
+
+        yield "["
+        first = True
+        for batch in batches:
+            if batch:
+                yield ("" if first else ",") + ",".join(dumps(item) for item in batch)
+                first = False
+        yield "]\n"
+
+    mimetype = NDJSON_MIMETYPE if stream_format == "ndjson" else "application/json"
+    return current_app.response_class(stream_with_context(generate()), mimetype=mimetype)
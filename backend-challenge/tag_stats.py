@@ -0,0 +1,78 @@
+from sqlalchemy import DDL, event, text
+
+from database import db
+
+from models import *
+from pagination import PaginationError, decode_cursor, encode_cursor, paginate_ids
+
+# Precomputed tag statistics and multi-tag club listings.
+# tag_stats holds the number of clubs of every tag. SQLite triggers update it in the same statement as every
+# insert or delete on tag and club_tags, whether made through the ORM, Core statements or bootstrap.py, so
+# /api/tags reads each count with a primary key lookup instead of counting club_tags rows.
+# Clubs having several tags are listed page by page straight from the (tag_id, club_id) primary key index of
+# club_tags.
+
+# Triggers keeping tag_stats in sync, created by db.create_all() after the tables
+TAG_STATS_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS tag_stats_tag_insert AFTER INSERT ON tag BEGIN "
+    "INSERT OR IGNORE INTO tag_stats (tag_id, club_count) VALUES (NEW.id, 0); END",
+    "CREATE TRIGGER IF NOT EXISTS tag_stats_tag_delete AFTER DELETE ON tag BEGIN "
+    "DELETE FROM tag_stats WHERE tag_id = OLD.id; END",
+    "CREATE TRIGGER IF NOT EXISTS tag_stats_club_tags_insert AFTER INSERT ON club_tags BEGIN "
+    "UPDATE tag_stats SET club_count = club_count + 1 WHERE tag_id = NEW.tag_id; END",
+    "CREATE TRIGGER IF NOT EXISTS tag_stats_club_tags_delete AFTER DELETE ON club_tags BEGIN "
+    "UPDATE tag_stats SET club_count = club_count - 1 WHERE tag_id = OLD.tag_id; END"
+)
+
+for trigger in TAG_STATS_TRIGGERS:
+    event.listen(db.metadata, "after_create", DDL(trigger))
+
+# Recomputes every row of tag_stats from the tag and club_tags tables, e.g. for a database created before
+# tag_stats existed
+def rebuild_tag_stats():
+    db.session.execute(text("DELETE FROM tag_stats"))
+    db.session.execute(text(
+        "INSERT INTO tag_stats (tag_id, club_count) "
+        "SELECT tag.id, count(club_tags.club_id) FROM tag "
+        "LEFT JOIN club_tags ON club_tags.tag_id = tag.id GROUP BY tag.id"
+    ))
+
+# Returns a query of the ids of the clubs having all of the given tags.
+# The rows of the tag with the fewest clubs are scanned in club id order and the other tags are checked with
+# primary key lookups, so the cost depends on the rarest tag rather than on the most common one.
+def all_tags_query(tag_ids):
+    counts = dict(db.session.query(tag_stats.c.tag_id, tag_stats.c.club_count).filter(tag_stats.c.tag_id.in_(tag_ids)))
+    rarest, *others = sorted(tag_ids, key=lambda tag_id: (counts.get(tag_id, 0), tag_id))
+    query = db.session.query(club_tags.c.club_id).filter(club_tags.c.tag_id == rarest)
+    for tag_id in others:
+        other = club_tags.alias()
+        query = query.filter(db.exists().where(other.c.tag_id == tag_id, other.c.club_id == club_tags.c.club_id))
+    return query
+
+# Returns one page of the ids of the clubs having all (match 'all') or any (match 'any') of the given tags,
+# ordered by club id, as (ids, next cursor token or None).
+# For 'any', each tag's rows are read in club id order from the index and merged by a UNION, which stops once
+# the page is full instead of collecting and sorting every club of every tag.
+def tagged_club_ids(tag_ids, match, limit, cursor=None):
+    if match == 'all':
+        return paginate_ids(all_tags_query(tag_ids), (club_tags.c.club_id,), limit, cursor)
+
+    after = None
+    if cursor is not None:
+        after = decode_cursor(cursor, 1)[0]
+        if not isinstance(after, int):
+            raise PaginationError("Invalid cursor")
+    selects = []
+    for tag_id in tag_ids:
+        select = db.select(club_tags.c.club_id).where(club_tags.c.tag_id == tag_id)
+        if after is not None:
+            select = select.where(club_tags.c.club_id > after)
+        selects.append(select)
+    query = selects[0] if len(selects) == 1 else db.union(*selects)
+    club_ids = db.session.execute(query.order_by(club_tags.c.club_id.name).limit(limit + 1)).scalars().all()
+
+    next_cursor = None
+    if len(club_ids) > limit:
+        club_ids = club_ids[:limit]
+        next_cursor = encode_cursor([club_ids[-1]])
+    return club_ids, next_cursor
@@ -0,0 +1,115 @@
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+
+from app import create_app
+from bootstrap import bulk_load_clubs, create_user
+from database import db
+
+# Fixtures shared by the tests: an app on a fresh SQLite database seeded like bootstrap.py, and clients sending
+# requests to it through the WSGI app (Flask test client) or the ASGI app (asgi.py, through httpx).
+
+CLUBS_FILE = Path(__file__).resolve().parent.parent / 'clubs.json'
+
+# Response of either client
+class ApiResponse:
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+# Sends requests through the Flask test client. Both clients take a json body, or raw bytes as content along
+# with a Content-Type header.
+class WSGIClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, json=None, headers=None, content=None):
+        response = self.client.open(url, method=method, json=json, data=content, headers=headers)
+        return ApiResponse(response.status_code, response.headers, response.get_data())
+
+    def close(self):
+        pass
+
+# Sends requests through the ASGI app of asgi.py, on its own event loop
+class ASGIClient:
+    def __init__(self, app):
+        httpx = pytest.importorskip('httpx')
+        pytest.importorskip('aiosqlite')
+        from asgi_lifespan import LifespanManager
+        from asgi import create_asgi_app
+
+        self.loop = asyncio.new_event_loop()
+        self.application = create_asgi_app(app)
+        self.lifespan = self.loop.run_until_complete(self.start_lifespan(LifespanManager))
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=self.application),
+                                        base_url='http://localhost')
+
+    # Sends the lifespan startup event. The manager is made on the loop, as it needs a running one.
+    async def start_lifespan(self, manager_class):
+        lifespan = manager_class(self.application)
+        await lifespan.__aenter__()
+        return lifespan
+
+    async def send(self, method, url, json=None, headers=None, content=None):
+        response = await self.client.request(method, url, json=json, content=content, headers=headers)
+        return ApiResponse(response.status_code, response.headers, response.content)
+
+    def request(self, method, url, json=None, headers=None, content=None):
+        return self.loop.run_until_complete(self.send(method, url, json, headers, content))
+
+    # Sends (method, url, json) requests concurrently on the event loop and returns their responses in order
+    def gather(self, requests):
+        async def send_all():
+            return await asyncio.gather(*(self.send(*request) for request in requests))
+        return self.loop.run_until_complete(send_all())
+
+    def close(self):
+        self.loop.run_until_complete(self.client.aclose())
+        self.loop.run_until_complete(self.lifespan.__aexit__(None, None, None))
+        self.loop.close()
+
+CLIENTS = {'wsgi': WSGIClient, 'asgi': ASGIClient}
+
+# Returns an app on a new SQLite database in directory, seeded like bootstrap.py.
+# Only the tables of the default engine are created: db keeps the metadata of a read-only bind once an app used
+# one (READ_DATABASE_URL), and that bind opens the same database anyway.
+def make_app(directory, config=None):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{directory / 'test.db'}", **(config or {})})
+    with app.app_context():
+        db.create_all(bind_key=None)
+        create_user()
+        bulk_load_clubs(CLUBS_FILE, report=lambda message: None)
+    return app
+
+# Closes the connections of an app's engines
+def dispose_app(app):
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+
+@pytest.fixture
+def app(tmp_path):
+    app = make_app(tmp_path)
+    yield app
+    dispose_app(app)
+
+# A client of the WSGI app, or of the ASGI app for tests parametrized with indirect=True
+@pytest.fixture
+def client(app, request):
+    client = CLIENTS[getattr(request, 'param', 'wsgi')](app)
+    yield client
+    client.close()
+
+# Runs a function inside an app context of the app
+@pytest.fixture
+def in_app(app):
+    def run(function, *args):
+        with app.app_context():
+            return function(*args)
+    return run
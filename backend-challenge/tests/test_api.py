@@ -0,0 +1,466 @@
+import gc
+import re
+import threading
+import time
+
+import pytest
+from sqlalchemy import text
+
+from activity import rebuild_club_activity
+from app import PRELOAD_PATHS, create_app
+from conftest import dispose_app, make_app
+from database import READ_BIND_KEY, db, get_db_profile
+from models import Club, Comment, Tag, User, club_activity, club_members, tag_stats
+from recommendations import MEMBER, RecommendationIndex, build_recommendation_index
+from tag_stats import rebuild_tag_stats
+
+# API tests run against both the WSGI app and the ASGI app (asgi.py), which serve the same routes and must give
+# the same responses. ASGI runs are skipped when its dependencies are not installed.
+
+pytestmark = pytest.mark.parametrize('client', ['wsgi', 'asgi'], indirect=True)
+
+# Returns the id of the club with the given code
+def club_id(in_app, code):
+    return in_app(lambda: Club.query.filter_by(code=code).one().id)
+
+def user_id(in_app):
+    return in_app(lambda: User.query.filter_by(email='josh@upenn.edu').one().id)
+
+def test_get_clubs(client):
+    response = client.request('GET', '/api/clubs')
+    assert response.status_code == 200
+    assert sorted(club['code'] for club in response.json()) == \
+        ['locustlabs', 'lorem-ipsum', 'penn-memes', 'pppjo', 'pppp']
+
+def test_get_club(client, in_app):
+    response = client.request('GET', f"/api/clubs/{club_id(in_app, 'pppjo')}")
+    assert response.status_code == 200
+    club = response.json()
+    assert club['name'] == 'Penn Pre-Professional Juggling Organization'
+    assert club['tags'] == ['Pre-Professional', 'Athletics', 'Undergraduate']
+    assert (club['members'], club['favorites'], club['comments']) == (0, 0, 0)
+
+    assert client.request('GET', '/api/clubs/999999').status_code == 404
+
+def test_club_etag(client, in_app):
+    url = f"/api/clubs/{club_id(in_app, 'pppp')}"
+    etag = client.request('GET', url).headers['ETag']
+    assert client.request('GET', url, headers={'If-None-Match': etag}).status_code == 304
+
+    response = client.request('POST', url, json={'description': 'Tomorrow.'}, headers={'If-Match': etag})
+    assert response.status_code == 200
+    assert response.json()['description'] == 'Tomorrow.'
+    # The club changed since etag was read
+    assert client.request('POST', url, json={'description': 'Later.'}, headers={'If-Match': etag}).status_code == 412
+    assert client.request('GET', url, headers={'If-None-Match': etag}).status_code == 200
+
+def test_search_clubs(client):
+    response = client.request('GET', '/api/clubs/search/jugg')
+    assert response.status_code == 200
+    assert [club['code'] for club in response.json()] == ['pppjo']
+    assert client.request('GET', '/api/clubs/search/nothingmatches').json() == []
+
+def test_create_club(client):
+    response = client.request('POST', '/api/clubs', json={
+        'code': 'chess', 'name': 'Penn Chess Club', 'description': 'Checkmate.', 'tags': ['Undergraduate', 'Games']})
+    assert response.status_code == 201
+    assert response.json()['tags'] == ['Undergraduate', 'Games']
+
+    assert client.request('POST', '/api/clubs', json={'code': 'chess', 'name': 'Other'}).status_code == 400
+    assert client.request('POST', '/api/clubs', json={'name': 'No Code'}).status_code == 422
+    assert [club['code'] for club in client.request('GET', '/api/clubs/search/chess').json()] == ['chess']
+    tags = {tag['name']: tag['number_of_clubs'] for tag in client.request('GET', '/api/tags').json()}
+    assert (tags['Undergraduate'], tags['Games']) == (5, 1)
+
+def test_delete_club(client, in_app):
+    url = f"/api/clubs/{club_id(in_app, 'penn-memes')}"
+    assert client.request('DELETE', url).status_code == 204
+    assert client.request('GET', url).status_code == 404
+    assert client.request('GET', '/api/clubs/search/memes').json() == []
+
+def test_join_and_favorite(client, in_app):
+    pppjo, josh = club_id(in_app, 'pppjo'), user_id(in_app)
+    assert client.request('POST', f'/api/clubs/{pppjo}/join', json={'user_id': josh}).json()['action'] == 'joined'
+    assert client.request('POST', f'/api/clubs/{pppjo}/favorite', json={'user_id': josh}).json()['action'] == 'added'
+    club = client.request('GET', f'/api/clubs/{pppjo}').json()
+    assert (club['members'], club['favorites']) == (1, 1)
+    user = client.request('GET', f'/api/users/{josh}').json()
+    assert user['clubs'] == ['Penn Pre-Professional Juggling Organization']
+
+    assert client.request('POST', f'/api/clubs/{pppjo}/join', json={'user_id': josh}).json()['action'] == 'left'
+    assert client.request('GET', f'/api/clubs/{pppjo}').json()['members'] == 0
+    assert client.request('POST', f'/api/clubs/{pppjo}/join', json={'user_id': 999999}).status_code == 404
+    assert client.request('POST', f'/api/clubs/{pppjo}/join', json={}).status_code == 422
+
+def test_users(client):
+    response = client.request('POST', '/api/users', json={
+        'name': 'Ada', 'email': 'ada@upenn.edu', 'graduation_year': 2027,
+        'school': [{'id': 2, 'code': 'WH', 'name': 'Wharton'}], 'major': [{'id': 2, 'code': 'MATH', 'name': 'Mathematics'}]})
+    assert response.status_code == 201
+    ada = response.json()['id']
+    assert client.request('POST', '/api/users', json={'name': 'Ada', 'email': 'ada@upenn.edu'}).status_code == 400
+
+    response = client.request('POST', f'/api/users/{ada}', json={'graduation_year': 2028})
+    assert response.status_code == 200
+    assert response.json()['graduation_year'] == 2028
+    assert [school['code'] for school in client.request('GET', '/api/schools').json()] == ['SEAS', 'WH']
+
+    assert client.request('DELETE', f'/api/users/{ada}').status_code == 204
+    assert client.request('GET', f'/api/users/{ada}').status_code == 404
+
+def test_comments(client, in_app):
+    club, josh = club_id(in_app, 'locustlabs'), user_id(in_app)
+    url = f'/api/clubs/{club}/comments'
+    top = client.request('POST', url, json={'user_id': josh, 'body': 'First!'})
+    assert top.status_code == 201
+    reply = client.request('POST', url, json={'user_id': josh, 'body': 'Reply', 'parent_id': top.json()['id']})
+    assert reply.status_code == 201
+
+    threads = client.request('GET', url).json()
+    assert [comment['body'] for comment in threads] == ['First!']
+    assert [comment['body'] for comment in threads[0]['replies']] == ['Reply']
+    assert client.request('GET', f"/api/clubs/{club}").json()['comments'] == 2
+
+    response = client.request('POST', f"/api/comments/{reply.json()['id']}", json={'body': 'Edited'})
+    assert response.status_code == 200
+    assert response.json()['body'] == 'Edited'
+    assert client.request('DELETE', f"/api/comments/{top.json()['id']}").status_code == 204
+    assert client.request('GET', url).json() == []
+    assert in_app(lambda: Comment.query.count()) == 0
+
+def test_comment_errors(client, in_app):
+    club, other, josh = club_id(in_app, 'locustlabs'), club_id(in_app, 'pppp'), user_id(in_app)
+    parent = client.request('POST', f'/api/clubs/{club}/comments', json={'user_id': josh, 'body': 'Hi'}).json()['id']
+    assert client.request('POST', f'/api/clubs/{club}/comments', json={'user_id': josh}).status_code == 422
+    assert client.request('POST', f'/api/clubs/{club}/comments',
+                          json={'user_id': josh, 'body': 'Reply', 'parent_id': 999999}).status_code == 404
+    assert client.request('POST', f'/api/clubs/{other}/comments',
+                          json={'user_id': josh, 'body': 'Reply', 'parent_id': parent}).status_code == 422
+    assert client.request('GET', '/api/clubs/999999/comments').status_code == 404
+
+def test_reply_pages(client, in_app):
+    club, josh = club_id(in_app, 'locustlabs'), user_id(in_app)
+    url = f'/api/clubs/{club}/comments'
+    parent = client.request('POST', url, json={'user_id': josh, 'body': 'Parent'}).json()['id']
+    replies = [client.request('POST', url, json={'user_id': josh, 'body': f'Reply {n}', 'parent_id': parent}).json()['id']
+               for n in range(5)]
+
+    thread = client.request('GET', f'/api/comments/{parent}?replies_limit=2').json()
+    assert thread['reply_count'] == 5
+    shown = [reply['id'] for reply in thread['replies']]
+    assert shown == replies[:2]
+
+    # The rest of the replies, after the last one shown
+    page = client.request('GET', f'/api/comments/{parent}/replies?after={shown[-1]}&limit=2')
+    assert [reply['id'] for reply in page.json()] == replies[2:4]
+    page = client.request('GET', f"/api/comments/{parent}/replies?limit=2&cursor={page.headers['X-Next-Cursor']}")
+    assert [reply['id'] for reply in page.json()] == replies[4:]
+    assert 'X-Next-Cursor' not in page.headers
+
+    assert client.request('GET', f'/api/comments/{parent}/replies?after={parent}').status_code == 400
+    assert client.request('GET', f'/api/comments/{parent}/replies?after=abc').status_code == 400
+    assert client.request('GET', '/api/comments/999999/replies').status_code == 404
+
+# Waits up to 10 seconds for condition to become true
+def wait_for(condition):
+    deadline = time.monotonic() + 10
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+def test_recommendations(client, app, in_app):
+    pppjo, josh = club_id(in_app, 'pppjo'), user_id(in_app)
+    client.request('POST', f'/api/clubs/{pppjo}/join', json={'user_id': josh})
+
+    # The first request starts building the index in the background instead of waiting for it
+    response = client.request('GET', f'/api/clubs/{pppjo}/similar')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+    state = app.extensions['recommendations']
+    wait_for(lambda: state.index is not None)
+
+    similar = client.request('GET', f'/api/clubs/{pppjo}/similar').json()
+    # Clubs sharing the Undergraduate tag
+    assert sorted(club['code'] for club in similar) == ['locustlabs', 'lorem-ipsum', 'pppp']
+    recommended = client.request('GET', f'/api/users/{josh}/recommendations').json()
+    assert [club['code'] for club in recommended] == [club['code'] for club in similar]
+    assert client.request('GET', '/api/users/999999/recommendations').status_code == 404
+
+def test_legacy_lists_are_not_truncated(client, in_app):
+    for n in range(60):
+        client.request('POST', '/api/clubs', json={'code': f'club{n}', 'name': f'Quokka Club {n}', 'tags': [f'Topic {n}']})
+    assert len(client.request('GET', '/api/tags').json()) == 67
+    assert len(client.request('GET', '/api/clubs/search/quokka').json()) == 60
+
+    # Pages are only returned when asked for
+    page = client.request('GET', '/api/tags?limit=50')
+    assert len(page.json()) == 50
+    rest = client.request('GET', f"/api/tags?cursor={page.headers['X-Next-Cursor']}")
+    assert len(rest.json()) == 17
+    assert 'X-Next-Cursor' not in rest.headers
+
+    assert client.request('GET', '/api/tags?limit=abc').status_code == 400
+    assert client.request('GET', '/api/tags?limit=0').status_code == 400
+    assert client.request('GET', '/api/clubs/trending?days=abc').status_code == 400
+    assert client.request('GET', f"/api/clubs/{club_id(in_app, 'pppp')}/comments?depth=x").status_code == 400
+
+# Committed joins are applied to the index by a background thread, not by the request that made them
+def test_recommendation_changes_are_applied_in_background(client, app, in_app, monkeypatch):
+    pppjo, pppp, josh = club_id(in_app, 'pppjo'), club_id(in_app, 'pppp'), user_id(in_app)
+    in_app(build_recommendation_index)
+    index = app.extensions['recommendations'].index
+    threads = []
+    apply = RecommendationIndex.apply
+    monkeypatch.setattr(RecommendationIndex, 'apply',
+                        lambda self, change: threads.append(threading.current_thread()) or apply(self, change))
+
+    for club in (pppjo, pppp):
+        assert client.request('POST', f'/api/clubs/{club}/join', json={'user_id': josh}).status_code == 200
+    wait_for(lambda: index.user_clubs.get(josh) == {pppjo: MEMBER, pppp: MEMBER})
+    assert len(threads) == 2 and threading.current_thread() not in threads
+    wait_for(lambda: not app.extensions['recommendations'].applying)
+    # Both clubs are now linked through josh
+    assert client.request('GET', f'/api/clubs/{pppjo}/similar').json()[0]['code'] == 'pppp'
+
+def test_batch_members(client, in_app):
+    pppjo, josh = club_id(in_app, 'pppjo'), user_id(in_app)
+    ada = client.request('POST', '/api/users', json={'name': 'Ada', 'email': 'ada@upenn.edu'}).json()['id']
+    url = f'/api/clubs/{pppjo}/members/batch'
+
+    response = client.request('POST', url, json={'add': [josh, ada, 999999]})
+    assert response.status_code == 200
+    assert response.json()['results'] == [
+        {'id': josh, 'action': 'joined'}, {'id': ada, 'action': 'joined'}, {'id': 999999, 'action': 'not_found'}]
+    assert response.json()['summary'] == {'joined': 2, 'not_found': 1}
+    assert client.request('GET', f'/api/clubs/{pppjo}').json()['members'] == 2
+
+    response = client.request('POST', url, json={'add': [josh], 'remove': [ada, 999999]})
+    assert response.json()['summary'] == {'unchanged': 1, 'left': 1, 'not_found': 1}
+    assert client.request('GET', f'/api/clubs/{pppjo}').json()['members'] == 1
+
+    # The user side of the same links
+    response = client.request('POST', f'/api/users/{ada}/favorites/batch',
+                              json={'add': [pppjo, club_id(in_app, 'pppp')]})
+    assert response.json()['summary'] == {'added': 2}
+    assert client.request('GET', f'/api/clubs/{pppjo}').json()['favorites'] == 1
+    assert client.request('POST', '/api/users/999999/clubs/batch', json={'add': [pppjo]}).status_code == 404
+
+def test_batch_errors(client, in_app):
+    url = f"/api/clubs/{club_id(in_app, 'pppjo')}/members/batch"
+    josh = user_id(in_app)
+    for body in (b'[1, 2]', b'null', b'"add"', b'5'):
+        response = client.request('POST', url, headers={'Content-Type': 'application/json'}, content=body)
+        assert response.status_code == 400, body
+    for body in ({}, {'add': []}, {'add': 'abc'}, {'add': [True]}, {'remove': [josh, '2']}, {'add': [1.5]},
+                 {'add': [josh], 'remove': [josh]}, {'add': list(range(1, 1002))}):
+        assert client.request('POST', url, json=body).status_code == 422, body
+    assert client.request('POST', url, json={'add': list(range(1, 1001))}).status_code == 200
+    assert client.request('POST', '/api/clubs/999999/members/batch', json={'add': [josh]}).status_code == 404
+
+# A join committed by another request while a club edit is in progress does not make the edit fail
+def test_club_edit_during_join(client, app, in_app, monkeypatch):
+    import app as app_module
+    from versioning import bump_versions
+
+    pppjo, josh = club_id(in_app, 'pppjo'), user_id(in_app)
+    url = f'/api/clubs/{pppjo}'
+    if_match_passes = app_module.if_match_passes
+
+    def join_then_check(etag):
+        # After the edit loaded the club, as a concurrent request would
+        def join():
+            db.session.execute(club_members.insert().values(club_id=pppjo, user_id=josh))
+            bump_versions(Club, [pppjo])
+            db.session.commit()
+        in_app(join)
+        return if_match_passes(etag)
+
+    monkeypatch.setattr(app_module, 'if_match_passes', join_then_check)
+    response = client.request('POST', url, json={'description': 'Edited.'})
+    assert response.status_code == 200
+    assert (response.json()['description'], response.json()['members']) == ('Edited.', 1)
+    # Both the join and the edit incremented the version
+    assert in_app(lambda: db.session.query(Club.version).filter(Club.id == pppjo).scalar()) == 3
+
+    # With If-Match, an edit made after a join the client did not see is rejected
+    monkeypatch.undo()
+    etag = response.headers['ETag']
+    client.request('POST', f'{url}/favorite', json={'user_id': josh})
+    response = client.request('POST', url, json={'description': 'Again.'}, headers={'If-Match': etag})
+    assert response.status_code == 412
+    assert in_app(lambda: db.session.query(Club.description).filter(Club.id == pppjo).scalar()) == 'Edited.'
+
+# Returns the values of the given pragmas on a connection of the app's engine (or of its read-only engine)
+def read_pragmas(names, bind_key=None):
+    with db.engines[bind_key].connect() as connection:
+        return tuple(connection.execute(text(f'PRAGMA {name}')).scalar() for name in names)
+
+# Each DB_PROFILE sets its pragmas on every connection, and the app serves requests with either profile
+def test_db_profiles(client, in_app, tmp_path, monkeypatch):
+    names = ('journal_mode', 'synchronous', 'foreign_keys', 'busy_timeout', 'cache_size', 'temp_store', 'mmap_size')
+    assert in_app(read_pragmas, names) == ('delete', 2, 1, 5000, -2000, 0, 0)
+    with pytest.raises(ValueError, match='Unknown DB_PROFILE'):
+        get_db_profile({'DB_PROFILE': 'fast'})
+
+    monkeypatch.setenv('READ_DATABASE_URL', 'readonly')
+    (tmp_path / 'prod').mkdir()
+    app = make_app(tmp_path / 'prod', {'DB_PROFILE': 'prod'})
+    prod_client = type(client)(app)
+    try:
+        response = prod_client.request('POST', '/api/clubs', json={'code': 'chess', 'name': 'Penn Chess Club'})
+        assert response.status_code == 201
+        assert prod_client.request('GET', f"/api/clubs/{response.json()['id']}").status_code == 200
+        with app.app_context():
+            assert read_pragmas(names) == ('wal', 1, 1, 5000, -65536, 2, 268435456)
+            # The read-only engine keeps the journal mode of the database and rejects writes
+            assert read_pragmas(('journal_mode', 'query_only'), READ_BIND_KEY) == ('wal', 1)
+    finally:
+        prod_client.close()
+        dispose_app(app)
+
+# Returns the value of a sample of the /api/_metrics output, or 0 if it is not there yet
+def metric_value(client, sample):
+    lines = client.request('GET', '/api/_metrics').body.decode().splitlines()
+    values = [float(line.rsplit(' ', 1)[1]) for line in lines if line.rsplit(' ', 1)[0] == sample]
+    return values[0] if values else 0
+
+# Every request gets a Server-Timing header and is counted in the histograms of its route in /api/_metrics
+def test_request_metrics(client, app, in_app, caplog):
+    url = f"/api/clubs/{club_id(in_app, 'pppjo')}"
+    labels = 'method="GET",route="/api/clubs/<int:club_id>"'
+    count = metric_value(client, f'http_request_duration_seconds_count{{{labels}}}')
+
+    response = client.request('GET', url)
+    timings = response.headers['Server-Timing'].split(', ')
+    assert [timing.split(';')[0] for timing in timings] == ['db', 'serialize', 'total']
+    assert re.fullmatch(r'db;dur=[\d.]+;desc="[1-9]\d* queries"', timings[0])
+    client.request('GET', url)
+
+    # Both requests are in the route's histograms, in the +Inf bucket at least
+    assert metric_value(client, f'http_request_duration_seconds_count{{{labels}}}') == count + 2
+    assert metric_value(client, f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}}') == count + 2
+    assert metric_value(client, f'http_request_queries_count{{{labels}}}') == count + 2
+    response = client.request('GET', '/api/_metrics')
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    assert '# TYPE http_request_db_seconds histogram' in response.body.decode()
+
+    # Requests running more statements than QUERY_BUDGET are logged
+    app.config['QUERY_BUDGET'] = 0
+    client.request('GET', '/api/clubs')
+    assert 'GET /api/clubs? ran' in caplog.text and '(budget 0)' in caplog.text
+
+# Returns the rows of a table as a sorted list
+def table_rows(table):
+    return sorted(tuple(row) for row in db.session.query(table))
+
+# The tag_stats triggers follow club creations, tag edits, club and tag deletions and match a full recount
+def test_tag_counts(client, in_app):
+    def counts():
+        return {tag['name']: tag['number_of_clubs'] for tag in client.request('GET', '/api/tags').json()}
+
+    before = counts()
+    chess = client.request('POST', '/api/clubs', json={
+        'code': 'chess', 'name': 'Penn Chess Club', 'tags': ['Undergraduate', 'Games']}).json()['id']
+    assert counts() == {**before, 'Undergraduate': before['Undergraduate'] + 1, 'Games': 1}
+    assert client.request('POST', f'/api/clubs/{chess}', json={'tags': ['Games', 'Athletics']}).status_code == 200
+    assert counts() == {**before, 'Games': 1, 'Athletics': before['Athletics'] + 1}
+    # The club's club_tags rows are deleted by ON DELETE CASCADE, which runs the triggers too
+    assert client.request('DELETE', f'/api/clubs/{chess}').status_code == 204
+    assert counts() == {**before, 'Games': 0}
+
+    def delete_tag():
+        db.session.delete(Tag.query.filter_by(name='Athletics').one())
+        db.session.commit()
+        stored = table_rows(tag_stats)
+        rebuild_tag_stats()
+        return stored, table_rows(tag_stats)
+    stored, recounted = in_app(delete_tag)
+    assert stored == recounted
+    assert counts() == {name: count for name, count in before.items() if name != 'Athletics'} | {'Games': 0}
+
+# /api/clubs/trending follows joins, favorites, comments and their removal through the club_activity triggers
+def test_trending_clubs(client, in_app):
+    pppjo, pppp, josh = club_id(in_app, 'pppjo'), club_id(in_app, 'pppp'), user_id(in_app)
+
+    def trending(query=''):
+        return [(club['code'], club['score']) for club in client.request('GET', f'/api/clubs/trending{query}').json()]
+
+    assert trending() == []
+    client.request('POST', f'/api/clubs/{pppjo}/join', json={'user_id': josh})
+    assert trending() == [('pppjo', 1)]
+    for body in ('First', 'Second'):
+        client.request('POST', f'/api/clubs/{pppp}/comments', json={'user_id': josh, 'body': body})
+    client.request('POST', f'/api/clubs/{pppjo}/favorite', json={'user_id': josh})
+    assert trending() == [('pppjo', 2), ('pppp', 2)]
+    assert trending('?metric=comments') == [('pppp', 2)]
+    assert trending('?metric=joins&days=1') == [('pppjo', 1)]
+    assert client.request('GET', '/api/clubs/trending?metric=views').status_code == 400
+
+    # Leaving the club removes its join, and deleting a club removes its rows by ON DELETE CASCADE
+    client.request('POST', f'/api/clubs/{pppjo}/join', json={'user_id': josh})
+    assert trending() == [('pppp', 2), ('pppjo', 1)]
+    assert client.request('DELETE', f'/api/clubs/{pppp}').status_code == 204
+    assert trending() == [('pppjo', 1)]
+    client.request('POST', f'/api/clubs/{pppjo}/favorite', json={'user_id': josh})
+    assert trending() == []
+
+    def recount():
+        stored = table_rows(club_activity)
+        rebuild_club_activity()
+        return stored, table_rows(club_activity)
+    stored, recounted = in_app(recount)
+    # Rows whose counters all went back to 0 are kept by the triggers but not made by a recount
+    assert [row for row in stored if any(row[2:])] == recounted
+
+# Deleting a user keeps their comments without an author (ON DELETE SET NULL), while deleting a club removes its
+# comments, memberships and favorites (ON DELETE CASCADE)
+def test_delete_policies(client, in_app):
+    club, josh = club_id(in_app, 'locustlabs'), user_id(in_app)
+    ada = client.request('POST', '/api/users', json={'name': 'Ada', 'email': 'ada@upenn.edu'}).json()['id']
+    url = f'/api/clubs/{club}/comments'
+    client.request('POST', f'/api/clubs/{club}/join', json={'user_id': ada})
+    client.request('POST', f'/api/clubs/{club}/favorite', json={'user_id': ada})
+    client.request('POST', f'/api/clubs/{club}/join', json={'user_id': josh})
+    top = client.request('POST', url, json={'user_id': ada, 'body': 'Hello'}).json()['id']
+    client.request('POST', url, json={'user_id': josh, 'body': 'Hi Ada', 'parent_id': top})
+
+    assert client.request('DELETE', f'/api/users/{ada}').status_code == 204
+    threads = client.request('GET', url).json()
+    assert [(comment['body'], comment['user']) for comment in threads] == [('Hello', None)]
+    assert threads[0]['replies'][0]['user'] is not None
+    club_json = client.request('GET', f'/api/clubs/{club}').json()
+    assert (club_json['members'], club_json['favorites'], club_json['comments']) == (1, 0, 2)
+
+    assert client.request('DELETE', f'/api/clubs/{club}').status_code == 204
+    assert client.request('GET', f'/api/comments/{top}').status_code == 404
+    assert client.request('GET', f'/api/users/{josh}').json()['clubs'] == []
+    assert in_app(lambda: (Comment.query.count(), db.session.query(club_members).count())) == (0, 0)
+
+# preload_app fills the response cache and the recommendation index, closes the pooled connections, forgets its
+# requests in the metrics and freezes the objects it made
+def test_preload_app(client, tmp_path):
+    (tmp_path / 'preload').mkdir()
+    seeded = make_app(tmp_path / 'preload')
+    dispose_app(seeded)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': seeded.config['SQLALCHEMY_DATABASE_URI'], 'PRELOAD': True})
+    preloaded_client = None
+    try:
+        assert gc.get_freeze_count() > 0
+        assert app.extensions['recommendations'].index is not None
+        with app.app_context():
+            assert all(engine.pool.checkedin() == 0 for engine in db.engines.values())
+
+        preloaded_client = type(client)(app)
+        metrics = preloaded_client.request('GET', '/api/_metrics').body.decode()
+        assert '_count{' not in metrics
+        stats = preloaded_client.request('GET', '/api/_cache').json()
+        # Every preloaded path but the search, whose responses are not cached
+        assert (stats['entries'], stats['hits']) == (len(PRELOAD_PATHS) - 1, 0)
+        for path in ('/api/tags', '/api/schools', '/api/clubs/trending'):
+            assert preloaded_client.request('GET', path).status_code == 200
+        assert preloaded_client.request('GET', '/api/_cache').json()['hits'] == 3
+    finally:
+        if preloaded_client is not None:
+            preloaded_client.close()
+        dispose_app(app)
+        gc.unfreeze()
@@ -0,0 +1,105 @@
+import json
+
+import pytest
+
+from database import db
+from models import Club, Comment, User
+
+# Requests interleaving on the ASGI app's event loop must each see their own Flask contexts and db.session
+
+pytestmark = pytest.mark.parametrize('client', ['asgi'], indirect=True)
+
+# Wraps asgi.dispatch to record how many requests were being dispatched at the same time
+@pytest.fixture
+def overlap(monkeypatch):
+    import asgi
+
+    counts = {'active': 0, 'max': 0}
+    dispatch = asgi.dispatch
+
+    def counting_dispatch(session, app, environ, send):
+        counts['active'] += 1
+        counts['max'] = max(counts['max'], counts['active'])
+        try:
+            return dispatch(session, app, environ, send)
+        finally:
+            counts['active'] -= 1
+
+    monkeypatch.setattr(asgi, 'dispatch', counting_dispatch)
+    return counts
+
+def test_concurrent_reads_are_isolated(client, in_app, overlap):
+    clubs = in_app(lambda: {club.id: club.code for club in Club.query})
+    requests = [('GET', f'/api/clubs/{club_id}', None) for club_id in clubs] * 10
+    responses = client.gather(requests)
+    assert overlap['max'] > 1
+    for (_, url, _), response in zip(requests, responses):
+        assert response.status_code == 200
+        assert clubs[response.json()['id']] == clubs[int(url.rsplit('/', 1)[1])]
+    # Every request's session was removed by its app context's teardown
+    assert db.session.registry.registry == {}
+
+def test_concurrent_writes_are_isolated(client, in_app, overlap):
+    club_id = in_app(lambda: Club.query.filter_by(code='locustlabs').one().id)
+    user_id = in_app(lambda: User.query.one().id)
+    requests = [('POST', f'/api/clubs/{club_id}/comments', {'user_id': user_id, 'body': f'Comment {n}'})
+                for n in range(20)]
+    responses = client.gather(requests)
+    assert overlap['max'] > 1
+    assert [response.status_code for response in responses] == [201] * 20
+    assert [response.json()['body'] for response in responses] == [f'Comment {n}' for n in range(20)]
+    assert in_app(lambda: Comment.query.count()) == 20
+    assert client.request('GET', f'/api/clubs/{club_id}').json()['comments'] == 20
+    assert db.session.registry.registry == {}
+
+# Sends a GET request straight to the ASGI app and returns the ASGI messages it sent back
+def asgi_messages(client, path, query_string=b'', headers=()):
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string, 'headers': list(headers),
+             'http_version': '1.1', 'scheme': 'http', 'root_path': ''}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    client.loop.run_until_complete(client.application(scope, receive, send))
+    return messages
+
+def test_streamed_responses_are_sent_in_chunks(client, monkeypatch):
+    import app
+
+    monkeypatch.setattr(app, 'STREAM_BATCH_SIZE', 2)
+    messages = asgi_messages(client, '/api/clubs/search/penn', b'stream=true')
+    assert messages[0]['type'] == 'http.response.start' and messages[0]['status'] == 200
+    bodies = messages[1:]
+    # The opening bracket, one message per batch of clubs and the closing bracket
+    assert len(bodies) > 2
+    assert all(message['more_body'] for message in bodies[:-1])
+    assert not bodies[-1].get('more_body', False)
+    clubs = json.loads(b''.join(message['body'] for message in bodies))
+    assert len(clubs) == len(client.request('GET', '/api/clubs/search/penn').json())
+
+    lines = asgi_messages(client, '/api/clubs/search/penn', headers=[(b'accept', b'application/x-ndjson')])[1:]
+    assert len(lines) > 1
+    assert len([json.loads(line) for message in lines for line in message['body'].splitlines()]) == len(clubs)
+
+def test_plain_responses_are_sent_in_one_message(client):
+    messages = asgi_messages(client, '/api/tags')
+    assert [message['type'] for message in messages] == ['http.response.start', 'http.response.body']
+    assert not messages[1].get('more_body', False)
+
+# Requests waiting for their group commit await it on the event loop, so the writes of concurrent requests share
+# batches instead of each blocking the loop until its own commit
+def test_group_commit_does_not_block_the_loop(app, client, in_app):
+    app.config.update(GROUP_COMMIT_ENABLED=True, GROUP_COMMIT_INTERVAL=0.05)
+    club_id = in_app(lambda: Club.query.filter_by(code='locustlabs').one().id)
+    user_id = in_app(lambda: User.query.one().id)
+    requests = [('POST', f'/api/clubs/{club_id}/comments', {'user_id': user_id, 'body': f'Comment {n}'})
+                for n in range(20)]
+    responses = client.gather(requests)
+    assert [response.status_code for response in responses] == [201] * 20
+    writer = app.config['GROUP_COMMIT_WRITER']
+    assert writer.writes == 20 and writer.batches < 20
+    assert in_app(lambda: Comment.query.count()) == 20
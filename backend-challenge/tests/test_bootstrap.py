@@ -0,0 +1,94 @@
+import io
+import json
+
+import pytest
+from sqlalchemy import text
+
+from bootstrap import bulk_load_clubs, iter_json_records, schema_differences
+from database import db
+from conftest import CLUBS_FILE
+from models import Club
+
+# Loading clubs.json again updates the clubs in place
+def test_reload_is_idempotent(in_app):
+    def load():
+        assert bulk_load_clubs(CLUBS_FILE, report=lambda message: None) == 5
+        return {club.code: (club.name, club.version) for club in Club.query}
+
+    clubs = in_app(load)
+    assert len(clubs) == 5
+    assert all(version == 2 for _, version in clubs.values())
+
+# A record named like a club with another code is skipped and reported, and the rest of the file still loads
+def test_name_conflicts_are_skipped(tmp_path, in_app):
+    path = tmp_path / 'clubs.jsonl'
+    records = [
+        {'code': 'juggling', 'name': 'Penn Pre-Professional Juggling Organization', 'tags': ['Athletics']},
+        {'code': 'chess', 'name': 'Penn Chess Club', 'tags': ['Games']},
+        {'code': 'chess2', 'name': 'Penn Chess Club'},
+        {'code': 'pppjo', 'name': 'Penn Juggling', 'description': 'Renamed.'}
+    ]
+    path.write_text('\n'.join(json.dumps(record) for record in records))
+    messages = []
+
+    def load():
+        assert bulk_load_clubs(path, chunk_size=2, report=messages.append) == 4
+        return {club.code: club.name for club in Club.query}
+
+    clubs = in_app(load)
+    assert [message for message in messages if message.startswith('Skipped')] == [
+        "Skipped club juggling: another club is already named 'Penn Pre-Professional Juggling Organization'",
+        "Skipped club chess2: another club is already named 'Penn Chess Club'"
+    ]
+    assert 'juggling' not in clubs and 'chess2' not in clubs
+    assert (clubs['chess'], clubs['pppjo']) == ('Penn Chess Club', 'Penn Juggling')
+
+# bootstrap.py --append refuses databases created before the version columns and ON DELETE actions
+def test_schema_differences(in_app):
+    assert in_app(schema_differences) == []
+
+    def downgrade():
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE club DROP COLUMN version'))
+            connection.execute(text('DROP TABLE club_favorites'))
+            connection.execute(text('CREATE TABLE club_favorites (club_id INTEGER REFERENCES club (id), '
+                                    'user_id INTEGER REFERENCES user (id), PRIMARY KEY (club_id, user_id))'))
+        return schema_differences()
+
+    assert in_app(downgrade) == [
+        'club.version is missing', 'club_favorites.created_at is missing',
+        'club_favorites.club_id has no ON DELETE CASCADE', 'club_favorites.user_id has no ON DELETE CASCADE'
+    ]
+
+# File reading a few characters at a time, which records how much was read
+class SlowFile(io.StringIO):
+    def __init__(self, text):
+        super().__init__(text)
+        self.reads = []
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.reads.append(len(data))
+        return data
+
+RECORDS = [{'code': f'club{n}', 'name': f'Club {n}', 'description': 'x' * 50 * n} for n in range(5)]
+
+@pytest.mark.parametrize('text', [json.dumps(RECORDS), '\n'.join(json.dumps(record) for record in RECORDS)])
+def test_records_span_several_reads(text):
+    json_file = SlowFile(text)
+    assert list(iter_json_records(json_file, read_size=8)) == RECORDS
+    # Each retry reads as much again as the buffered record, instead of read_size at a time
+    assert len(json_file.reads) < 40
+
+def test_malformed_record_stops_reading():
+    # The rest of the file is never read
+    json_file = SlowFile('[{"code": "a", "name": "A"}, {"code": oops, "name": "B"}, ' + '{"code": "c"}, ' * 100000 + ']')
+    records = iter_json_records(json_file, read_size=64, max_record_size=1024)
+    assert next(records) == {'code': 'a', 'name': 'A'}
+    with pytest.raises(json.JSONDecodeError, match='Record longer than 1024 characters'):
+        next(records)
+    assert sum(json_file.reads) <= 1024 + 64
+
+    # A file ending in the middle of a record
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_records(SlowFile('[{"code": "a"}, {"code": "b", "na'), read_size=4))
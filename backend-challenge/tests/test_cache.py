@@ -0,0 +1,98 @@
+import pytest
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from cache import TABLE_DEPENDENCIES, CacheBackend, LRUCache
+from database import db
+from models import Club, Comment, Major, School, Tag, User, club_favorites, club_members, club_tags
+
+# The response cache (cache.py): writes through the API and Core statements on every table of TABLE_DEPENDENCIES
+# must evict the cached responses they change
+
+def test_backend_must_implement_interface():
+    class GetOnly(CacheBackend):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnly()
+    assert isinstance(LRUCache(), CacheBackend)
+
+# Sends a GET request, and checks the next one is served from the cache with the same body
+def cached_get(client, app, url):
+    response = client.get(url)
+    hits = app.config['RESPONSE_CACHE_BACKEND'].stats()['hits']
+    assert client.get(url).get_data() == response.get_data()
+    assert app.config['RESPONSE_CACHE_BACKEND'].stats()['hits'] == hits + 1
+    return response
+
+def test_writes_evict_cached_responses(app, in_app):
+    client = app.test_client()
+    pppjo = in_app(lambda: Club.query.filter_by(code='pppjo').one().id)
+    josh = in_app(lambda: User.query.one().id)
+    url = f'/api/clubs/{pppjo}'
+
+    # Club edit
+    etag = cached_get(client, app, url).headers['ETag']
+    client.post(url, json={'description': 'Edited.'})
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['description'] == 'Edited.'
+
+    # A user joining the club
+    cached_get(client, app, url)
+    client.post(f'{url}/join', json={'user_id': josh})
+    assert client.get(url).get_json()['members'] == 1
+
+    # A comment on the club, its edit and its deletion
+    cached_get(client, app, url)
+    comment = client.post(f'{url}/comments', json={'user_id': josh, 'body': 'Hi'}).get_json()['id']
+    assert client.get(url).get_json()['comments'] == 1
+    etag = cached_get(client, app, url).headers['ETag']
+    client.post(f'/api/comments/{comment}', json={'body': 'Edited'})
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 200
+    cached_get(client, app, url)
+    client.delete(f'/api/comments/{comment}')
+    assert client.get(url).get_json()['comments'] == 0
+
+    # A user edit adding a new school
+    cached_get(client, app, '/api/schools')
+    client.post(f'/api/users/{josh}', json={'schools': [{'id': 5, 'code': 'NURS', 'name': 'Nursing'}]})
+    assert [school['code'] for school in client.get('/api/schools').get_json()] == ['SEAS', 'NURS']
+
+# A Core statement on each table of TABLE_DEPENDENCIES, changing what the cached responses show
+CORE_WRITES = {
+    'club': lambda ids: Club.__table__.update().where(Club.id == ids['pppjo']).values(description='Core'),
+    'tag': lambda ids: Tag.__table__.insert().values(name='Core Tag'),
+    'club_tags': lambda ids: club_tags.insert().values(club_id=ids['pppjo'], tag_id=ids['graduate']),
+    'club_members': lambda ids: club_members.insert().values(club_id=ids['pppjo'], user_id=ids['josh']),
+    'club_favorites': lambda ids: club_favorites.insert().values(club_id=ids['pppjo'], user_id=ids['josh']),
+    'comment': lambda ids: Comment.__table__.insert().values(club_id=ids['pppjo'], user_id=ids['josh'], body='Core'),
+    'school': lambda ids: sqlite_insert(School.__table__).values(code='CORE', name='Core School'),
+    'major': lambda ids: Major.__table__.update().values(name='Core Major')
+}
+
+def test_table_dependencies_cover_core_writes(app, in_app):
+    assert set(CORE_WRITES) == set(TABLE_DEPENDENCIES)
+    client = app.test_client()
+    ids = in_app(lambda: {
+        'pppjo': Club.query.filter_by(code='pppjo').one().id,
+        'graduate': Tag.query.filter_by(name='Graduate').one().id,
+        'undergraduate': Tag.query.filter_by(name='Undergraduate').one().id,
+        'josh': User.query.one().id
+    })
+    urls = [f"/api/clubs/{ids['pppjo']}", '/api/clubs', '/api/clubs/trending', '/api/tags',
+            f"/api/tags/{ids['graduate']}", f"/api/tags/{ids['undergraduate']}", '/api/schools', '/api/majors']
+
+    def write(table):
+        db.session.execute(CORE_WRITES[table](ids))
+        db.session.commit()
+
+    for table in CORE_WRITES:
+        cached = {url: cached_get(client, app, url).get_data() for url in urls}
+        in_app(write, table)
+        app.config['RESPONSE_CACHE_ENABLED'] = False
+        fresh = {url: client.get(url).get_data() for url in urls}
+        app.config['RESPONSE_CACHE_ENABLED'] = True
+        assert any(cached[url] != fresh[url] for url in urls), table
+        # Every changed response was evicted
+        assert {url: client.get(url).get_data() for url in urls} == fresh, table
@@ -0,0 +1,72 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from app import write_link_toggle
+from database import db
+from group_commit import GroupCommitWriter
+from models import Club, Comment, School, User, club_members
+
+# The group commit writer (group_commit.py), driven directly. Writes submitted together fall within one batch, as
+# the interval is much longer than it takes to submit them.
+
+@pytest.fixture
+def writer(app):
+    return GroupCommitWriter(app, interval=0.2, max_batch=100)
+
+def add_school(code):
+    school = School(code=code, name=f'School {code}')
+    db.session.add(school)
+    db.session.flush()
+    return school.id
+
+def add_school_and_fail(code):
+    add_school(code)
+    raise ValueError(f'{code} failed')
+
+# Adds a comment by a user who does not exist. SQLite only checks deferred foreign keys on commit, so the write
+# itself succeeds and the commit of its batch fails.
+def add_orphan_comment(club_id):
+    db.session.execute(text('PRAGMA defer_foreign_keys = ON'))
+    db.session.add(Comment(club_id=club_id, user_id=999999, body='Orphan'))
+    db.session.flush()
+
+def school_codes(in_app):
+    return in_app(lambda: sorted(code for code, in db.session.query(School.code)))
+
+def test_writes_are_committed_in_one_batch(writer, in_app):
+    futures = [writer.submit(add_school, (f'B{n}',)) for n in range(5)]
+    assert [future.result(timeout=5)[1] for future in futures] == [True] * 5
+    assert (writer.batches, writer.writes) == (1, 5)
+    assert school_codes(in_app) == ['B0', 'B1', 'B2', 'B3', 'B4', 'SEAS']
+
+def test_failed_write_only_rolls_back_itself(writer, in_app):
+    futures = [writer.submit(add_school, ('A',)), writer.submit(add_school_and_fail, ('X',)),
+               writer.submit(add_school, ('C',))]
+    assert isinstance(futures[0].result(timeout=5)[0], int)
+    with pytest.raises(ValueError, match='X failed'):
+        futures[1].result(timeout=5)
+    assert isinstance(futures[2].result(timeout=5)[0], int)
+    assert (writer.batches, writer.writes) == (1, 3)
+    assert school_codes(in_app) == ['A', 'C', 'SEAS']
+
+def test_failed_commit_retries_each_write_once(writer, in_app):
+    club_id = in_app(lambda: Club.query.filter_by(code='pppjo').one().id)
+    user_id = in_app(lambda: User.query.one().id)
+    calls = []
+
+    def toggle(*args):
+        calls.append(args)
+        return write_link_toggle(*args)
+
+    futures = [writer.submit(toggle, (club_members, club_id, user_id)), writer.submit(add_orphan_comment, (club_id,)),
+               writer.submit(add_school, ('A',))]
+    # The toggle joined the club once: it was rolled back with the failed batch and applied again on its own
+    assert futures[0].result(timeout=5) == (True, True)
+    with pytest.raises(IntegrityError, match='FOREIGN KEY'):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5)[1]
+    assert len(calls) == 2
+    assert in_app(lambda: db.session.query(club_members).count()) == 1
+    assert in_app(lambda: Comment.query.count()) == 0
+    assert school_codes(in_app) == ['A', 'SEAS']
@@ -0,0 +1,72 @@
+import pytest
+
+from bootstrap import upsert_clubs
+from conftest import dispose_app, make_app
+from database import db
+from models import Major, School, Tag
+from search import rebuild_search_index
+from serializers import assert_max_queries, count_queries
+
+# Statement budgets of the list endpoints. Each endpoint must run the same number of statements whether it
+# returns a handful of rows or many, so N+1 queries show up as a failing test. Responses are not cached here, so
+# every request reaches the database.
+
+# Maximum number of statements of each endpoint, whatever the number of rows it returns
+BUDGETS = {
+    '/api/tags': 3,
+    '/api/tags/{undergraduate}': 7,
+    '/api/clubs/search/penn': 6,
+    '/api/schools': 2,
+    '/api/majors': 2,
+    '/api/test': 6
+}
+
+# Adds count clubs (all tagged Undergraduate and named "Penn Club ..."), schools and majors
+def add_rows(count):
+    upsert_clubs([{'code': f'club{n}', 'name': f'Penn Club {n}', 'description': 'Open to all.',
+                   'tags': ['Undergraduate', f'Topic {n % 7}']} for n in range(count)])
+    db.session.add_all(School(code=f'S{n}', name=f'School {n}') for n in range(count))
+    db.session.add_all(Major(code=f'M{n}', name=f'Major {n}') for n in range(count))
+    rebuild_search_index()
+    db.session.commit()
+
+# Sends a GET request to each endpoint within its budget. Returns the number of statements and of items of each.
+def measure(app, client):
+    undergraduate = Tag.query.filter_by(name='Undergraduate').one().id
+    results = {}
+    for path, budget in BUDGETS.items():
+        with assert_max_queries(budget) as statements:
+            response = client.get(path.format(undergraduate=undergraduate))
+        assert response.status_code == 200
+        results[path] = (len(statements), len(response.get_json()))
+    return results
+
+def test_statements_do_not_grow_with_results(app):
+    app.config['RESPONSE_CACHE_ENABLED'] = False
+    client = app.test_client()
+    with app.app_context():
+        few = measure(app, client)
+        add_rows(40)
+        many = measure(app, client)
+
+    for path in BUDGETS:
+        assert many[path][1] > few[path][1], path
+        assert many[path][0] == few[path][0], path
+
+def test_assert_max_queries_reports_statements(app):
+    with app.app_context(), pytest.raises(AssertionError, match='Expected at most 1 queries but 3'):
+        with assert_max_queries(1):
+            app.test_client().get('/api/tags')
+
+# Read requests routed to the read-only engine are counted too
+def test_count_queries_includes_read_engine(tmp_path, monkeypatch):
+    monkeypatch.setenv('READ_DATABASE_URL', 'readonly')
+    app = make_app(tmp_path, {'RESPONSE_CACHE_ENABLED': False})
+    try:
+        with app.app_context():
+            assert 'read' in db.engines
+            with count_queries() as statements:
+                assert app.test_client().get('/api/clubs/search/penn').status_code == 200
+            assert len(statements) == BUDGETS['/api/clubs/search/penn']
+    finally:
+        dispose_app(app)
@@ -0,0 +1,108 @@
+from flask import request
+from sqlalchemy import bindparam, text
+
+from database import db
+from metrics import timed_serialization
+
+from models import *
+from pagination import PaginationError, encode_cursor, get_int_arg
+
+# Loads comment threads with a single recursive query instead of walking Comment.replies one comment at a time.
+# The query starts from a list of root comments, follows replies down to an optional depth, keeps at most
+# replies_limit replies per comment at each level (oldest first), and joins each comment to its author, if the
+# author was not deleted.
+# The rows come back ordered by creation time, so the tree is assembled in one pass over the results.
+
+# Depth used when no depth limit is given. Deeper replies than this are not returned.
+MAX_THREAD_DEPTH = 1000
+
+THREAD_QUERY = text(
+    'WITH RECURSIVE thread(id, depth) AS ('
+    'SELECT id, 0 FROM comment WHERE id IN :root_ids '
+    'UNION ALL '
+    'SELECT reply.id, thread.depth + 1 FROM thread JOIN comment AS reply ON reply.id IN ('
+    'SELECT sibling.id FROM comment AS sibling WHERE sibling.parent_id = thread.id '
+    'ORDER BY sibling.created_at, sibling.id LIMIT :replies_limit'
+    ') WHERE thread.depth < :max_depth'
+    ') '
+    'SELECT comment.id, comment.body, comment.club_id, comment.parent_id, comment.created_at, comment.updated_at, '
+    'comment.user_id, "user".name AS user_name, '
+    '(SELECT COUNT(*) FROM comment AS child WHERE child.parent_id = comment.id) AS reply_count '
+    'FROM thread JOIN comment ON comment.id = thread.id LEFT JOIN "user" ON "user".id = comment.user_id '
+    'ORDER BY comment.created_at, comment.id'
+).bindparams(bindparam('root_ids', expanding=True)).columns(
+    id=db.Integer,
+    body=db.Text,
+    club_id=db.Integer,
+    parent_id=db.Integer,
+    created_at=db.DateTime,
+    updated_at=db.DateTime,
+    user_id=db.Integer,
+    user_name=db.String,
+    reply_count=db.Integer
+)
+
+# Returns the json data for the comment threads starting at root_ids, in the order of root_ids, in one query.
+# max_depth limits how many levels of replies are returned (0 returns only the root comments).
+# replies_limit limits how many replies are returned under each comment.
+# Every comment includes `reply_count`, its total number of direct replies, so clients can tell when replies were cut off.
+@timed_serialization
+def load_threads(root_ids, max_depth=None, replies_limit=None):
+    if not root_ids:
+        return []
+    rows = db.session.execute(THREAD_QUERY, {
+        'root_ids': list(root_ids),
+        'max_depth': MAX_THREAD_DEPTH if max_depth is None else max_depth,
+        'replies_limit': -1 if replies_limit is None else replies_limit
+    })
+
+    rows = rows.all()
+    comments = {}
+    for row in rows:
+        comments[row.id] = {
+            'id': row.id,
+            'user': {'id': row.user_id, 'name': row.user_name} if row.user_id is not None else None,
+            'club_id': row.club_id,
+            'parent_id': row.parent_id,
+            'body': row.body,
+            'created_at': row.created_at.isoformat() if row.created_at else None,
+            'updated_at': row.updated_at.isoformat() if row.updated_at else None,
+            'reply_count': row.reply_count,
+            'replies': []
+        }
+
+    # Rows are ordered by creation time, so appending keeps every reply list in order
+    roots = set(root_ids)
+    for row in rows:
+        if row.id not in roots:
+            comments[row.parent_id]['replies'].append(comments[row.id])
+    return [comments[root_id] for root_id in root_ids if root_id in comments]
+
+# Reads the optional `depth` and `replies_limit` query parameters of the current request.
+# Returns a tuple of (max depth or None, replies limit or None).
+def get_thread_args():
+    max_depth = get_int_arg('depth')
+    replies_limit = get_int_arg('replies_limit')
+    if max_depth is not None and max_depth < 0:
+        raise PaginationError("depth must not be negative")
+    if replies_limit is not None and replies_limit < 0:
+        raise PaginationError("replies_limit must not be negative")
+    return max_depth, replies_limit
+
+# Returns the cursor of the page of a comment's replies to return: the request's `cursor`, or else the cursor of
+# the replies after the reply whose id is the `after` query parameter, e.g. the last reply a thread returned
+# when replies_limit cut off the rest. Returns None for the first page.
+def get_replies_cursor(comment_id, cursor):
+    after = request.args.get('after')
+    if cursor is not None or after is None:
+        return cursor
+    try:
+        after = int(after)
+    except ValueError:
+        raise PaginationError("after must be the id of a reply")
+    # The created_at of the cursor is the string SQLite stores, as in paginate_ids
+    key = db.session.query(db.type_coerce(Comment.created_at, db.String), Comment.id) \
+        .filter(Comment.id == after, Comment.parent_id == comment_id).first()
+    if key is None:
+        raise PaginationError("after must be the id of a reply of the comment")
+    return encode_cursor(list(key))
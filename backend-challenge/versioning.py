@@ -0,0 +1,152 @@
+import hashlib
+
+from flask import request, current_app
+from sqlalchemy import event, inspect
+
+from database import db
+
+from models import *
+from streaming import get_stream_format
+
+# Row versions, ETags and conditional requests.
+# Club, User and Comment each have a version column that is incremented in the same flush as any change to
+# the data they serialize to, including changes to related rows that only live in association tables
+# (tags, memberships, favorites) and comments created or deleted under a club.
+# Club and User versions are incremented in SQL (version = version + 1), so edits, joins and comments made at the
+# same time each add their own increment and none of them is rejected. An edit only has to start from the
+# version the client saw when it sends If-Match: lock_if_match locks the row before the ETag is compared, so it
+# cannot change between the check and the write.
+# Comment's version is also the mapper's version_id_col, so the ORM only writes a comment if its version is still
+# the one that was read, and a concurrent edit raises StaleDataError instead of silently overwriting the other.
+# Comment versions are only changed by edits of the comment itself.
+# GET handlers build strong ETags from these versions, which only needs the version columns and not the
+# serialized json, so matching If-None-Match headers are answered with a 304 before any serialization.
+
+# Increments the version of an instance once per flush. New and deleted instances are left alone.
+def bump_version(session, instance, bumped):
+    if instance is None or instance in bumped or instance in session.new or instance in session.deleted:
+        return
+    bumped.add(instance)
+    if isinstance(instance, Comment):
+        # version_id_col values must be known before the UPDATE, which checks the previous one
+        instance.version = (instance.version or 0) + 1
+    else:
+        # Added to the current value in the UPDATE, and read back the next time it is used
+        instance.version = type(instance).version + 1
+
+# Returns the clubs added to or removed from a relationship collection in the pending flush
+def changed_clubs(instance, attribute):
+    history = inspect(instance).attrs[attribute].history
+    return list(history.added or ()) + list(history.deleted or ())
+
+# Increments the version of every club, user and comment whose json is changed by the pending flush.
+# Instances edited by the flush are bumped through the ORM in the UPDATE of the edit. Clubs whose json only
+# changes through other rows (member, favorite and comment counts, comment listings) are bumped with
+# bump_versions instead: two users commenting on or joining the same club at the same time do not edit the club,
+# and neither conflicts with an edit of the club.
+@event.listens_for(db.session, 'before_flush')
+def bump_changed_versions(session, flush_context, instances):
+    bumped = set()
+    club_ids = set()
+    for instance in list(session.dirty):
+        if not session.is_modified(instance):
+            continue
+        if isinstance(instance, (Club, User, Comment)):
+            bump_version(session, instance, bumped)
+        if isinstance(instance, User):
+            # Member and favorite counts of the clubs joined, left, favorited or unfavorited
+            club_ids.update(club.id for club in changed_clubs(instance, 'clubs') + changed_clubs(instance, 'favorites'))
+        if isinstance(instance, Comment) and instance.club_id is not None:
+            club_ids.add(instance.club_id)
+
+    # Deleted users' clubs are bumped by the user DELETE handler with bump_versions, since their memberships are
+    # removed by the database and never loaded
+    for instance in list(session.new) + list(session.deleted):
+        if isinstance(instance, Comment) and instance.club_id is not None:
+            # Comment count and comment listings of the club
+            club_ids.add(instance.club_id)
+
+    # Clubs edited by this flush, or created or deleted by it, are already handled
+    for instance in list(bumped) + list(session.new) + list(session.deleted):
+        if isinstance(instance, Club):
+            club_ids.discard(instance.id)
+    club_ids.discard(None)
+    bump_versions(Club, sorted(club_ids))
+    # Loaded clubs read their new version from the database the next time it is used
+    for club_id in club_ids:
+        club = session.identity_map.get(inspect(Club).identity_key_from_primary_key((club_id,)))
+        if club is not None:
+            session.expire(club, ['version'])
+
+# Increments the versions of the rows of model with the given ids in one statement.
+# For writes made with Core statements, which the before_flush hook above does not see.
+def bump_versions(model, ids):
+    if ids:
+        statement = model.__table__.update().where(model.id.in_(ids)).values(version=model.version + 1)
+        db.session.execute(statement, execution_options={
+            'cache_changes': [(model.__tablename__, model_id) for model_id in ids]})
+
+# Returns a strong ETag value built from the given parts
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+# Returns the ETag of a club's json, or None if the club does not exist
+def club_etag(club_id):
+    version = db.session.query(Club.version).filter(Club.id == club_id).scalar()
+    if version is None:
+        return None
+    return make_etag('club', club_id, version)
+
+# Returns the ETag of a user's json, or None if the user does not exist.
+# Includes the versions of the user's clubs and favorites, since their names are part of the user's json.
+def user_etag(user_id):
+    version = db.session.query(User.version).filter(User.id == user_id).scalar()
+    if version is None:
+        return None
+    club_ids = db.session.query(club_members.c.club_id).filter(club_members.c.user_id == user_id).union(
+        db.session.query(club_favorites.c.club_id).filter(club_favorites.c.user_id == user_id))
+    clubs = db.session.query(Club.id, Club.version).filter(Club.id.in_(club_ids)).order_by(Club.id).all()
+    return make_etag('user', user_id, version, [tuple(club) for club in clubs])
+
+# Returns the ETag of the comments under a club for the current request's query parameters, or None if the club
+# does not exist. The club's version changes with every comment created, edited or deleted under it, and the
+# versions of the authors are included since their names are part of each comment's json.
+def club_comments_etag(club_id):
+    version = db.session.query(Club.version).filter(Club.id == club_id).scalar()
+    if version is None:
+        return None
+    author_ids = db.session.query(Comment.user_id).filter(Comment.club_id == club_id)
+    authors = db.session.query(User.id, User.version).filter(User.id.in_(author_ids)).order_by(User.id).all()
+    # Streamed and paginated responses have different bodies for the same query string
+    return make_etag('comments', club_id, version, [tuple(author) for author in authors], request.query_string,
+                     get_stream_format())
+
+# Returns the ETag of a comment and its replies for the current request's query parameters
+def comment_etag(comment):
+    return make_etag('comment', comment.id, comment.version, club_comments_etag(comment.club_id))
+
+# Returns an empty 304 response if the request's If-None-Match header matches etag, otherwise None
+def not_modified(etag):
+    if not request.if_none_match.contains(etag):
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+# Returns True unless the request has an If-Match header that does not match etag
+def if_match_passes(etag):
+    return not request.if_match or request.if_match.contains(etag)
+
+# Locks the row of model with the given id for the rest of the transaction if the request has an If-Match header,
+# so the ETag compared next stays current until the edit commits. The UPDATE leaves the row as it is, but takes
+# the database's write lock (SQLite) or the row's lock.
+def lock_if_match(model, row_id):
+    if request.if_match:
+        db.session.execute(
+            model.__table__.update().where(model.id == row_id).values(version=model.version),
+            execution_options={'cache_changes': [(model.__tablename__, row_id)]})
+
+# Sets the ETag header of a response and returns it
+def with_etag(response, etag):
+    response.set_etag(etag)
+    return response